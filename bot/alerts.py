@@ -0,0 +1,103 @@
+"""Listener of proximity alerts pushed by the API.
+
+The API publishes an alert once, when the bus comes close to the stop, to
+its stream endpoint. The listener keeps one connection to the stream open
+and reconnects when it drops; alerts fired while it is down are lost, so
+the user can still check the bus with "Обновить".
+"""
+import json
+import logging
+import threading
+
+import requests
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# The API sends a ping every 15 seconds, a silent stream is dead.
+READ_TIMEOUT: float = 60
+CONNECT_TIMEOUT: float = 3.05
+RECONNECT_DELAYS: tuple = (1, 2, 5, 10, 30)
+
+
+def read_events(lines):
+    """Yield (event, data) pairs of Server-Sent Events lines."""
+    event, data = 'message', []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, json.loads('\n'.join(data))
+            event, data = 'message', []
+            continue
+        if line.startswith(':'):
+            continue
+        field, _, value = line.partition(':')
+        value = value[1:] if value.startswith(' ') else value
+        if field == 'event':
+            event = value
+        elif field == 'data':
+            data.append(value)
+
+
+class AlertListener:
+    """Thread which passes fired alerts to a callback.
+
+    The callback gets the alert dict: alert, chat_id, vehicle, stop,
+    path_id, distance, eta and passed.
+    """
+
+    def __init__(self, stream_url: str, token: str, callback):
+        """Create listener.
+
+        Args:
+            stream_url (str): The stream endpoint, e.g.
+        'http://host/api/stream/'.
+            token (str): ALERT_STREAM_TOKEN of the API.
+            callback: Function of the alert dict.
+        """
+        self.stream_url = stream_url
+        self.token = token
+        self.callback = callback
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Start listening in a daemon thread."""
+        self._thread = threading.Thread(target=self._run,
+                                        name='alert-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop listening, the thread ends with the next event or ping."""
+        self._stopped.set()
+
+    def _run(self) -> None:
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                with requests.get(self.stream_url, params={'alerts': 1},
+                                  headers={'Authorization':
+                                           f'Bearer {self.token}'},
+                                  stream=True,
+                                  timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+                                  ) as response:
+                    response.raise_for_status()
+                    failures = 0
+                    self._listen(response)
+            except (requests.RequestException, ValueError) as error:
+                logger.warning(f'Alert stream failed: {error}')
+            delay = RECONNECT_DELAYS[min(failures,
+                                         len(RECONNECT_DELAYS) - 1)]
+            failures += 1
+            self._stopped.wait(delay)
+
+    def _listen(self, response) -> None:
+        for event, alert in read_events(
+                response.iter_lines(decode_unicode=True)):
+            if self._stopped.is_set():
+                return
+            if event != 'alert':
+                continue
+            try:
+                self.callback(alert)
+            except Exception:
+                logger.exception('Failed to send alert.')
@@ -0,0 +1,225 @@
+"""Client of the bus_tj API used by the bot."""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT: tuple = (3.05, 10)
+DEFAULT_POOL_SIZE: int = 20
+DEFAULT_WORKERS: int = 8
+LATENCY_BUCKETS: tuple = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DEFAULT_CACHE_SIZE: int = 1000
+MISSING = object()
+# Seconds a response is reused: names of stops and buses rarely change,
+# distances are stale in a few seconds.
+DEFAULT_CACHE_TTLS: dict = {'stop': 300, 'bus': 300, 'location': 5}
+
+
+class EndpointMetrics:
+    """Latency histogram, error and cache hit counts of every endpoint."""
+
+    def __init__(self):
+        """Create empty metrics."""
+        self._endpoints: dict = {}
+        self._lock = threading.Lock()
+
+    def _stats(self, endpoint: str) -> dict:
+        return self._endpoints.setdefault(endpoint, {
+            'count': 0, 'errors': 0, 'hits': 0, 'total': 0.0, 'max': 0.0,
+            'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+        })
+
+    def observe(self, endpoint: str, seconds: float, error: bool) -> None:
+        """Record one call."""
+        with self._lock:
+            stats = self._stats(endpoint)
+            stats['count'] += 1
+            stats['errors'] += error
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            for number, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                number = len(LATENCY_BUCKETS)
+            stats['buckets'][number] += 1
+
+    def hit(self, endpoint: str) -> None:
+        """Record a call served from the cache or a call in flight."""
+        with self._lock:
+            self._stats(endpoint)['hits'] += 1
+
+    def snapshot(self) -> dict:
+        """Return {endpoint: stats} with count, errors, hits, mean, max, p95.
+
+        Count, mean, max and p95 are of calls sent to the API.
+        """
+        with self._lock:
+            endpoints = {name: dict(stats, buckets=list(stats['buckets']))
+                         for name, stats in self._endpoints.items()}
+        result = {}
+        for name, stats in endpoints.items():
+            seen = 0
+            p95 = None
+            for number, count in enumerate(stats['buckets']):
+                seen += count
+                if seen >= 0.95 * stats['count']:
+                    p95 = (LATENCY_BUCKETS[number]
+                           if number < len(LATENCY_BUCKETS) else stats['max'])
+                    break
+            result[name] = {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'hits': stats['hits'],
+                'mean': stats['total'] / max(stats['count'], 1),
+                'max': stats['max'],
+                'p95': p95,
+            }
+        return result
+
+
+class ApiClient:
+    """Pooled keep-alive client with strict timeouts.
+
+    Independent calls are sent concurrently from a thread pool, so a
+    screen which needs several resources waits for the slowest of them
+    only. Responses of the endpoints in ``cache_ttls`` are reused for the
+    endpoint's TTL, and identical calls made while one is in flight wait
+    for its response instead of calling the API again.
+    """
+
+    def __init__(self, base_url: str, timeout: tuple = DEFAULT_TIMEOUT,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 workers: int = DEFAULT_WORKERS, cache_ttls: dict = None,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        """Create client.
+
+        Args:
+            base_url (str): The API root, e.g. 'http://host/api/'.
+            timeout (tuple): Connect and read timeouts in seconds.
+            pool_size (int): Max keep-alive connections to the API.
+            workers (int): Threads for concurrent calls.
+            cache_ttls (dict): Seconds to reuse responses by endpoint,
+        DEFAULT_CACHE_TTLS by default, 0 disables the cache of an endpoint.
+            cache_size (int): Max responses cached per endpoint.
+        """
+        self.base_url = base_url.rstrip('/') + '/'
+        self.timeout = timeout
+        self.metrics = EndpointMetrics()
+        self.session = requests.Session()
+        retry = Retry(total=2, connect=2, read=0, backoff_factor=0.2,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=('GET',))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='api-client')
+        if cache_ttls is None:
+            cache_ttls = DEFAULT_CACHE_TTLS
+        self._caches = {endpoint: TTLCache(cache_size, ttl)
+                        for endpoint, ttl in cache_ttls.items() if ttl > 0}
+        self._in_flight: dict = {}
+        self._cache_lock = threading.Lock()
+
+    def get(self, endpoint: str, path: str = '', params: dict = None):
+        """GET endpoint/path and return decoded JSON.
+
+        The response may come from the cache and is shared, so it must not
+        be changed.
+
+        Raises:
+            requests.RequestException on network errors, timeouts and non
+        2xx responses.
+        """
+        key = (endpoint, path, tuple(sorted((params or {}).items())))
+        cache = self._caches.get(endpoint)
+        with self._cache_lock:
+            data = MISSING if cache is None else cache.get(key, MISSING)
+            if data is not MISSING:
+                self.metrics.hit(endpoint)
+                return data
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+            else:
+                self.metrics.hit(endpoint)
+        if not leader:
+            return future.result()
+        try:
+            data = self._fetch('get', endpoint, path, params=params)
+        except BaseException as error:
+            with self._cache_lock:
+                del self._in_flight[key]
+            future.set_exception(error)
+            raise
+        with self._cache_lock:
+            if cache is not None:
+                cache[key] = data
+            del self._in_flight[key]
+        future.set_result(data)
+        return data
+
+    def _fetch(self, method: str, endpoint: str, path: str, **kwargs):
+        started = time.perf_counter()
+        error = True
+        try:
+            response = self.session.request(
+                method, f'{self.base_url}{endpoint}/{path}',
+                timeout=self.timeout, **kwargs)
+            response.raise_for_status()
+            data = response.json() if response.content else None
+            error = False
+            return data
+        finally:
+            self.metrics.observe(endpoint, time.perf_counter() - started,
+                                 error)
+
+    def gather(self, *calls) -> list:
+        """Run (endpoint, path, params) calls concurrently.
+
+        Returns:
+            Results in the order of calls; the first error is raised.
+        """
+        futures = [self._executor.submit(self.get, *call) for call in calls]
+        return [future.result() for future in futures]
+
+    def near_stops(self, latitude: float, longitude: float) -> dict:
+        """Get stops near the point."""
+        return self.get('stop', params={'latitude': latitude,
+                                        'longitude': longitude})
+
+    def stop_buses(self, stop_id: int) -> dict:
+        """Get buses which pass the stop."""
+        return self.get('bus', params={'stop': stop_id})
+
+    def bus_data(self, bus_id: int, stop_id: int) -> tuple:
+        """Get (distance, bus, stop) of the bus and the stop at once."""
+        return tuple(self.gather(
+            ('location', '', {'bus': bus_id, 'stop': stop_id}),
+            ('bus', f'{bus_id}/', None),
+            ('stop', f'{stop_id}/', None),
+        ))
+
+    def subscribe_alert(self, chat_id: int, bus_id: int, stop_id: int,
+                        minutes: int = None, distance: float = None) -> dict:
+        """Ask the API to push an alert when the bus is close to the stop.
+
+        Raises:
+            requests.RequestException on network errors, timeouts and non
+        2xx responses.
+        """
+        return self._fetch('post', 'alert', '', json={
+            'chat_id': chat_id, 'bus': bus_id, 'stop': stop_id,
+            'minutes': minutes, 'distance': distance})
+
+    def close(self) -> None:
+        """Close connections and stop worker threads."""
+        self._executor.shutdown(wait=False)
+        self.session.close()
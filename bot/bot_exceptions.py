@@ -5,3 +5,9 @@ class TokenError(Exception):
     """Raises when token is None."""
 
     pass
+
+
+class SessionNotFound(KeyError):
+    """Raises when the chat has no session or it has expired."""
+
+    pass
@@ -0,0 +1,137 @@
+"""Update dispatching and webhook serving for the bot."""
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+DEFAULT_CHAT_WORKERS: int = 8
+DEFAULT_LANE_SIZE: int = 1000
+MAX_UPDATE_SIZE: int = 1024 * 1024
+
+
+class ChatOrderedDispatcher(Dispatcher):
+    """Dispatcher which handles different chats in parallel.
+
+    Every chat is pinned to one of ``chat_workers`` lanes by its id. A lane
+    is a queue with one thread, so updates of one chat are handled in the
+    order they came, while a slow chat holds up only its own lane.
+    Updates without a chat are handled by the dispatcher thread itself.
+    """
+
+    def __init__(self, *args, chat_workers: int = DEFAULT_CHAT_WORKERS,
+                 lane_size: int = DEFAULT_LANE_SIZE, **kwargs):
+        """Create dispatcher, other arguments go to Dispatcher."""
+        super().__init__(*args, **kwargs)
+        self.chat_workers = chat_workers
+        self._lanes = [Queue(lane_size) for _ in range(chat_workers)]
+        self._lane_threads = []
+
+    def start(self, ready: threading.Event = None) -> None:
+        """Start lane threads, then process the update queue."""
+        if not self._lane_threads:
+            for number, lane in enumerate(self._lanes):
+                thread = threading.Thread(
+                    target=self._run_lane, args=(lane,),
+                    name=f'chat-lane-{number}', daemon=True)
+                thread.start()
+                self._lane_threads.append(thread)
+        super().start(ready)
+
+    def stop(self) -> None:
+        """Stop reading updates and wait for lanes to finish."""
+        super().stop()
+        for lane in self._lanes:
+            lane.put(None)
+        for thread in self._lane_threads:
+            thread.join()
+        self._lane_threads = []
+
+    def process_update(self, update: object) -> None:
+        """Put update into the lane of its chat."""
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            super().process_update(update)
+            return
+        self._lanes[chat.id % self.chat_workers].put(update)
+
+    def _run_lane(self, lane: Queue) -> None:
+        while True:
+            update = lane.get()
+            if update is None:
+                break
+            try:
+                super().process_update(update)
+            except Exception:
+                logger.exception('Failed to process update.')
+
+
+class WebhookServer:
+    """HTTP listener which puts posted Telegram updates into a queue.
+
+    It needs no Telegram connection, so recorded update payloads can be
+    posted to it locally, e.g. with replay_updates.py.
+    """
+
+    def __init__(self, bot, update_queue: Queue, listen: str, port: int,
+                 path: str):
+        """Create server, call start() to listen."""
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path
+        self._httpd = ThreadingHTTPServer((listen, port),
+                                          self._handler_class())
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        """Return the port the server listens on."""
+        return self._httpd.server_address[1]
+
+    def _handler_class(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            """Accept updates posted to the webhook path."""
+
+            def do_POST(self):
+                """Decode update and queue it."""
+                if self.path != server.path:
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                if not 0 < length <= MAX_UPDATE_SIZE:
+                    self.send_error(400)
+                    return
+                try:
+                    data = json.loads(self.rfile.read(length))
+                    update = Update.de_json(data, server.bot)
+                except (ValueError, TypeError, KeyError):
+                    self.send_error(400)
+                    return
+                server.update_queue.put(update)
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                """Log requests to the module logger."""
+                logger.debug(format, *args)
+
+        return WebhookHandler
+
+    def start(self) -> None:
+        """Serve in a background thread."""
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop serving."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -1,23 +1,53 @@
 """Telegram bot script."""
 import logging
+import signal
+import threading
+from functools import wraps
 from logging.handlers import RotatingFileHandler
 from os import getenv
+from queue import Queue
 
 import requests
-from bot_exceptions import TokenError
+from alerts import AlertListener
+from api_client import ApiClient
+from bot_exceptions import SessionNotFound, TokenError
+from dispatching import ChatOrderedDispatcher, WebhookServer
+from media_cache import MediaCache, send_photo
+from sessions import SessionStore
 from dotenv import load_dotenv
-from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
+from telegram import (Bot, InlineKeyboardButton, InlineKeyboardMarkup,
                       KeyboardButton, ReplyKeyboardMarkup)
 from telegram.error import BadRequest
 from telegram.ext import (CallbackQueryHandler, CommandHandler, Filters,
-                          MessageHandler, Updater)
+                          JobQueue, MessageHandler, Updater)
+from telegram.utils.request import Request
 
 load_dotenv()
 
 TELEGRAM_TOKEN: str = getenv('TELEGRAM_BOT_TOKEN')
-LOCATION_DISTANCE_URL: str = 'http://bustj.pythonanywhere.com/api/location/'
-STOP_URL: str = 'http://bustj.pythonanywhere.com/api/stop/'
-BUSES_URL: str = 'http://bustj.pythonanywhere.com/api/bus/'
+API_URL: str = getenv('API_URL', 'http://bustj.pythonanywhere.com/api/')
+API_TIMEOUT: float = float(getenv('API_TIMEOUT', '10'))
+API_NAMES_TTL: int = int(getenv('API_NAMES_TTL', '300'))
+API_DISTANCE_TTL: int = int(getenv('API_DISTANCE_TTL', '5'))
+ALERT_STREAM_URL: str = getenv('ALERT_STREAM_URL',
+                               API_URL.rstrip('/') + '/stream/')
+ALERT_MINUTES: int = int(getenv('ALERT_MINUTES', '3'))
+ALERT_STREAM_TOKEN: str = getenv('ALERT_STREAM_TOKEN')
+METRICS_LOG_INTERVAL: int = 300
+LOGO_PATH: str = 'bot/logo.jpeg'
+MEDIA_CACHE_PATH: str = getenv('MEDIA_CACHE_PATH', 'bot/media_cache.json')
+SESSIONS_PATH: str = getenv('SESSIONS_PATH', 'bot/sessions.sqlite3')
+SESSION_TTL: int = int(getenv('SESSION_TTL', str(30 * 24 * 60 * 60)))
+SESSION_CACHE_SIZE: int = int(getenv('SESSION_CACHE_SIZE', '10000'))
+SESSION_PURGE_INTERVAL: int = 60 * 60
+BOT_MODE: str = getenv('BOT_MODE', 'polling')
+BOT_WORKERS: int = int(getenv('BOT_WORKERS', '4'))
+BOT_CHAT_WORKERS: int = int(getenv('BOT_CHAT_WORKERS', '8'))
+WEBHOOK_LISTEN: str = getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT: int = int(getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH: str = getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL: str = getenv('WEBHOOK_URL')
+STOP_SIGNALS: tuple = (signal.SIGINT, signal.SIGTERM, signal.SIGABRT)
 
 logger: logging.Logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -26,9 +56,15 @@ formater: logging.Formatter = logging.Formatter(
 handler: RotatingFileHandler = RotatingFileHandler(
     'my_looger.log', maxBytes=5000000, backupCount=5)
 handler.setFormatter(formater)
-logger.addHandler(logger)
+logger.addHandler(handler)
 
-users: dict = {}
+api: ApiClient = ApiClient(
+    API_URL, timeout=(3.05, API_TIMEOUT),
+    cache_ttls={'stop': API_NAMES_TTL, 'bus': API_NAMES_TTL,
+                'location': API_DISTANCE_TTL})
+media: MediaCache = MediaCache(MEDIA_CACHE_PATH)
+sessions: SessionStore = SessionStore(
+    SESSIONS_PATH, ttl=SESSION_TTL, cache_size=SESSION_CACHE_SIZE)
 
 
 def check_tokens() -> None:
@@ -39,6 +75,25 @@ def check_tokens() -> None:
         raise TokenError(message)
 
 
+def persist_session(callback):
+    """Save session of the chat after the handler has changed it."""
+    @wraps(callback)
+    def wrapper(update, context):
+        try:
+            return callback(update, context)
+        finally:
+            if update.effective_chat is not None:
+                sessions.flush(update.effective_chat.id)
+    return wrapper
+
+
+def purge_sessions(context):
+    """Remove expired sessions."""
+    removed = sessions.purge()
+    if removed:
+        logger.info(f'Removed {removed} expired sessions.')
+
+
 def send_error_message(update, context):
     """Send error message."""
     chat_id = update.effective_chat.id
@@ -47,33 +102,40 @@ def send_error_message(update, context):
         '❗️ Произошла ошибка ❗️ пожалуйста перезапустите бот 👉 /start')
 
 
-def edit_message_reply_markup(update, context, markup):
-    """Edit main message markup."""
-    try:
-        chat_id = update.effective_chat.id
-        message_id = users[f'{chat_id}']['main_message_id']
-        context.bot.edit_message_reply_markup(
-            chat_id, message_id,
-            reply_markup=markup
-        )
-    except BadRequest:
-        pass
-    except KeyError:
-        send_error_message(update, context)
-
+def send_main_message(update, context, caption, markup):
+    """Send logo with caption as the new main message.
 
-def edit_message_caption(update, context, text):
-    """Edit main message text."""
+    The logo is uploaded once, then it is sent by its cached file_id.
+    """
+    chat_id = update.effective_chat.id
+    message = send_photo(
+        context.bot, media, chat_id, LOGO_PATH,
+        caption=caption,
+        reply_markup=markup,
+        parse_mode='HTML')
+    session = sessions.get(chat_id)
+    if session.main_message_id is not None:
+        delete_message(update, context, session.main_message_id)
+    session.main_message_id = message.message_id
+
+
+def edit_main_message(update, context, caption, markup) -> bool:
+    """Edit caption and markup of the main message in one request.
+
+    Returns:
+        False if the main message can't be edited.
+    """
+    chat_id = update.effective_chat.id
+    message_id = sessions.get(chat_id).main_message_id
+    if message_id is None:
+        return False
     try:
-        chat_id = update.effective_chat.id
-        message_id = users[f'{chat_id}']['main_message_id']
         context.bot.edit_message_caption(
-            chat_id, message_id, caption=text
-        )
-    except BadRequest:
-        pass
-    except KeyError:
-        send_error_message(update, context)
+            chat_id, message_id,
+            caption=caption, reply_markup=markup, parse_mode='HTML')
+    except BadRequest as error:
+        return 'not modified' in str(error)
+    return True
 
 
 def delete_message(update, context, message_id):
@@ -85,11 +147,12 @@ def delete_message(update, context, message_id):
         pass
 
 
+@persist_session
 def start(update, context) -> None:
     """Register user and send stop decision."""
     try:
         chat_id = update.effective_chat.id
-        users[f'{chat_id}'] = {}
+        sessions.create(chat_id)
         send_stop_decisions(update, context)
         delete_message(update, context, update.message.message_id)
     except Exception:
@@ -99,7 +162,8 @@ def start(update, context) -> None:
 def send_stop_decisions(update, context) -> None:
     """Send decision: 4 near stops or input stop id."""
     chat_id = update.effective_chat.id
-    users[f'{chat_id}']['action'] = 'choose_way'
+    session = sessions.get(chat_id)
+    session.action = 'choose_way'
     """
     keyboard = [[InlineKeyboardButton(
         'Найти ближайшие', callback_data='choose'
@@ -110,45 +174,32 @@ def send_stop_decisions(update, context) -> None:
         'Найти ближайшие', request_location=True)]]
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True,
                                  one_time_keyboard=True)
-
-    with open('bot/logo.jpeg', 'rb') as photo:
-        message = context.bot.send_photo(
-            chat_id,
-            photo,
-            caption='Напишите id остановки',
-            reply_markup=markup,
-            parse_mode='HTML')
-        try:
-            delete_message(
-                update, context, users[f'{chat_id}']['main_message_id'])
-        except KeyError:
-            pass
-        users[f'{chat_id}']['main_message_id'] = message.message_id
+    # Reply keyboards can't be attached by editing, so it is sent anew.
+    send_main_message(update, context, 'Напишите id остановки', markup)
 
 
+@persist_session
 def station_by_location(update, context):
     """Delete location message."""
     delete_message(update, context, update.message.message_id)
     send_near_stations(update, context)
 
 
+@persist_session
 def send_near_stations(update, context):
     """Send near stations choose-buttons."""
     chat_id = update.effective_chat.id
-    users[f'{chat_id}']['action'] = 'choose_stop'
-    users[f'{chat_id}']['way'] = 'near'
+    session = sessions.get(chat_id)
+    session.action = 'choose_stop'
+    session.way = 'near'
     keyboard = [[]]
     try:
         location = update.message.location
-        users[f'{chat_id}']['latitude'] = location.latitude
-        users[f'{chat_id}']['longitude'] = location.longitude
-        params = {'latitude': location.latitude,
-                  'longitude': location.longitude}
-        data = requests.get(STOP_URL, params=params).json()
+        session.latitude = location.latitude
+        session.longitude = location.longitude
+        data = api.near_stops(location.latitude, location.longitude)
     except AttributeError:
-        params = {'latitude': users[f'{chat_id}']['latitude'],
-                  'longitude': users[f'{chat_id}']['longitude']}
-        data = requests.get(STOP_URL, params=params).json()
+        data = api.near_stops(session.latitude, session.longitude)
     for stop in data['stops']:
         keyboard.append([InlineKeyboardButton(
             f'{stop[1]} - {stop[0]}', callback_data=f'stop {stop[1]}'
@@ -156,24 +207,19 @@ def send_near_stations(update, context):
     keyboard.append([InlineKeyboardButton(
         '◀️ Назад', callback_data='back')])
     markup = InlineKeyboardMarkup(keyboard)
-    with open('bot/logo.jpeg', 'rb') as photo:
-        message = context.bot.send_photo(
-            chat_id,
-            photo,
-            caption='Напишите id остановки',
-            reply_markup=markup,
-            parse_mode='HTML')
-        delete_message(update, context, users[f'{chat_id}']['main_message_id'])
-        users[f'{chat_id}']['main_message_id'] = message.message_id
+    caption = 'Напишите id остановки'
+    if update.callback_query is None or not edit_main_message(
+            update, context, caption, markup):
+        send_main_message(update, context, caption, markup)
 
 
 def send_buses(update, context):
     """Send buses choose_buttons which pass the selected station."""
     chat_id = update.effective_chat.id
-    users[f'{chat_id}']['action'] = 'choose_buses'
+    session = sessions.get(chat_id)
+    session.action = 'choose_buses'
     keyboard = [[]]
-    params = {'stop': users[f'{chat_id}']['stop']}
-    data = requests.get(BUSES_URL, params=params).json()
+    data = api.stop_buses(session.stop)
     for bus in data['buses']:
         keyboard[0].append(InlineKeyboardButton(
             f'{bus[0]}', callback_data=f'bus {bus[1]}'
@@ -181,99 +227,200 @@ def send_buses(update, context):
     keyboard.append([InlineKeyboardButton(
         '◀️ Назад', callback_data='back')])
     markup = InlineKeyboardMarkup(keyboard)
-    if users[f'{chat_id}'].get('is_input', False):
-        with open('bot/logo.jpeg', 'rb') as photo:
-            message = context.bot.send_photo(
-                chat_id,
-                photo,
-                caption='Выберите нужный вам автобус',
-                reply_markup=markup,
-                parse_mode='HTML')
-        delete_message(update, context, users[f'{chat_id}']['main_message_id'])
-        users[f'{chat_id}']['main_message_id'] = message.message_id
-        users[f'{chat_id}']['is_input'] = False
-    else:
-        edit_message_caption(update, context, 'Выберите нужный вам автобус')
-        edit_message_reply_markup(update, context, markup)
+    caption = 'Выберите нужный вам автобус'
+    if session.is_input or not edit_main_message(
+            update, context, caption, markup):
+        send_main_message(update, context, caption, markup)
+        session.is_input = False
 
 
+@persist_session
 def stop_input(update, context):
     """Choose station by inputing id."""
     chat_id = update.effective_chat.id
+    session = sessions.get(chat_id)
     message = update.message.text
-    if users[f'{chat_id}']['action'] == 'choose_way':
+    if session.action == 'choose_way':
         try:
             id = int(message)
-            users[f'{chat_id}']['stop'] = id
+            session.stop = id
         except ValueError:
             pass
     delete_message(update, context, update.message.message_id)
-    users[f'{chat_id}']['is_input'] = True
-    users[f'{chat_id}']['way'] = 'input'
+    session.is_input = True
+    session.way = 'input'
     send_buses(update, context)
 
 
 def send_bus_data(update, context):
     """Send bus data."""
     chat_id = update.effective_chat.id
-    users[f'{chat_id}']['action'] = 'get_location'
+    session = sessions.get(chat_id)
+    session.action = 'get_location'
     keyboard = [
         [InlineKeyboardButton('Обновить', callback_data='update')],
         [InlineKeyboardButton('Заново', callback_data='again')],
         [InlineKeyboardButton('◀️ Назад', callback_data='back')]
     ]
+    if ALERT_STREAM_TOKEN:
+        # Without the stream alerts would never reach the chat.
+        keyboard.insert(1, [InlineKeyboardButton('Уведомить о прибытии',
+                                                 callback_data='alert')])
     markup = InlineKeyboardMarkup(keyboard)
-    bus_id = users[f'{chat_id}']['bus']
-    stop_id = users[f'{chat_id}']['stop']
-    params = {
-        'bus': bus_id,
-        'stop': stop_id}
-    data = requests.get(LOCATION_DISTANCE_URL, params=params).json()
-    bus = requests.get(BUSES_URL + f'{bus_id}/').json()
-    stop = requests.get(STOP_URL + f'{stop_id}/').json()
+    bus_id = session.bus
+    stop_id = session.stop
+    data, bus, stop = api.bus_data(bus_id, stop_id)
     distance = data['distance']
     message = (f'Остановка ({stop["id"]}): {stop["name"]}\nАвтобус:'
-               f' {bus["name"]}\nРастояние: {distance}м'
-               f'\nВремя прибытия: {round(distance/400)}мин')
-    edit_message_caption(update, context, message)
-    edit_message_reply_markup(update, context, markup)
+               f' {bus["name"]}')
+    if distance is None:
+        message += '\nАвтобус уже проехал остановку'
+    else:
+        eta = data.get('eta', round(distance/400))
+        message += f'\nРастояние: {distance}м\nВремя прибытия: {eta}мин'
+    if not edit_main_message(update, context, message, markup):
+        send_main_message(update, context, message, markup)
 
 
+@persist_session
 def back(update, context):
     """Go back to the previous action."""
     chat_id = update.effective_chat.id
-    action = users[f'{chat_id}']['action']
+    session = sessions.get(chat_id)
+    action = session.action
     if action == 'get_location':
         send_buses(update, context)
-    elif action == 'choose_buses' and users[f'{chat_id}']['way'] == 'input':
+    elif action == 'choose_buses' and session.way == 'input':
         send_stop_decisions(update, context)
-    elif action == 'choose_buses' and users[f'{chat_id}']['way'] == 'near':
+    elif action == 'choose_buses' and session.way == 'near':
         send_near_stations(update, context)
     elif action == 'choose_stop':
         send_stop_decisions(update, context)
 
 
+@persist_session
 def undefined_button_click(update, context):
     """Determine button's action and execute."""
     chat_id = update.effective_chat.id
+    session = sessions.get(chat_id)
     data: str = update.callback_query.data.split()
     if data[0] == 'stop':
-        users[f'{chat_id}']['stop'] = int(data[1])
+        session.stop = int(data[1])
         send_buses(update, context)
     elif data[0] == 'bus':
-        users[f'{chat_id}']['bus'] = int(data[1])
+        session.bus = int(data[1])
         send_bus_data(update, context)
     elif data[0] == 'update':
         send_bus_data(update, context)
+    elif data[0] == 'alert' and ALERT_STREAM_TOKEN:
+        subscribe_alert(update, context)
     elif data[0] == 'again':
-        users[f'{chat_id}']['stop'] = None
-        users[f'{chat_id}']['bus'] = None
+        session.stop = None
+        session.bus = None
         send_stop_decisions(update, context)
 
 
+def subscribe_alert(update, context):
+    """Ask the API to notify the chat when the bus is near the stop."""
+    chat_id = update.effective_chat.id
+    session = sessions.get(chat_id)
+    api.subscribe_alert(chat_id, session.bus, session.stop,
+                        minutes=ALERT_MINUTES)
+    update.callback_query.answer(
+        f'🔔 Сообщу, когда автобус будет в {ALERT_MINUTES} мин от '
+        f'остановки')
+
+
+def send_alert(bot, alert: dict) -> None:
+    """Tell the chat its bus is near the stop."""
+    bus, stop = api.gather(('bus', f'{alert["vehicle"]}/', None),
+                           ('stop', f'{alert["stop"]}/', None))
+    if alert['passed']:
+        text = (f'🚌 Автобус {bus["name"]} проехал остановку '
+                f'{stop["name"]}')
+    else:
+        text = (f'🚌 Автобус {bus["name"]} подъезжает к остановке '
+                f'{stop["name"]}\nРастояние: {alert["distance"]}м'
+                f'\nВремя прибытия: {alert["eta"]}мин')
+    bot.send_message(alert['chat_id'], text)
+
+
+def log_api_metrics(context):
+    """Log latency of the API endpoints."""
+    for endpoint, stats in api.metrics.snapshot().items():
+        logger.info(
+            f'API {endpoint}: {stats["count"]} calls, {stats["hits"]} cache '
+            f'hits, {stats["errors"]} errors, mean {stats["mean"]:.3f}s, '
+            f'p95 <= {stats["p95"]}s, max {stats["max"]:.3f}s')
+
+
+def error_handler(update, context):
+    """Log errors of handlers, tell the user if the API is unavailable."""
+    if isinstance(context.error, SessionNotFound) and update is not None and (
+            update.effective_chat is not None):
+        # The chat has no session, e.g. it has expired.
+        send_error_message(update, context)
+        return
+    if isinstance(context.error, requests.RequestException):
+        logger.error(f'API request failed: {context.error}')
+        if update is not None and update.effective_chat is not None:
+            context.bot.send_message(
+                update.effective_chat.id,
+                '⏳ Сервер не отвечает, попробуйте ещё раз позже')
+        return
+    logger.error('Неизвестная ошибка.', exc_info=context.error)
+
+
+def build_updater() -> Updater:
+    """Create updater with a chat-ordered dispatcher.
+
+    Updates of different chats are handled by BOT_CHAT_WORKERS threads in
+    parallel, updates of one chat are handled in order.
+    """
+    bot = Bot(TELEGRAM_TOKEN, request=Request(
+        con_pool_size=BOT_CHAT_WORKERS + BOT_WORKERS + 4))
+    job_queue = JobQueue()
+    dispatcher = ChatOrderedDispatcher(
+        bot, Queue(), workers=BOT_WORKERS, job_queue=job_queue,
+        chat_workers=BOT_CHAT_WORKERS)
+    job_queue.set_dispatcher(dispatcher)
+    return Updater(dispatcher=dispatcher, workers=None)
+
+
+def start_webhook(updater: Updater) -> WebhookServer:
+    """Serve updates posted to WEBHOOK_PATH.
+
+    Telegram is told about the webhook only if WEBHOOK_URL is set, so the
+    listener can be fed with recorded updates locally.
+    """
+    server = WebhookServer(updater.bot, updater.update_queue,
+                           WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+    updater.job_queue.start()
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher',
+                     daemon=True).start()
+    server.start()
+    if WEBHOOK_URL:
+        updater.bot.set_webhook(WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH)
+    logger.info(f'Webhook listens on {WEBHOOK_LISTEN}:{server.port}.')
+    return server
+
+
+def wait_for_stop_signal(stop_signals: tuple = STOP_SIGNALS) -> None:
+    """Block until one of the signals is received.
+
+    Updater.idle exits the process at once unless polling is running, so
+    the webhook mode waits here and shuts down by itself.
+    """
+    stopped = threading.Event()
+    for number in stop_signals:
+        signal.signal(number, lambda signum, frame: stopped.set())
+    while not stopped.wait(1):
+        pass
+
+
 def main():
     """Call to start the bot."""
-    updater: Updater = Updater(token=TELEGRAM_TOKEN)
+    updater: Updater = build_updater()
     try:
         updater.dispatcher.add_handler(
             CommandHandler('start', start))
@@ -288,10 +435,32 @@ def main():
             MessageHandler(Filters.location, station_by_location))
         updater.dispatcher.add_handler(
             MessageHandler(Filters.text, stop_input))
+        updater.dispatcher.add_error_handler(error_handler)
+        updater.job_queue.run_repeating(
+            log_api_metrics, interval=METRICS_LOG_INTERVAL)
+        updater.job_queue.run_repeating(
+            purge_sessions, interval=SESSION_PURGE_INTERVAL)
     except Exception:
         logger.exception('Неизвестная ошибка.')
-    updater.start_polling()
-    updater.idle()
+    alerts = AlertListener(
+        ALERT_STREAM_URL, ALERT_STREAM_TOKEN,
+        lambda alert: send_alert(updater.bot, alert))
+    if ALERT_STREAM_TOKEN:
+        alerts.start()
+    else:
+        logger.warning('ALERT_STREAM_TOKEN is not set, alerts are off.')
+    if BOT_MODE == 'webhook':
+        server = start_webhook(updater)
+        wait_for_stop_signal()
+        logger.info('Stopping the webhook.')
+        server.stop()
+        updater.stop()
+    else:
+        updater.start_polling()
+        updater.idle()
+    alerts.stop()
+    api.close()
+    sessions.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+"""Cache of Telegram file_ids of uploaded media."""
+import json
+import os
+import threading
+
+from telegram.error import BadRequest
+
+
+class MediaCache:
+    """Remember file_ids of uploaded files in a JSON file.
+
+    Telegram keeps every uploaded file and lets the bot send it again by
+    its file_id, so each asset is uploaded once. Entries are keyed by bot
+    id, file path, size and modification time, so a changed asset or
+    another bot token uploads the file again.
+    """
+
+    def __init__(self, path: str):
+        """Load cache from the path if it exists."""
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as file:
+                self._file_ids: dict = json.load(file)
+        except (OSError, ValueError):
+            self._file_ids = {}
+
+    @staticmethod
+    def _key(bot_id: int, asset: str) -> str:
+        stat = os.stat(asset)
+        return (f'{bot_id}:{os.path.abspath(asset)}:{stat.st_size}:'
+                f'{stat.st_mtime_ns}')
+
+    def get(self, bot_id: int, asset: str) -> str:
+        """Return file_id of the asset or None if it wasn't uploaded."""
+        return self._file_ids.get(self._key(bot_id, asset))
+
+    def set(self, bot_id: int, asset: str, file_id: str) -> None:
+        """Remember file_id of the asset and save the cache."""
+        with self._lock:
+            self._file_ids[self._key(bot_id, asset)] = file_id
+            self._save()
+
+    def forget(self, bot_id: int, asset: str) -> None:
+        """Drop file_id of the asset, e.g. when Telegram rejects it."""
+        with self._lock:
+            if self._file_ids.pop(self._key(bot_id, asset), None):
+                self._save()
+
+    def _save(self) -> None:
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(self._file_ids, file)
+        os.replace(temporary, self.path)
+
+
+def send_photo(bot, cache: MediaCache, chat_id: int, asset: str, **kwargs):
+    """Send the asset as photo, uploading it only if needed.
+
+    Returns:
+        The sent message.
+    """
+    file_id = cache.get(bot.id, asset)
+    if file_id is not None:
+        try:
+            return bot.send_photo(chat_id, file_id, **kwargs)
+        except BadRequest:
+            cache.forget(bot.id, asset)
+    with open(asset, 'rb') as photo:
+        message = bot.send_photo(chat_id, photo, **kwargs)
+    cache.set(bot.id, asset, message.photo[-1].file_id)
+    return message
@@ -0,0 +1,49 @@
+"""Post recorded Telegram updates to the bot webhook.
+
+Usage:
+    python bot/replay_updates.py http://127.0.0.1:8443/telegram updates.json
+
+A file holds one update, a JSON list of updates or one update per line.
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def read_updates(path: str) -> list:
+    """Read updates from the file."""
+    with open(path, encoding='utf-8') as file:
+        text = file.read()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line]
+    return data if isinstance(data, list) else [data]
+
+
+def main():
+    """Post updates and print throughput."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url', help='The webhook URL.')
+    parser.add_argument('files', nargs='+', help='Files with updates.')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Updates posted at once.')
+    args = parser.parse_args()
+    updates = [update for path in args.files for update in read_updates(path)]
+    session = requests.Session()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        statuses = list(executor.map(
+            lambda update: session.post(args.url, json=update,
+                                        timeout=10).status_code,
+            updates))
+    elapsed = time.perf_counter() - started
+    failed = sum(status != 200 for status in statuses)
+    print(f'{len(updates)} updates in {elapsed:.2f}s, {failed} failed')
+
+
+if __name__ == '__main__':
+    main()
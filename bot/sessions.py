@@ -0,0 +1,144 @@
+"""Persistent store of per-chat bot state."""
+import json
+import sqlite3
+import threading
+import time
+
+from bot_exceptions import SessionNotFound
+from cachetools import LRUCache
+
+DEFAULT_TTL: int = 30 * 24 * 60 * 60
+DEFAULT_CACHE_SIZE: int = 10000
+
+
+class Session:
+    """State of one chat.
+
+    Attributes:
+    chat_id (int): The id of the chat.
+    action (str): The current screen.
+    way (str): How the stop was chosen, 'near' or 'input'.
+    stop (int): The chosen stop.
+    bus (int): The chosen bus.
+    latitude (float): The last location sent by the user.
+    longitude (float): The last location sent by the user.
+    main_message_id (int): The message the bot edits.
+    is_input (bool): Whether the user has just typed something.
+    updated (float): Unix time of the last save.
+    """
+
+    __slots__ = ('chat_id', 'action', 'way', 'stop', 'bus', 'latitude',
+                 'longitude', 'main_message_id', 'is_input', 'updated')
+    FIELDS: tuple = __slots__[1:-1]
+
+    def __init__(self, chat_id: int, *values, updated: float = None):
+        """Create session, values follow Session.FIELDS."""
+        self.chat_id = chat_id
+        values = values or (None,) * len(self.FIELDS)
+        for field, value in zip(self.FIELDS, values):
+            setattr(self, field, value)
+        self.is_input = bool(self.is_input)
+        self.updated = time.time() if updated is None else updated
+
+    def dump(self) -> str:
+        """Encode fields as a compact JSON array."""
+        return json.dumps([getattr(self, field) for field in self.FIELDS],
+                          separators=(',', ':'))
+
+
+class SessionStore:
+    """Sessions in SQLite behind a bounded LRU cache.
+
+    The database is in WAL mode, so it can be read while the bot writes
+    and other processes can inspect it. The cache in front of it belongs
+    to one process, so a chat must be served by one process at a time.
+    Sessions not saved for ``ttl`` seconds are treated as missing and
+    removed by ``purge``.
+    """
+
+    def __init__(self, path: str, ttl: int = DEFAULT_TTL,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        """Open or create the database.
+
+        Args:
+            path (str): The SQLite file.
+            ttl (int): Seconds a session lives without updates.
+            cache_size (int): Sessions kept in memory.
+        """
+        self.ttl = ttl
+        self._cache = LRUCache(cache_size)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS session ('
+            'chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, '
+            'updated REAL NOT NULL)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS session_updated ON session(updated)')
+
+    def create(self, chat_id: int) -> Session:
+        """Start a new empty session of the chat and save it."""
+        session = Session(chat_id)
+        self.save(session)
+        return session
+
+    def get(self, chat_id: int) -> Session:
+        """Return session of the chat.
+
+        Raises:
+            SessionNotFound if the chat has no session or it has expired.
+        """
+        with self._lock:
+            session = self._cache.get(chat_id)
+            if session is None:
+                row = self._db.execute(
+                    'SELECT data, updated FROM session WHERE chat_id = ?',
+                    (chat_id,)).fetchone()
+                if row is None:
+                    raise SessionNotFound(chat_id)
+                session = Session(chat_id, *json.loads(row[0]),
+                                  updated=row[1])
+                self._cache[chat_id] = session
+            if session.updated < time.time() - self.ttl:
+                self.delete(chat_id)
+                raise SessionNotFound(chat_id)
+            return session
+
+    def save(self, session: Session) -> None:
+        """Write session to the cache and the database."""
+        session.updated = time.time()
+        with self._lock:
+            self._cache[session.chat_id] = session
+            self._db.execute(
+                'INSERT OR REPLACE INTO session (chat_id, data, updated) '
+                'VALUES (?, ?, ?)',
+                (session.chat_id, session.dump(), session.updated))
+
+    def flush(self, chat_id: int) -> None:
+        """Save the cached session of the chat if there is one."""
+        with self._lock:
+            session = self._cache.get(chat_id)
+            if session is not None:
+                self.save(session)
+
+    def delete(self, chat_id: int) -> None:
+        """Remove session of the chat."""
+        with self._lock:
+            self._cache.pop(chat_id, None)
+            self._db.execute('DELETE FROM session WHERE chat_id = ?',
+                             (chat_id,))
+
+    def purge(self) -> int:
+        """Remove expired sessions and return how many were removed."""
+        with self._lock:
+            return self._db.execute(
+                'DELETE FROM session WHERE updated < ?',
+                (time.time() - self.ttl,)).rowcount
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._db.close()
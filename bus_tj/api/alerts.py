@@ -0,0 +1,269 @@
+"""Proximity alerts evaluated as buses move.
+
+A chat asks to be told when a bus is a number of meters or minutes away
+from a stop. Alerts are stored in ProximityAlert and indexed in the memory
+of the process by route: alerts of a route are sorted by the offsets of
+their stops, so a moved bus checks only the alerts of its route between
+its previous position and its furthest threshold ahead. An alert fires
+once: it is published to the alerts topic, which the bot reads from the
+stream endpoint, and deleted. An alert nobody received stays and is
+published again on a fix ALERT_RETRY_INTERVAL seconds later.
+
+Every worker reloads its index when the alerts in the database change,
+which it checks at most every ALERT_CHECK_INTERVAL seconds. Alerts older
+than ALERT_TTL seconds are dropped on reload.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from tracker.models import BusStop, Path, ProximityAlert, StopOffset
+from .arrivals import estimate_eta
+from .geometry import get_route_geometry
+from .offsets import stop_offset
+from .pubsub import get_broker
+
+logger = logging.getLogger(__name__)
+
+ALERTS_TOPIC = 'alerts'
+DEFAULT_ALERT_TTL = 2 * 60 * 60
+DEFAULT_CHECK_INTERVAL = 1
+DEFAULT_RETRY_INTERVAL = 30
+
+
+class Move(NamedTuple):
+    """New position of a bus.
+
+    Attributes:
+    vehicle_id (int): PrimaryKey of the bus.
+    path_id (int): The route of the bus.
+    distance (float): The distance from the route start.
+    speed (float): The speed of the bus in meters per minute.
+    """
+
+    vehicle_id: int
+    path_id: int
+    distance: float
+    speed: float
+
+
+class RouteAlerts:
+    """Alerts on one route sorted by the offsets of their stops.
+
+    Attributes:
+    offsets (ndarray): The distances of the stops from the route start.
+    vehicle_ids (ndarray): The buses of the alerts.
+    meters (ndarray): Distance thresholds, NaN if not set.
+    minutes (ndarray): Time thresholds, NaN if not set.
+    alerts (list): (alert id, chat id, vehicle id, stop id) of every alert.
+    """
+
+    def __init__(self, rows: list):
+        """Create index of alert rows.
+
+        Args:
+            rows (list): (offset, alert id, chat id, vehicle id, stop id,
+        meters, minutes) of every alert.
+        """
+        rows = sorted(rows, key=lambda row: row[0])
+        self.offsets = np.array([row[0] for row in rows], dtype=float)
+        self.vehicle_ids = np.array([row[3] for row in rows], dtype=np.int64)
+        self.meters = np.array([row[5] for row in rows], dtype=float)
+        self.minutes = np.array([row[6] for row in rows], dtype=float)
+        self.alerts = [row[1:5] for row in rows]
+        self._max_meters = float(np.nan_to_num(self.meters).max())
+        self._max_minutes = float(np.nan_to_num(self.minutes).max())
+
+    def reach(self, speed: float) -> float:
+        """Return the furthest distance ahead at which an alert may fire."""
+        return max(self._max_meters, self._max_minutes * speed)
+
+    def between(self, route, start: float, length: float) -> np.ndarray:
+        """Return positions of alerts up to length meters ahead of start.
+
+        On a circular route the range goes past the route start.
+        """
+        end = start + length
+        first = np.searchsorted(self.offsets, start, side='left')
+        last = np.searchsorted(self.offsets, end, side='right')
+        found = np.arange(first, last)
+        if route.circular and end >= route.period:
+            wrapped = np.searchsorted(self.offsets, end - route.period,
+                                      side='right')
+            found = np.concatenate((np.arange(min(wrapped, first)), found))
+        return found
+
+
+class AlertRegistry:
+    """Alerts of the process indexed by route."""
+
+    def __init__(self):
+        """Create empty registry, alerts are loaded on first use."""
+        self._routes = None
+        self._version = None
+        self._checked = 0.0
+        self._positions = {}
+        self._retries = {}
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        ttl = getattr(settings, 'ALERT_TTL', DEFAULT_ALERT_TTL)
+        ProximityAlert.objects.filter(
+            created__lt=timezone.now() - timedelta(seconds=ttl)).delete()
+        version = self._stored_version()
+        alerts = list(ProximityAlert.objects.values_list(
+            'id', 'chat_id', 'vehicle_id', 'vehicle__path_id', 'stop_id',
+            'distance', 'minutes'))
+        offsets = dict(((stop_id, path_id), distance) for
+                       stop_id, path_id, distance in
+                       StopOffset.objects.filter(
+                           stop_id__in={alert[4] for alert in alerts}
+                       ).values_list('stop_id', 'path_id', 'distance'))
+        rows = {}
+        for (alert_id, chat_id, vehicle_id, path_id, stop_id, meters,
+             minutes) in alerts:
+            offset = offsets.get((stop_id, path_id))
+            if offset is None:
+                try:
+                    offset = stop_offset(stop_id, path_id)
+                except (BusStop.DoesNotExist, Path.DoesNotExist):
+                    continue
+            rows.setdefault(path_id, []).append(
+                (offset, alert_id, chat_id, vehicle_id, stop_id,
+                 np.nan if meters is None else meters,
+                 np.nan if minutes is None else minutes))
+        self._version = version
+        self._routes = {path_id: RouteAlerts(route_rows)
+                        for path_id, route_rows in rows.items()}
+        watched = {alert[2] for alert in alerts}
+        self._positions = {vehicle_id: distance for vehicle_id, distance in
+                           self._positions.items() if vehicle_id in watched}
+        stored = {alert[0] for alert in alerts}
+        self._retries = {alert_id: retry for alert_id, retry in
+                         self._retries.items() if alert_id in stored}
+        return self._routes
+
+    @staticmethod
+    def _stored_version() -> tuple:
+        """Return a value which changes whenever stored alerts change.
+
+        A replaced alert keeps its id but gets a new creation time.
+        """
+        stored = ProximityAlert.objects.aggregate(
+            last_id=Max('id'), count=Count('id'), last_created=Max('created'))
+        return stored['last_id'], stored['count'], stored['last_created']
+
+    def _loaded(self) -> dict:
+        if self._routes is None:
+            return self._load()
+        now = time.monotonic()
+        if now - self._checked >= getattr(settings, 'ALERT_CHECK_INTERVAL',
+                                          DEFAULT_CHECK_INTERVAL):
+            self._checked = now
+            if self._stored_version() != self._version:
+                return self._load()
+        return self._routes
+
+    def reset(self) -> None:
+        """Reload alerts on next use, e.g. when routes or stops change."""
+        self._routes = None
+
+    def check(self, moves: list) -> list:
+        """Fire alerts of the moved buses which came close to their stops.
+
+        A stop the bus drove past since its previous fix fires too, so an
+        alert isn't missed between two fixes.
+
+        Args:
+            moves (list): Move of every bus.
+
+        Returns:
+            Messages of the fired alerts, they are published to the alerts
+        topic. An alert which can't be published, or reaches nobody, is
+        kept and fires on a fix ALERT_RETRY_INTERVAL seconds later.
+        """
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            routes = self._loaded()
+            for move in moves:
+                alerts = routes.get(move.path_id)
+                if alerts is None:
+                    continue
+                due.extend(message for message in self._due(alerts, move)
+                           if self._retries.get(message['alert'], 0) <= now)
+        if not due:
+            return []
+        ttl = getattr(settings, 'ALERT_TTL', DEFAULT_ALERT_TTL)
+        retry = getattr(settings, 'ALERT_RETRY_INTERVAL',
+                        DEFAULT_RETRY_INTERVAL)
+        fired = []
+        broker = get_broker()
+        for message in due:
+            alert_id = message['alert']
+            alert = ProximityAlert.objects.filter(pk=alert_id)
+            # Another worker may have fired the alert since its load, the
+            # one which marks it publishes it. Expired alerts don't fire.
+            if not alert.filter(
+                    fired=False,
+                    created__gte=timezone.now() - timedelta(seconds=ttl),
+            ).update(fired=True):
+                continue
+            try:
+                receivers = broker.publish(ALERTS_TOPIC, message)
+            except Exception:
+                logger.exception(f'Failed to publish alert {alert_id}.')
+                receivers = 0
+            if receivers == 0:
+                alert.update(fired=False)
+                self._retries[alert_id] = now + retry
+                continue
+            alert.delete()
+            fired.append(message)
+        return fired
+
+    def _due(self, alerts: RouteAlerts, move: Move) -> list:
+        route = get_route_geometry(move.path_id)
+        previous = self._positions.get(move.vehicle_id)
+        self._positions[move.vehicle_id] = move.distance
+        driven = None
+        if previous is not None:
+            driven = route.progress(previous, move.distance)
+        if driven is None:
+            previous, driven = move.distance, 0.0
+        found = alerts.between(route, previous,
+                               driven + alerts.reach(move.speed))
+        found = found[alerts.vehicle_ids[found] == move.vehicle_id]
+        if not len(found):
+            return []
+        offsets = alerts.offsets[found]
+        passed = route.forward(previous, offsets) <= driven
+        left = np.where(passed, 0.0, route.forward(move.distance, offsets))
+        hit = passed | (left <= alerts.meters[found]) | (
+            left / move.speed <= alerts.minutes[found])
+        due = []
+        for position, distance, was_passed in zip(found[hit].tolist(),
+                                                  left[hit].tolist(),
+                                                  passed[hit].tolist()):
+            alert_id, chat_id, vehicle_id, stop_id = alerts.alerts[position]
+            due.append({
+                'alert': alert_id,
+                'chat_id': chat_id,
+                'vehicle': vehicle_id,
+                'stop': stop_id,
+                'path_id': move.path_id,
+                'distance': round(distance),
+                'eta': estimate_eta(distance, move.speed),
+                'passed': was_passed,
+            })
+        return due
+
+
+alert_registry = AlertRegistry()
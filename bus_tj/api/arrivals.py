@@ -0,0 +1,306 @@
+"""Distances and arrival times of buses to stops."""
+import logging
+import threading
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+
+from tracker.models import BusStop
+from .exceptions import ObjectDoesNotExistError
+from .geometry import get_route_geometry
+from .live import live_state
+from .metrics import hot_section
+from .network import network_version
+from .pubsub import get_broker
+
+logger = logging.getLogger(__name__)
+
+# The bot has always assumed buses do 400 meters a minute.
+DEFAULT_BUS_SPEED = 400
+# Weight of the newest speed sample in the moving average.
+SPEED_SMOOTHING = 0.3
+MIN_BUS_SPEED = 50
+MAX_BUS_SPEED = 1500
+
+
+def bus_speed() -> float:
+    """Return average bus speed in meters per minute."""
+    return getattr(settings, 'BUS_AVERAGE_SPEED', DEFAULT_BUS_SPEED)
+
+
+def vehicle_topic(vehicle_id: int) -> str:
+    """Return topic of arrival updates of the bus."""
+    return f'vehicle:{vehicle_id}'
+
+
+def route_topic(path_id: int) -> str:
+    """Return topic of arrival updates of all buses of the route."""
+    return f'route:{path_id}'
+
+
+def estimate_eta(distance: float, speed: float = None) -> int:
+    """Return minutes needed to drive the distance."""
+    return round(distance / (speed or bus_speed()))
+
+
+def route_distance(path_id: int, location_id: int, latitude: float,
+                   longitude: float) -> float:
+    """Return distance of a point along the route from its start.
+
+    Points of the route are looked up directly, other points are snapped
+    onto the route.
+
+    Returns:
+        Distance in meters or None if the route has no points.
+    """
+    route = get_route_geometry(path_id)
+    if not len(route):
+        return None
+    distance = route.distance_of(location_id)
+    if distance is None and latitude is not None and longitude is not None:
+        distance = route.index.snap(latitude, longitude).distance
+    return distance
+
+
+class Arrival(NamedTuple):
+    """Arrival of a bus to a stop.
+
+    Attributes:
+    distance (float): Distance left to the stop along the route in meters.
+    eta (int): Minutes left to the stop.
+    updated (datetime): The time of the fix the arrival was computed from.
+    """
+
+    distance: float
+    eta: int
+    updated: datetime
+
+
+class RouteStops(NamedTuple):
+    """Stops of a route sorted by their distance from the route start."""
+
+    route: object
+    distances: np.ndarray
+    stop_ids: np.ndarray
+
+
+def load_route_stops(path_id: int) -> RouteStops:
+    """Find stops served by the buses of the route and place them on it."""
+    route = get_route_geometry(path_id)
+    stops = (BusStop.objects
+             .filter(buses__path_id=path_id)
+             .distinct()
+             .values_list('id', 'location_id', 'location__latitude',
+                          'location__longitude'))
+    placed = []
+    if len(route):
+        for stop_id, location_id, latitude, longitude in stops:
+            placed.append((route_distance(path_id, location_id, latitude,
+                                          longitude), stop_id))
+    placed.sort()
+    return RouteStops(
+        route,
+        np.array([distance for distance, _ in placed], dtype=float),
+        np.array([stop_id for _, stop_id in placed], dtype=np.int64),
+    )
+
+
+class ArrivalTable:
+    """Arrivals of buses to stops keyed by (stop_id, vehicle_id).
+
+    The table is updated when a bus moves, and only the stops ahead of the
+    bus on its route are touched, on a circular route every stop is ahead.
+    Speed of every bus is an exponential moving average of its recent
+    progress along the route.
+    """
+
+    def __init__(self):
+        """Create empty table."""
+        self._arrivals = {}
+        self._stop_buses = {}
+        self._bus_stops = {}
+        self._motion = {}
+        self._route_stops = {}
+        self._lock = threading.Lock()
+
+    def route_stops(self, path_id: int) -> RouteStops:
+        """Return stops of the route, reloading them if geometry changed."""
+        network_version.check()
+        route_stops = self._route_stops.get(path_id)
+        if (route_stops is None
+                or route_stops.route is not get_route_geometry(path_id)):
+            route_stops = load_route_stops(path_id)
+            self._route_stops[path_id] = route_stops
+        return route_stops
+
+    def invalidate_stops(self) -> None:
+        """Forget stops of every route, e.g. when a stop changed."""
+        self._route_stops = {}
+
+    def speed(self, vehicle_id: int) -> float:
+        """Return smoothed speed of the bus in meters per minute."""
+        motion = self._motion.get(vehicle_id)
+        return motion[2] if motion is not None else bus_speed()
+
+    def _smooth_speed(self, vehicle_id: int, route, distance: float,
+                      timestamp: datetime) -> float:
+        previous = self._motion.get(vehicle_id)
+        if previous is None:
+            speed = bus_speed()
+        else:
+            last_distance, last_timestamp, speed = previous
+            minutes = (timestamp - last_timestamp).total_seconds() / 60
+            driven = route.progress(last_distance, distance)
+            if minutes > 0 and driven is not None:
+                sample = driven / minutes
+                sample = min(max(sample, MIN_BUS_SPEED), MAX_BUS_SPEED)
+                speed += SPEED_SMOOTHING * (sample - speed)
+            elif minutes <= 0:
+                return speed
+        self._motion[vehicle_id] = (distance, timestamp, speed)
+        return speed
+
+    @hot_section('arrival_update')
+    def update(self, vehicle_id: int, path_id: int, distance: float,
+               timestamp: datetime) -> None:
+        """Move the bus and recompute arrivals to the stops ahead of it.
+
+        Changed arrivals and passed stops are published to the vehicle and
+        route topics. Errors of the broker are logged, they never fail the
+        update.
+
+        Args:
+            vehicle_id (int): PrimaryKey of the bus.
+            path_id (int): The route of the bus.
+            distance (float): Distance of the bus from the route start.
+            timestamp (datetime): The time of the fix.
+        """
+        route_stops = self.route_stops(path_id)
+        left = route_stops.route.forward(distance, route_stops.distances)
+        ahead = ~np.isnan(left)
+        stop_ids = route_stops.stop_ids[ahead].tolist()
+        left = left[ahead].tolist()
+        changed = []
+        with self._lock:
+            speed = self._smooth_speed(vehicle_id, route_stops.route,
+                                       distance, timestamp)
+            passed = self._bus_stops.get(vehicle_id, set()) - set(stop_ids)
+            for stop_id in passed:
+                self._arrivals.pop((stop_id, vehicle_id), None)
+                self._stop_buses.get(stop_id, set()).discard(vehicle_id)
+            for stop_id, stop_distance in zip(stop_ids, left):
+                arrival = Arrival(stop_distance,
+                                  estimate_eta(stop_distance, speed),
+                                  timestamp)
+                previous = self._arrivals.get((stop_id, vehicle_id))
+                if (previous is None or previous.eta != arrival.eta
+                        or round(previous.distance) != round(stop_distance)):
+                    changed.append([stop_id, round(stop_distance),
+                                    arrival.eta])
+                self._arrivals[(stop_id, vehicle_id)] = arrival
+                self._stop_buses.setdefault(stop_id, set()).add(vehicle_id)
+            self._bus_stops[vehicle_id] = set(stop_ids)
+        message = {
+            'vehicle': vehicle_id,
+            'path_id': path_id,
+            'distance': round(distance),
+            'timestamp': timestamp.isoformat(),
+            'arrivals': changed,
+            'passed': sorted(passed),
+        }
+        broker = get_broker()
+        try:
+            broker.publish(vehicle_topic(vehicle_id), message)
+            broker.publish(route_topic(path_id), message)
+        except Exception:
+            logger.exception(f'Failed to publish bus {vehicle_id}.')
+
+    def forget(self, vehicle_id: int) -> None:
+        """Drop every arrival of the bus."""
+        with self._lock:
+            for stop_id in self._bus_stops.pop(vehicle_id, ()):
+                self._arrivals.pop((stop_id, vehicle_id), None)
+                self._stop_buses.get(stop_id, set()).discard(vehicle_id)
+            self._motion.pop(vehicle_id, None)
+
+    def get(self, stop_id: int, vehicle_id: int) -> Arrival:
+        """Return arrival of the bus to the stop or None."""
+        return self._arrivals.get((stop_id, vehicle_id))
+
+    def for_stop(self, stop_id: int) -> dict:
+        """Return {vehicle_id: Arrival} of buses heading to the stop."""
+        with self._lock:
+            return {vehicle_id: self._arrivals[(stop_id, vehicle_id)]
+                    for vehicle_id in self._stop_buses.get(stop_id, ())}
+
+
+arrival_table = ArrivalTable()
+network_version.connect(arrival_table.invalidate_stops)
+
+
+def departure_board(stop_id: int) -> dict:
+    """Get distance and ETA of every bus which passes the stop.
+
+    Takes two queries, one for the stop and one for its buses; route
+    geometry comes from the route cache and bus positions from the live
+    state. Distances of the buses of one route are computed at once.
+
+    Raises:
+        ObjectDoesNotExistError if the stop doesn't exist.
+
+    Returns:
+        Dict with the stop and its arrivals sorted by ETA. Buses which have
+    passed the stop of a linear route or have no location come last with
+    None distance.
+    """
+    stop = (BusStop.objects
+            .filter(pk=stop_id)
+            .values('id', 'name', 'location_id', 'location__latitude',
+                    'location__longitude')
+            .first())
+    if stop is None:
+        raise ObjectDoesNotExistError('BusStop object does not exist.')
+    buses = (BusStop.buses.through.objects
+             .filter(busstop_id=stop_id)
+             .values_list('vehicle_id', 'vehicle__name', 'vehicle__path_id',
+                          'vehicle__location_id',
+                          'vehicle__location__latitude',
+                          'vehicle__location__longitude'))
+    routes = {}
+    for bus in buses:
+        routes.setdefault(bus[2], []).append(bus)
+    arrivals = []
+    for path_id, route_buses in routes.items():
+        stop_distance = route_distance(
+            path_id, stop['location_id'], stop['location__latitude'],
+            stop['location__longitude'])
+        positions = []
+        for bus_id, _, _, location_id, latitude, longitude in route_buses:
+            live = live_state.get(bus_id)
+            if live is not None and live.path_id == path_id and (
+                    live.distance is not None):
+                positions.append(live.distance)
+            elif location_id is not None and stop_distance is not None:
+                positions.append(route_distance(path_id, location_id,
+                                                latitude, longitude))
+            else:
+                positions.append(None)
+        left = np.full(len(route_buses), np.nan)
+        if stop_distance is not None:
+            left = get_route_geometry(path_id).forward(
+                np.array(positions, dtype=float), stop_distance)
+        for (bus_id, name, *_), distance in zip(route_buses, left.tolist()):
+            known = distance == distance
+            arrivals.append({
+                'bus': bus_id,
+                'name': name,
+                'distance': round(distance) if known else None,
+                'eta': (estimate_eta(distance, arrival_table.speed(bus_id))
+                        if known else None),
+            })
+    arrivals.sort(key=lambda item: (item['eta'] is None, item['eta'] or 0,
+                                    item['distance'] or 0))
+    return {'stop': {'id': stop['id'], 'name': stop['name']},
+            'arrivals': arrivals}
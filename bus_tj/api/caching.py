@@ -0,0 +1,104 @@
+"""Response cache of read endpoints with conditional GET.
+
+Cached data is grouped into namespaces, e.g. 'stops' and 'buses'. Every
+namespace has a version in the cache which signals bump when its models
+change. The ETag of a response is derived from the versions of the
+namespaces it depends on and the request, so a client with a fresh ETag
+gets 304 before anything is read or serialized, and entries of older
+versions are never read again and expire by the timeout.
+
+Versions expire by the timeout too. A process which doesn't share the
+cache, e.g. with the locmem backend, never sees bumps of other processes,
+but it starts a new version once the old one expires.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+DEFAULT_TIMEOUT = 300
+KEY_PREFIX = 'api:'
+
+
+def get_cache():
+    """Return the cache backend named by the API_CACHE setting."""
+    return caches[getattr(settings, 'API_CACHE', 'default')]
+
+
+def cache_timeout() -> int:
+    """Return seconds a response is kept, the API_CACHE_TIMEOUT setting."""
+    return getattr(settings, 'API_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def _version_key(namespace: str) -> str:
+    return f'{KEY_PREFIX}version:{namespace}'
+
+
+def _new_version() -> int:
+    # A version lost to eviction must not come back as a value which was
+    # already used, so versions start from the clock.
+    return time.time_ns() // 1000
+
+
+def get_versions(namespaces: tuple) -> tuple:
+    """Return current versions of the namespaces."""
+    cache = get_cache()
+    keys = [_version_key(namespace) for namespace in namespaces]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, _new_version(), cache_timeout())
+            versions[key] = cache.get(key)
+    return tuple(versions[key] for key in keys)
+
+
+def bump_version(namespace: str) -> None:
+    """Make cached responses of the namespace stale."""
+    cache = get_cache()
+    try:
+        cache.incr(_version_key(namespace))
+    except ValueError:
+        cache.set(_version_key(namespace), _new_version(), cache_timeout())
+
+
+def request_key(request) -> str:
+    """Return path with sorted query params of the request."""
+    params = sorted(request.GET.lists())
+    return f'{request.path}?{params}'
+
+
+def cached_response(*namespaces: str):
+    """Cache successful responses of a viewset method.
+
+    Args:
+        namespaces (str): Namespaces the response depends on.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            versions = get_versions(namespaces)
+            etag = '"{}"'.format(hashlib.md5(
+                f'{versions}:{request_key(request)}'.encode()).hexdigest())
+            if_none_match = request.headers.get('If-None-Match')
+            if if_none_match and (
+                    etag in parse_etags(if_none_match)
+                    or if_none_match.strip() == '*'):
+                return Response(status=status.HTTP_304_NOT_MODIFIED,
+                                headers={'ETag': etag})
+            cache = get_cache()
+            key = f'{KEY_PREFIX}response:{etag}'
+            data = cache.get(key)
+            if data is not None:
+                return Response(data, headers={'ETag': etag})
+            response = method(self, request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, cache_timeout())
+                response['ETag'] = etag
+            return response
+        return wrapper
+    return decorator
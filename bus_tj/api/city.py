@@ -0,0 +1,138 @@
+"""Synthetic city networks for benchmarks and local development."""
+import math
+
+import numpy as np
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Max
+
+from tracker.models import BusStop, Location, Path, Vehicle
+from .distance import METERS_PER_DEGREE
+from .signals import invalidate_network
+
+CENTER = (38.56, 68.78)
+DEFAULT_SPACING = 100
+CITY_RADIUS = 10000
+MAX_TURN = math.radians(30)
+
+
+def bulk_create_ids(model, objects: list) -> list:
+    """Create rows of the model and return their ids in order.
+
+    Backends which return ids from bulk inserts set them on the objects.
+    On others the rows past the last id before the insert are matched to
+    the objects by their values in id order, so rows another writer
+    inserts meanwhile are skipped. Rows with equal values are equal.
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objects, batch_size=1000)
+        return [item.pk for item in objects]
+    fields = [field.attname for field in model._meta.concrete_fields
+              if not field.primary_key]
+    rows = [tuple(getattr(item, name) for name in fields)
+            for item in objects]
+    last_id = model.objects.aggregate(last=Max('id'))['last'] or 0
+    model.objects.bulk_create(objects, batch_size=1000)
+    pks = []
+    for pk, *values in model.objects.filter(id__gt=last_id).order_by(
+            'id').values_list('id', *fields).iterator():
+        if len(pks) < len(rows) and tuple(values) == rows[len(pks)]:
+            pks.append(pk)
+    if len(pks) != len(rows):
+        raise DatabaseError(f'{len(rows) - len(pks)} new {model.__name__} '
+                            f'rows not found.')
+    return pks
+
+
+def create_locations(points: np.ndarray) -> list:
+    """Create locations of (lat, lon) rows and return their ids in order."""
+    return bulk_create_ids(Location, [
+        Location(latitude=latitude, longitude=longitude)
+        for latitude, longitude in points.tolist()])
+
+
+def _route_points(rng: np.random.Generator, points: int,
+                  spacing: float) -> np.ndarray:
+    """Random walk of points spacing meters apart inside the city."""
+    x, y = rng.uniform(-CITY_RADIUS, CITY_RADIUS, 2) / 2
+    heading = rng.uniform(0, 2 * math.pi)
+    coordinates = []
+    for _ in range(points):
+        coordinates.append((x, y))
+        if math.hypot(x, y) > CITY_RADIUS:
+            heading = math.atan2(-y, -x)
+        heading += rng.uniform(-MAX_TURN, MAX_TURN)
+        x += spacing * math.cos(heading)
+        y += spacing * math.sin(heading)
+    coordinates = np.array(coordinates)
+    latitudes = CENTER[0] + coordinates[:, 1] / METERS_PER_DEGREE
+    longitudes = CENTER[1] + coordinates[:, 0] / (
+        METERS_PER_DEGREE * math.cos(math.radians(CENTER[0])))
+    return np.column_stack([latitudes, longitudes])
+
+
+@transaction.atomic
+def generate_city(stops: int, routes: int, points: int, vehicles: int,
+                  seed: int = 0, spacing: float = DEFAULT_SPACING) -> dict:
+    """Create a synthetic network next to the existing data.
+
+    Routes are random walks with ``points`` Path rows each. Stops are put
+    on route points and served by the buses of their route, buses stand
+    at random points of their routes. Every route gets its own locations.
+
+    Returns:
+        Dict with path_ids, stop_ids and vehicle_ids of created objects.
+
+    Raises:
+        ValueError if there are no routes or route points.
+    """
+    if routes < 1 or points < 1:
+        raise ValueError('routes and points must be positive')
+    rng = np.random.default_rng(seed)
+    # On SQLite the first insert locks the database, read path ids after.
+    locations = [create_locations(_route_points(rng, points, spacing))
+                 for _ in range(routes)]
+    first_path_id = (Path.objects.aggregate(last=Max('path_id'))['last']
+                     or 0) + 1
+    path_ids = list(range(first_path_id, first_path_id + routes))
+    route_locations = dict(zip(path_ids, locations))
+    path_rows = []
+    for path_id, location_ids in route_locations.items():
+        path_rows.extend(
+            Path(path_id=path_id, location_id=location_id, order=order,
+                 distance=round(order * spacing))
+            for order, location_id in enumerate(location_ids))
+    Path.objects.bulk_create(path_rows, batch_size=1000)
+
+    vehicle_routes = [path_ids[number % routes] for number in range(vehicles)]
+    vehicle_pks = bulk_create_ids(Vehicle, [
+        Vehicle(name=f'V{number}', path_id=path_id,
+                location_id=route_locations[path_id][rng.integers(points)])
+        for number, path_id in enumerate(vehicle_routes)
+    ])
+    route_vehicles = {}
+    for vehicle_id, path_id in zip(vehicle_pks, vehicle_routes):
+        route_vehicles.setdefault(path_id, []).append(vehicle_id)
+    vehicle_ids = [vehicle_id for ids in route_vehicles.values()
+                   for vehicle_id in ids]
+
+    stop_routes = [path_ids[number % routes] for number in range(stops)]
+    stop_orders = {}
+    for path_id in path_ids:
+        count = stop_routes.count(path_id)
+        stop_orders[path_id] = iter(np.sort(rng.choice(
+            points, size=count, replace=count > points)).tolist())
+    stop_ids = bulk_create_ids(BusStop, [
+        BusStop(name=f'S{number}', location_id=route_locations[path_id][
+            next(stop_orders[path_id])])
+        for number, path_id in enumerate(stop_routes)
+    ])
+    BusStop.buses.through.objects.bulk_create([
+        BusStop.buses.through(busstop_id=stop_id, vehicle_id=vehicle_id)
+        for stop_id, path_id in zip(stop_ids, stop_routes)
+        for vehicle_id in route_vehicles.get(path_id, [])
+    ], batch_size=1000)
+
+    # Bulk writes send no signals.
+    transaction.on_commit(lambda: invalidate_network(path_ids=path_ids))
+    return {'path_ids': path_ids, 'stop_ids': stop_ids,
+            'vehicle_ids': vehicle_ids}
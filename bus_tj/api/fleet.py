@@ -0,0 +1,249 @@
+"""Snapshot of positions of every bus with delta sync.
+
+Every bus is kept as a pre-encoded JSON record stamped with the version
+of its last change. Versions grow by one on every change, so a client
+which remembers the version of its last response asks only for the buses
+changed since then. The snapshot lives in the memory of the process, like
+the arrival table, and is loaded from the database on first use and
+when another process changes the network.
+
+Every process numbers its own changes: the high bits of a version are a
+random epoch of the process, and a version of another epoch gets the full
+snapshot. Fixes handled by other workers are picked up from the live state
+before every response.
+"""
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime, timezone as dt_timezone
+
+import numpy as np
+
+from tracker.models import Vehicle
+from .live import live_state
+from .network import network_version
+
+MAX_TOMBSTONES = 10000
+# Versions stay below 2 ** 53, so JavaScript clients read them exactly.
+EPOCH_BITS = 20
+COUNTER_BITS = 32
+
+
+def _encode(fields: dict) -> bytes:
+    return json.dumps(fields, separators=(',', ':')).encode()
+
+
+def _live_fields(live) -> dict:
+    return {'location': live.location_id, 'latitude': live.latitude,
+            'longitude': live.longitude,
+            'distance': (None if live.distance is None
+                         else round(live.distance)),
+            'timestamp': datetime.fromtimestamp(
+                live.timestamp, dt_timezone.utc).isoformat()}
+
+
+class Fleet:
+    """Positions of buses keyed by vehicle id."""
+
+    def __init__(self, max_tombstones: int = MAX_TOMBSTONES):
+        """Create empty fleet, it is loaded on first use.
+
+        Args:
+            max_tombstones (int): Deleted buses remembered for deltas, older
+        deltas get the full snapshot.
+        """
+        self.max_tombstones = max_tombstones
+        self._lock = threading.Lock()
+        self._pid = None
+        self._version = 0
+        self._horizon = 0
+        self._records = None
+        self._stamps = {}
+        self._removed = deque()
+        self._cache = {}
+
+    def _new_epoch(self) -> None:
+        # A forked worker must not share the epoch of its parent.
+        self._pid = os.getpid()
+        epoch = int.from_bytes(os.urandom(4), 'big') % (1 << EPOCH_BITS)
+        self._version = epoch << COUNTER_BITS
+
+    @staticmethod
+    def _epoch(version: int) -> int:
+        return version >> COUNTER_BITS
+
+    def _load(self) -> None:
+        if self._pid != os.getpid():
+            self._new_epoch()
+        self._version += 1
+        self._horizon = self._version
+        self._removed.clear()
+        self._cache = {}
+        self._records = {}
+        self._stamps = {}
+        for vehicle_id, name, path_id, location_id, latitude, longitude in (
+                Vehicle.objects.values_list(
+                    'id', 'name', 'path_id', 'location_id',
+                    'location__latitude', 'location__longitude')):
+            fields = {'id': vehicle_id, 'name': name, 'path_id': path_id,
+                      'location': location_id, 'latitude': latitude,
+                      'longitude': longitude, 'distance': None,
+                      'timestamp': None}
+            # The database lags behind the live state.
+            live = live_state.get(vehicle_id)
+            if live is not None and live.timestamp is not None:
+                fields.update(_live_fields(live))
+                self._stamps[vehicle_id] = live.timestamp
+            self._records[vehicle_id] = [self._version, fields,
+                                         _encode(fields)]
+
+    def _loaded(self) -> dict:
+        if self._records is None or self._pid != os.getpid():
+            self._load()
+        else:
+            self._sync()
+        return self._records
+
+    def _sync(self) -> None:
+        """Apply fixes which other workers stored in the live state."""
+        ids, stamps = live_state.timestamps()
+        known = np.array([self._stamps.get(vehicle_id, np.nan)
+                          for vehicle_id in ids.tolist()], dtype=float)
+        changed = ~np.isnan(stamps) & (stamps != known)
+        for vehicle_id in ids[changed].tolist():
+            record = self._records.get(vehicle_id)
+            live = live_state.get(vehicle_id)
+            if record is None or live is None or live.timestamp is None:
+                continue
+            self._stamps[vehicle_id] = live.timestamp
+            self._change(record, _live_fields(live))
+
+    def _change(self, record: list, fields: dict) -> None:
+        self._version += 1
+        record[0] = self._version
+        record[1].update(fields)
+        record[2] = _encode(record[1])
+
+    @property
+    def version(self) -> int:
+        """Return version of the last change."""
+        network_version.check()
+        with self._lock:
+            self._loaded()
+            return self._version
+
+    def update(self, vehicle_id: int, **fields) -> None:
+        """Change fields of the bus if the fleet is loaded.
+
+        Args:
+            vehicle_id (int): PrimaryKey of the bus.
+            fields: latitude, longitude, location, distance, timestamp.
+        """
+        with self._lock:
+            if self._records is None:
+                return
+            record = self._records.get(vehicle_id)
+            if record is None:
+                # A bus created since the load, read it with the others.
+                self._records = None
+                return
+            if isinstance(fields.get('timestamp'), datetime):
+                self._stamps[vehicle_id] = fields['timestamp'].timestamp()
+                fields['timestamp'] = fields['timestamp'].astimezone(
+                    dt_timezone.utc).isoformat()
+            self._change(record, fields)
+
+    def remove(self, vehicle_id: int) -> None:
+        """Forget the deleted bus."""
+        with self._lock:
+            if self._records is None or (
+                    self._records.pop(vehicle_id, None) is None):
+                return
+            self._version += 1
+            self._removed.append((self._version, vehicle_id))
+            if len(self._removed) > self.max_tombstones:
+                version, _ = self._removed.popleft()
+                self._horizon = version + 1
+
+    def reset(self) -> None:
+        """Reload from the database on next use, e.g. after bulk writes."""
+        with self._lock:
+            self._records = None
+
+    def snapshot(self, since: int = None) -> tuple:
+        """Return (version, JSON body) of the fleet or of its changes.
+
+        Args:
+            since (int): The version the client has. The full snapshot is
+        returned without it or if changes since it aren't known any more.
+        """
+        network_version.check()
+        with self._lock:
+            records = self._loaded()
+            full = since is None or since < self._horizon or (
+                since > self._version) or (
+                self._epoch(since) != self._epoch(self._version))
+            cached = self._cache.get(('full',))
+            if full and cached is not None and cached[0] == self._version:
+                return cached
+            if full:
+                vehicles = [record[2] for record in records.values()]
+                removed = []
+            else:
+                vehicles = [record[2] for record in records.values()
+                            if record[0] > since]
+                removed = [vehicle_id for version, vehicle_id in
+                           self._removed if version > since]
+            body = b''.join([
+                b'{"version":%d,"full":%s,"vehicles":[' % (
+                    self._version, b'true' if full else b'false'),
+                b','.join(vehicles),
+                b'],"removed":', _encode(removed), b'}',
+            ])
+            if full:
+                self._cache[('full',)] = (self._version, body)
+            return self._version, body
+
+    def vehicle_positions(self) -> tuple:
+        """Return (version, JSON body) in GTFS-realtime VehiclePositions form.
+
+        This is the JSON mapping of the FeedMessage protobuf, with every
+        bus as an entity.
+        """
+        network_version.check()
+        with self._lock:
+            records = self._loaded()
+            cached = self._cache.get(('positions',))
+            if cached is not None and cached[0] == self._version:
+                return cached
+            entities = []
+            for _, fields, _ in records.values():
+                if fields['latitude'] is None:
+                    continue
+                vehicle = {
+                    'vehicle': {'id': str(fields['id']),
+                                'label': fields['name']},
+                    'position': {'latitude': fields['latitude'],
+                                 'longitude': fields['longitude']},
+                }
+                if fields['timestamp'] is not None:
+                    vehicle['timestamp'] = int(datetime.fromisoformat(
+                        fields['timestamp']).timestamp())
+                entities.append({'id': str(fields['id']),
+                                 'vehicle': vehicle})
+            body = _encode({
+                'header': {
+                    'gtfs_realtime_version': '2.0',
+                    'incrementality': 'FULL_DATASET',
+                    'timestamp': int(datetime.now(
+                        dt_timezone.utc).timestamp()),
+                },
+                'entity': entities,
+            })
+            self._cache[('positions',)] = (self._version, body)
+            return self._version, body
+
+
+fleet = Fleet()
+network_version.connect(fleet.reset)
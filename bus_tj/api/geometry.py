@@ -0,0 +1,221 @@
+"""Cache of route geometry as contiguous NumPy arrays."""
+import threading
+
+import numpy as np
+from cachetools import LRUCache
+from django.conf import settings
+
+from tracker.models import Path
+from .distance import haversine
+from .network import network_version
+
+DEFAULT_ROUTE_CACHE_BYTES = 64 * 1024 * 1024
+# A route which ends this close to its start is a loop.
+DEFAULT_LOOP_TOLERANCE = 50
+
+
+class RouteGeometry:
+    """Points of one route ordered by Path.order.
+
+    Attributes:
+    path_id (int): The id of the path.
+    row_ids (ndarray): PrimaryKeys of the Path rows.
+    location_ids (ndarray): PrimaryKeys of the point locations.
+    latitudes (ndarray): The latitudes of the points.
+    longitudes (ndarray): The longitudes of the points.
+    distances (ndarray): The distances of the points from the start point.
+    circular (bool): Buses go round the route: its last point is within
+    ROUTE_LOOP_TOLERANCE meters of the first one.
+    period (float): The length of one lap of a circular route.
+    """
+
+    def __init__(self, path_id: int, rows):
+        """Build geometry.
+
+        Args:
+            path_id (int): The id of the path.
+            rows: Sequence of (row_id, location_id, latitude, longitude,
+        distance) tuples in route order.
+        """
+        self.path_id = path_id
+        columns = np.array(rows, dtype=float).reshape(-1, 5).T
+        self.row_ids = columns[0].astype(np.int64)
+        self.location_ids = columns[1].astype(np.int64)
+        self.latitudes = np.ascontiguousarray(columns[2])
+        self.longitudes = np.ascontiguousarray(columns[3])
+        self.distances = _increasing(columns[4], self.latitudes,
+                                     self.longitudes)
+        self.circular = False
+        self.period = None
+        if len(self) > 2:
+            gap = float(haversine(self.latitudes[-1], self.longitudes[-1],
+                                  self.latitudes[0], self.longitudes[0]))
+            self.circular = gap <= getattr(
+                settings, 'ROUTE_LOOP_TOLERANCE', DEFAULT_LOOP_TOLERANCE)
+            if self.circular:
+                self.period = float(self.distances[-1]) + gap
+        self._location_order = np.argsort(self.location_ids, kind='stable')
+        self._index = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Return number of points."""
+        return len(self.location_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Return memory taken by the arrays, the index is included."""
+        arrays = (self.row_ids, self.location_ids, self.latitudes,
+                  self.longitudes, self.distances, self._location_order)
+        # A built segment index takes about as much as the arrays again.
+        return 2 * sum(array.nbytes for array in arrays)
+
+    @property
+    def length(self) -> float:
+        """Return distance of the last point from the start point."""
+        return float(self.distances[-1]) if len(self) else 0.0
+
+    @property
+    def index(self):
+        """Return segment index of the route, built on first use."""
+        if self._index is None:
+            from .matching import RouteIndex
+            with self._lock:
+                if self._index is None:
+                    self._index = RouteIndex(self)
+        return self._index
+
+    def forward(self, start, end) -> np.ndarray:
+        """Return distances along the route from start to end points.
+
+        Both are distances from the route start, scalars or arrays. On a
+        circular route the distance wraps around to the next lap, on a
+        linear one it is NaN where end has been passed.
+        """
+        ahead = np.subtract(end, start, dtype=float)
+        if self.circular:
+            return np.mod(ahead, self.period)
+        return np.where(ahead >= 0, ahead, np.nan)
+
+    def progress(self, start: float, end: float) -> float:
+        """Return distance driven from start to end or None if backwards.
+
+        On a circular route a move of more than half a lap is taken for a
+        step backwards.
+        """
+        driven = float(self.forward(start, end))
+        if driven != driven or (self.circular and driven > self.period / 2):
+            return None
+        return driven
+
+    def position(self, location_id: int) -> int:
+        """Return position of the first point at the location or None."""
+        sorted_ids = self.location_ids[self._location_order]
+        found = np.searchsorted(sorted_ids, location_id)
+        if found < len(sorted_ids) and sorted_ids[found] == location_id:
+            return int(self._location_order[found])
+        return None
+
+    def distance_of(self, location_id: int) -> float:
+        """Return distance of the location from the start point or None."""
+        position = self.position(location_id)
+        if position is None:
+            return None
+        return float(self.distances[position])
+
+    def contains(self, row_id: int = None, location_id: int = None) -> bool:
+        """Check whether the route uses the Path row or the location."""
+        if row_id is not None and np.any(self.row_ids == row_id):
+            return True
+        return location_id is not None and (
+            self.position(location_id) is not None)
+
+
+def _increasing(distances: np.ndarray, latitudes: np.ndarray,
+                longitudes: np.ndarray) -> np.ndarray:
+    """Return distances which never go back along the route.
+
+    Some feeds start distances from zero again on every lap, such steps
+    are replaced by the length of the segment.
+    """
+    steps = np.diff(distances)
+    if not len(steps) or steps.min() >= 0:
+        return np.ascontiguousarray(distances)
+    back = np.flatnonzero(steps < 0)
+    steps[back] = haversine(latitudes[back], longitudes[back],
+                            latitudes[back + 1], longitudes[back + 1])
+    return np.concatenate(([distances[0]], distances[0] + np.cumsum(steps)))
+
+
+def load_route_geometry(path_id: int) -> RouteGeometry:
+    """Read points of the route from the database in route order."""
+    rows = list(
+        Path.objects
+        .filter(path_id=path_id, location__isnull=False)
+        .order_by('order')
+        .values_list('id', 'location_id', 'location__latitude',
+                     'location__longitude', 'distance')
+    )
+    return RouteGeometry(path_id, rows)
+
+
+class RouteGeometryCache:
+    """LRU cache of route geometry bounded by memory.
+
+    Routes are loaded lazily and least recently used ones are evicted once
+    the arrays take more than ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes: int = None):
+        """Create empty cache."""
+        if max_bytes is None:
+            max_bytes = getattr(settings, 'ROUTE_CACHE_MAX_BYTES',
+                                DEFAULT_ROUTE_CACHE_BYTES)
+        self._routes = LRUCache(maxsize=max_bytes,
+                                getsizeof=lambda route: max(route.nbytes, 1))
+        self._lock = threading.RLock()
+
+    def __contains__(self, path_id: int) -> bool:
+        """Check whether the route is loaded."""
+        with self._lock:
+            return path_id in self._routes
+
+    def get(self, path_id: int) -> RouteGeometry:
+        """Return geometry of the route, loading it if needed."""
+        network_version.check()
+        with self._lock:
+            route = self._routes.get(path_id)
+            if route is None:
+                route = load_route_geometry(path_id)
+                try:
+                    self._routes[path_id] = route
+                except ValueError:
+                    # The route alone is larger than the whole cache.
+                    pass
+            return route
+
+    def invalidate(self, path_id: int = None, row_id: int = None,
+                   location_id: int = None) -> None:
+        """Drop routes by id or by a Path row or location they use.
+
+        Without arguments every route is dropped.
+        """
+        with self._lock:
+            if path_id is None and row_id is None and location_id is None:
+                self._routes.clear()
+                return
+            self._routes.pop(path_id, None)
+            if row_id is None and location_id is None:
+                return
+            for key, route in list(self._routes.items()):
+                if route.contains(row_id, location_id):
+                    del self._routes[key]
+
+
+route_cache = RouteGeometryCache()
+network_version.connect(route_cache.invalidate)
+
+
+def get_route_geometry(path_id: int) -> RouteGeometry:
+    """Return geometry of the route from the shared cache."""
+    return route_cache.get(path_id)
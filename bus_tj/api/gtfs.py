@@ -0,0 +1,426 @@
+"""Streaming import of GTFS static feeds.
+
+Every shape used by trips becomes a route: Path rows with distances from
+the start and one Vehicle named after the GTFS route. Stops with their
+own locations are linked to the vehicles of the shapes whose trips stop
+at them. The archive is read table by table, row by row, and only ids
+and coordinates are kept in memory.
+
+Imported objects are remembered in FeedObject with checksums of their
+source rows, so a re-import creates, updates and deletes only what has
+changed in the feed.
+"""
+import csv
+import hashlib
+import io
+import os
+import zipfile
+from array import array
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Max
+
+from tracker.models import BusStop, FeedObject, Location, Path, Vehicle
+from .city import bulk_create_ids, create_locations
+from .distance import haversine
+from .signals import bulk_changes, invalidate_network
+
+BATCH_SIZE = 5000
+REQUIRED_TABLES = ('stops.txt', 'shapes.txt', 'trips.txt', 'stop_times.txt')
+
+
+class GtfsError(Exception):
+    """Raise when the feed can't be imported."""
+
+    pass
+
+
+def checksum(*values) -> str:
+    """Return SHA-1 of the values."""
+    digest = hashlib.sha1()
+    for value in values:
+        digest.update(value if isinstance(value, bytes)
+                      else repr(value).encode())
+    return digest.hexdigest()
+
+
+def file_checksum(path: str) -> str:
+    """Return SHA-1 of the file read in blocks."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class GtfsImporter:
+    """Import one GTFS zip archive as a named feed."""
+
+    def __init__(self, path: str, feed: str = 'default'):
+        """Create importer.
+
+        Args:
+            path (str): The GTFS zip archive.
+            feed (str): The name the imported objects are remembered by.
+        """
+        self.path = path
+        self.feed = feed
+        self.stats = {}
+
+    def table(self, archive: zipfile.ZipFile, name: str, columns: tuple):
+        """Yield tuples of the columns of a table, '' for missing columns.
+
+        Raises:
+            GtfsError if the table or a required column is missing.
+        """
+        members = {os.path.basename(member): member
+                   for member in archive.namelist()}
+        if name not in members:
+            raise GtfsError(f'{name} is missing.')
+        with archive.open(members[name]) as raw:
+            reader = csv.reader(io.TextIOWrapper(raw, encoding='utf-8-sig'))
+            header = [column.strip() for column in next(reader, [])]
+            indexes = [header.index(column) if column in header else None
+                       for column in columns]
+            if indexes[0] is None:
+                raise GtfsError(f'{name} has no {columns[0]} column.')
+            for row in reader:
+                yield tuple(
+                    row[index] if index is not None and index < len(row)
+                    else '' for index in indexes)
+
+    def mapping(self, kind: str) -> dict:
+        """Return {source_id: FeedObject} of the kind."""
+        return {item.source_id: item for item in FeedObject.objects.filter(
+            feed=self.feed, kind=kind)}
+
+    def checksums(self, kind: str) -> dict:
+        """Return {source_id: (object_id, checksum)} of the kind."""
+        return {item.source_id: (item.object_id, item.checksum)
+                for item in self.mapping(kind).values()}
+
+    def changed(self, kind: str, stored: dict) -> set:
+        """Return object ids of the kind created, updated or deleted.
+
+        Args:
+            kind (str): The kind of imported objects.
+            stored (dict): checksums of the kind before import.
+        """
+        current = self.checksums(kind)
+        return {object_id for source_id, (object_id, _) in
+                (*stored.items(), *current.items())
+                if stored.get(source_id) != current.get(source_id)}
+
+    def count(self, kind: str, action: str, number: int) -> None:
+        """Add to import statistics."""
+        self.stats.setdefault(kind, {'created': 0, 'updated': 0,
+                                     'deleted': 0})[action] += number
+
+    def run(self, force: bool = False) -> dict:
+        """Import the archive.
+
+        Args:
+            force (bool): Import even if the archive hasn't changed.
+
+        Returns:
+            {kind: {'created', 'updated', 'deleted'}} statistics, empty if
+        the archive is the one imported last time.
+        """
+        digest = file_checksum(self.path)
+        archive_object = self.mapping('archive').get('archive')
+        if not force and archive_object is not None and (
+                archive_object.checksum == digest):
+            return {}
+        with zipfile.ZipFile(self.path) as archive, transaction.atomic():
+            # Receivers would run per deleted row, the network is
+            # invalidated once when the import commits.
+            with bulk_changes():
+                members = {os.path.basename(member)
+                           for member in archive.namelist()}
+                missing = [name for name in REQUIRED_TABLES
+                           if name not in members]
+                if missing:
+                    raise GtfsError(f'{", ".join(missing)} missing.')
+                # Write first: on SQLite it locks the database, so path ids
+                # read below can't be taken by another import.
+                FeedObject.objects.update_or_create(
+                    feed=self.feed, kind='archive', source_id='archive',
+                    defaults={'object_id': 0, 'checksum': digest})
+                names = self.read_routes(archive)
+                shape_routes, trip_shapes = self.read_trips(archive)
+                stored = {kind: self.checksums(kind)
+                          for kind in ('stop', 'shape')}
+                stop_ids = self.import_stops(archive)
+                path_ids = self.import_shapes(archive, shape_routes)
+                vehicle_ids = self.import_vehicles(shape_routes, names,
+                                                   path_ids)
+                self.link_stops(archive, trip_shapes, stop_ids, vehicle_ids)
+                # Only moved stops and rebuilt routes lose their offsets.
+                changed_stops = self.changed('stop', stored['stop'])
+                changed_paths = self.changed('shape', stored['shape'])
+                transaction.on_commit(lambda: invalidate_network(
+                    path_ids=list(changed_paths),
+                    stop_ids=list(changed_stops)))
+        return self.stats
+
+    def read_routes(self, archive: zipfile.ZipFile) -> dict:
+        """Return {route_id: name}, routes.txt is optional."""
+        try:
+            return {
+                route_id: (short_name or long_name or route_id)[:10]
+                for route_id, short_name, long_name in self.table(
+                    archive, 'routes.txt',
+                    ('route_id', 'route_short_name', 'route_long_name'))
+            }
+        except GtfsError:
+            return {}
+
+    def read_trips(self, archive: zipfile.ZipFile) -> tuple:
+        """Return ({shape_id: route_id}, {trip_id: shape_id})."""
+        shape_routes, trip_shapes = {}, {}
+        for trip_id, route_id, shape_id in self.table(
+                archive, 'trips.txt', ('trip_id', 'route_id', 'shape_id')):
+            if shape_id:
+                trip_shapes[trip_id] = shape_id
+                shape_routes.setdefault(shape_id, route_id)
+        return shape_routes, trip_shapes
+
+    def import_stops(self, archive: zipfile.ZipFile) -> dict:
+        """Create, update and delete stops, return {stop_id: pk}."""
+        existing = self.mapping('stop')
+        stop_ids = {}
+        created, changed = [], []
+        for stop_id, name, latitude, longitude, location_type in self.table(
+                archive, 'stops.txt', ('stop_id', 'stop_name', 'stop_lat',
+                                       'stop_lon', 'location_type')):
+            if location_type not in ('', '0'):
+                continue
+            try:
+                row = (stop_id, name[:128], float(latitude),
+                       float(longitude))
+            except ValueError:
+                raise GtfsError(f'Stop {stop_id} has no coordinates.')
+            digest = checksum(*row[1:])
+            item = existing.get(stop_id)
+            if item is None:
+                created.append(row + (digest,))
+            else:
+                stop_ids[stop_id] = item.object_id
+                if item.checksum != digest:
+                    item.checksum = digest
+                    changed.append((item, row))
+
+        removed = [item for source_id, item in existing.items()
+                   if source_id not in stop_ids]
+        if removed:
+            # Stops are deleted with their locations.
+            Location.objects.filter(pk__in=BusStop.objects.filter(
+                pk__in=[item.object_id for item in removed]
+            ).values('location_id')).delete()
+            FeedObject.objects.filter(
+                pk__in=[item.pk for item in removed]).delete()
+            self.count('stop', 'deleted', len(removed))
+
+        if changed:
+            stops = BusStop.objects.in_bulk(
+                [item.object_id for item, _ in changed])
+            locations = Location.objects.in_bulk(
+                [stop.location_id for stop in stops.values()])
+            for item, (_, name, latitude, longitude) in changed:
+                stop = stops[item.object_id]
+                stop.name = name
+                location = locations[stop.location_id]
+                location.latitude = latitude
+                location.longitude = longitude
+            BusStop.objects.bulk_update(stops.values(), ['name'],
+                                        batch_size=BATCH_SIZE)
+            Location.objects.bulk_update(
+                locations.values(), ['latitude', 'longitude'],
+                batch_size=BATCH_SIZE)
+            FeedObject.objects.bulk_update(
+                [item for item, _ in changed], ['checksum'],
+                batch_size=BATCH_SIZE)
+            self.count('stop', 'updated', len(changed))
+
+        if created:
+            location_ids = create_locations(
+                np.array([row[2:4] for row in created], dtype=float))
+            pks = bulk_create_ids(BusStop, [
+                BusStop(name=row[1], location_id=location_id)
+                for row, location_id in zip(created, location_ids)])
+            FeedObject.objects.bulk_create(
+                [FeedObject(feed=self.feed, kind='stop', source_id=row[0],
+                            object_id=pk, checksum=row[4])
+                 for row, pk in zip(created, pks)], batch_size=BATCH_SIZE)
+            stop_ids.update(zip((row[0] for row in created), pks))
+            self.count('stop', 'created', len(created))
+        return stop_ids
+
+    def read_shapes(self, archive: zipfile.ZipFile, used: set) -> dict:
+        """Return {shape_id: (latitudes, longitudes)} of used shapes."""
+        points = {}
+        for shape_id, latitude, longitude, sequence in self.table(
+                archive, 'shapes.txt', ('shape_id', 'shape_pt_lat',
+                                        'shape_pt_lon',
+                                        'shape_pt_sequence')):
+            if shape_id not in used:
+                continue
+            arrays = points.get(shape_id)
+            if arrays is None:
+                arrays = points[shape_id] = (array('d'), array('d'),
+                                             array('d'))
+            arrays[0].append(float(sequence))
+            arrays[1].append(float(latitude))
+            arrays[2].append(float(longitude))
+        shapes = {}
+        for shape_id, (sequences, latitudes, longitudes) in points.items():
+            order = np.argsort(np.frombuffer(sequences), kind='stable')
+            shapes[shape_id] = (np.frombuffer(latitudes)[order],
+                                np.frombuffer(longitudes)[order])
+        return shapes
+
+    def import_shapes(self, archive: zipfile.ZipFile,
+                      shape_routes: dict) -> dict:
+        """Create, replace and delete routes, return {shape_id: path_id}."""
+        existing = self.mapping('shape')
+        shapes = self.read_shapes(archive, set(shape_routes))
+        path_ids = {}
+        rebuilt, changed = [], []
+        next_path_id = (Path.objects.aggregate(last=Max('path_id'))['last']
+                        or 0) + 1
+        for shape_id, (latitudes, longitudes) in shapes.items():
+            digest = checksum(latitudes.tobytes(), longitudes.tobytes())
+            item = existing.get(shape_id)
+            if item is None:
+                item = FeedObject(feed=self.feed, kind='shape',
+                                  source_id=shape_id, object_id=next_path_id,
+                                  checksum=digest)
+                next_path_id += 1
+                rebuilt.append((item, latitudes, longitudes))
+            elif item.checksum != digest:
+                item.checksum = digest
+                changed.append(item)
+                rebuilt.append((item, latitudes, longitudes))
+            path_ids[shape_id] = item.object_id
+
+        removed = [item for source_id, item in existing.items()
+                   if source_id not in shapes]
+        stale = [item.object_id for item in removed + changed]
+        if stale:
+            # Locations of routes are their own, they go with the rows.
+            location_ids = list(Path.objects.filter(
+                path_id__in=stale).values_list('location_id', flat=True))
+            Path.objects.filter(path_id__in=stale).delete()
+            Location.objects.filter(pk__in=location_ids).delete()
+        if removed:
+            FeedObject.objects.filter(
+                pk__in=[item.pk for item in removed]).delete()
+            self.count('shape', 'deleted', len(removed))
+
+        if rebuilt:
+            location_ids = create_locations(np.column_stack([
+                np.concatenate([shape[1] for shape in rebuilt]),
+                np.concatenate([shape[2] for shape in rebuilt]),
+            ]))
+            rows = []
+            start = 0
+            for item, latitudes, longitudes in rebuilt:
+                steps = haversine(latitudes[:-1], longitudes[:-1],
+                                  latitudes[1:], longitudes[1:])
+                distances = np.concatenate([[0], np.cumsum(steps)])
+                rows.extend(
+                    Path(path_id=item.object_id, location_id=location_id,
+                         order=order, distance=round(distance))
+                    for order, (location_id, distance) in enumerate(zip(
+                        location_ids[start:start + len(latitudes)],
+                        distances.tolist())))
+                start += len(latitudes)
+            Path.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+        FeedObject.objects.bulk_update(changed, ['checksum'],
+                                       batch_size=BATCH_SIZE)
+        FeedObject.objects.bulk_create(
+            [item for item, _, _ in rebuilt if item.pk is None],
+            batch_size=BATCH_SIZE)
+        self.count('shape', 'updated', len(changed))
+        self.count('shape', 'created', len(rebuilt) - len(changed))
+        return path_ids
+
+    def import_vehicles(self, shape_routes: dict, names: dict,
+                        path_ids: dict) -> dict:
+        """Keep one vehicle per route, return {shape_id: vehicle pk}."""
+        existing = self.mapping('vehicle')
+        vehicle_ids = {}
+        created, changed = [], []
+        for shape_id, path_id in path_ids.items():
+            route_id = shape_routes[shape_id]
+            name = names.get(route_id, route_id[:10])
+            digest = checksum(name, path_id)
+            item = existing.get(shape_id)
+            if item is None:
+                created.append((shape_id, name, path_id, digest))
+                continue
+            vehicle_ids[shape_id] = item.object_id
+            if item.checksum != digest:
+                item.checksum = digest
+                changed.append((item, name, path_id))
+
+        removed = [item for source_id, item in existing.items()
+                   if source_id not in path_ids]
+        if removed:
+            Vehicle.objects.filter(
+                pk__in=[item.object_id for item in removed]).delete()
+            FeedObject.objects.filter(
+                pk__in=[item.pk for item in removed]).delete()
+            self.count('vehicle', 'deleted', len(removed))
+        if changed:
+            vehicles = Vehicle.objects.in_bulk(
+                [item.object_id for item, _, _ in changed])
+            for item, name, path_id in changed:
+                vehicles[item.object_id].name = name
+                vehicles[item.object_id].path_id = path_id
+            Vehicle.objects.bulk_update(vehicles.values(),
+                                        ['name', 'path_id'])
+            FeedObject.objects.bulk_update(
+                [item for item, _, _ in changed], ['checksum'])
+            self.count('vehicle', 'updated', len(changed))
+        if created:
+            pks = bulk_create_ids(Vehicle, [
+                Vehicle(name=name, path_id=path_id)
+                for _, name, path_id, _ in created])
+            FeedObject.objects.bulk_create(
+                [FeedObject(feed=self.feed, kind='vehicle',
+                            source_id=shape_id, object_id=pk,
+                            checksum=digest)
+                 for (shape_id, _, _, digest), pk in zip(created, pks)],
+                batch_size=BATCH_SIZE)
+            vehicle_ids.update(zip((row[0] for row in created), pks))
+            self.count('vehicle', 'created', len(created))
+        return vehicle_ids
+
+    def link_stops(self, archive: zipfile.ZipFile, trip_shapes: dict,
+                   stop_ids: dict, vehicle_ids: dict) -> None:
+        """Link stops to the vehicles of the shapes which stop at them."""
+        wanted = set()
+        for trip_id, stop_id in self.table(archive, 'stop_times.txt',
+                                           ('trip_id', 'stop_id')):
+            shape_id = trip_shapes.get(trip_id)
+            if shape_id in vehicle_ids and stop_id in stop_ids:
+                wanted.add((stop_ids[stop_id], vehicle_ids[shape_id]))
+        through = BusStop.buses.through
+        existing = {
+            (busstop_id, vehicle_id): pk
+            for pk, busstop_id, vehicle_id in through.objects.filter(
+                vehicle_id__in=vehicle_ids.values()
+            ).values_list('id', 'busstop_id', 'vehicle_id').iterator()
+        }
+        extra = [pk for pair, pk in existing.items() if pair not in wanted]
+        for start in range(0, len(extra), BATCH_SIZE):
+            through.objects.filter(
+                pk__in=extra[start:start + BATCH_SIZE]).delete()
+        through.objects.bulk_create(
+            [through(busstop_id=busstop_id, vehicle_id=vehicle_id)
+             for busstop_id, vehicle_id in wanted - existing.keys()],
+            batch_size=BATCH_SIZE)
+        self.count('link', 'deleted', len(extra))
+        self.count('link', 'created', len(wanted - existing.keys()))
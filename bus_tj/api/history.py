@@ -0,0 +1,292 @@
+"""Compact location history of vehicles.
+
+Every fix is a 16 byte record: milliseconds since the start of its time
+partition (uint32), latitude, longitude and distance along the route
+(float32). Records of one vehicle and partition are kept sorted by time in
+one LocationChunk row, so an hour of fixes every 5 seconds takes 11 KB in
+one row instead of 720 rows. Fixes are buffered and written in batches.
+
+A thread of every process which stores fixes writes the buffer every
+HISTORY_FLUSH_INTERVAL seconds, and every HISTORY_COMPACT_INTERVAL seconds
+downsamples old partitions and drops expired ones. The compact_history
+command does the same on demand.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import (DatabaseError, IntegrityError, close_old_connections,
+                       transaction)
+from django.utils import timezone
+
+from tracker.models import LocationChunk, Vehicle
+from .metrics import hot_section
+
+logger = logging.getLogger(__name__)
+
+RECORD = np.dtype([('offset', '<u4'), ('latitude', '<f4'),
+                   ('longitude', '<f4'), ('distance', '<f4')])
+DEFAULT_PARTITION = 60 * 60
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 5
+DEFAULT_RESOLUTION = 60
+DEFAULT_RAW_DAYS = 7
+DEFAULT_RETENTION_DAYS = 90
+DEFAULT_COMPACT_INTERVAL = 60 * 60
+WRITE_ATTEMPTS = 3
+
+
+def partition_seconds() -> int:
+    """Return partition length in seconds, the HISTORY_PARTITION setting.
+
+    Records store milliseconds as uint32, so it must be under 49 days.
+    """
+    return getattr(settings, 'HISTORY_PARTITION', DEFAULT_PARTITION)
+
+
+def partition_start(timestamp: datetime) -> datetime:
+    """Return start of the partition which holds the timestamp."""
+    seconds = int(timestamp.timestamp())
+    return datetime.fromtimestamp(seconds - seconds % partition_seconds(),
+                                  tz=dt_timezone.utc)
+
+
+def decode(data) -> np.ndarray:
+    """Return records of a chunk."""
+    return np.frombuffer(bytes(data), dtype=RECORD)
+
+
+def merge(*parts: np.ndarray) -> np.ndarray:
+    """Return records of the parts sorted by time."""
+    records = np.concatenate(parts)
+    return records[np.argsort(records['offset'], kind='stable')]
+
+
+def downsample(records: np.ndarray, resolution: int) -> np.ndarray:
+    """Keep the last of the sorted records in every resolution seconds."""
+    buckets = records['offset'] // (resolution * 1000)
+    return records[np.r_[buckets[1:] != buckets[:-1], True]]
+
+
+@hot_section('history_write')
+def write_records(rows: list) -> None:
+    """Append fixes to raw chunks.
+
+    Args:
+        rows (list): (vehicle_id, timestamp, latitude, longitude, distance)
+    tuples in any order.
+    """
+    groups = {}
+    for vehicle_id, timestamp, latitude, longitude, distance in rows:
+        start = partition_start(timestamp)
+        offset = round((timestamp - start).total_seconds() * 1000)
+        groups.setdefault((vehicle_id, start), []).append(
+            (offset, latitude, longitude, distance))
+    vehicle_ids = set(Vehicle.objects.filter(
+        pk__in={vehicle_id for vehicle_id, _ in groups}
+    ).values_list('pk', flat=True))
+    groups = {key: np.array(records, dtype=RECORD)
+              for key, records in groups.items() if key[0] in vehicle_ids}
+    for attempt in range(WRITE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                _write_groups(groups)
+            return
+        except IntegrityError:
+            # Another process created one of the chunks, read it again.
+            if attempt == WRITE_ATTEMPTS - 1:
+                raise
+
+
+def _write_groups(groups: dict) -> None:
+    chunks = {
+        (chunk.vehicle_id, chunk.start): chunk
+        for chunk in LocationChunk.objects.select_for_update().filter(
+            vehicle_id__in={vehicle_id for vehicle_id, _ in groups},
+            start__in={start for _, start in groups}, resolution=0)
+    }
+    changed, created = [], []
+    for (vehicle_id, start), records in groups.items():
+        chunk = chunks.get((vehicle_id, start))
+        if chunk is None:
+            chunk = LocationChunk(vehicle_id=vehicle_id, start=start)
+            records = merge(records)
+            created.append(chunk)
+        else:
+            records = merge(decode(chunk.data), records)
+            changed.append(chunk)
+        chunk.data = records.tobytes()
+        chunk.count = len(records)
+    if changed:
+        LocationChunk.objects.bulk_update(changed, ['data', 'count'])
+    if created:
+        LocationChunk.objects.bulk_create(created)
+
+
+class HistoryBuffer:
+    """Fixes waiting to be written.
+
+    The buffer is written when it holds HISTORY_BATCH_SIZE fixes, every
+    HISTORY_FLUSH_INTERVAL seconds by a thread of the process, and when
+    the process exits. The thread compacts the history too. A failed write
+    is logged and its fixes are dropped, so history never fails a location
+    update.
+    """
+
+    def __init__(self):
+        """Create empty buffer."""
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+        self._worker_pid = None
+
+    def append(self, rows: list) -> None:
+        """Add rows, see write_records, and write them if it's time."""
+        batch_size = getattr(settings, 'HISTORY_BATCH_SIZE',
+                             DEFAULT_BATCH_SIZE)
+        interval = getattr(settings, 'HISTORY_FLUSH_INTERVAL',
+                           DEFAULT_FLUSH_INTERVAL)
+        with self._lock:
+            self._rows.extend(rows)
+            self._start_worker()
+            if (len(self._rows) < batch_size
+                    and time.monotonic() - self._flushed < interval):
+                return
+        self.flush()
+
+    def _start_worker(self) -> None:
+        """Start the thread of this process, once after a fork too."""
+        if self._worker_pid == os.getpid():
+            return
+        self._worker_pid = os.getpid()
+        threading.Thread(target=self._work_periodically,
+                         name='history-flush', daemon=True).start()
+
+    def _work_periodically(self) -> None:
+        compacted = time.monotonic()
+        while True:
+            time.sleep(getattr(settings, 'HISTORY_FLUSH_INTERVAL',
+                               DEFAULT_FLUSH_INTERVAL))
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush the history.')
+            if time.monotonic() - compacted < getattr(
+                    settings, 'HISTORY_COMPACT_INTERVAL',
+                    DEFAULT_COMPACT_INTERVAL):
+                continue
+            compacted = time.monotonic()
+            try:
+                compact_by_settings()
+            except Exception:
+                logger.exception('Failed to compact the history.')
+
+    def flush(self) -> None:
+        """Write buffered rows."""
+        with self._lock:
+            rows, self._rows = self._rows, []
+            self._flushed = time.monotonic()
+        if not rows:
+            return
+        try:
+            write_records(rows)
+        except DatabaseError:
+            logger.exception(f'Failed to write {len(rows)} history rows.')
+
+
+history_buffer = HistoryBuffer()
+atexit.register(history_buffer.flush)
+
+
+def iter_trace(vehicle_id: int, start: datetime, end: datetime):
+    """Yield (unix time, latitude, longitude, distance) of the vehicle.
+
+    Records between start and end are yielded in time order, chunk by
+    chunk, so a long trace is never held in memory.
+    """
+    chunks = LocationChunk.objects.filter(
+        vehicle_id=vehicle_id,
+        start__gt=start - timedelta(seconds=partition_seconds()),
+        start__lte=end,
+    ).order_by('start', 'resolution').values_list('start', 'data')
+    start_time, end_time = start.timestamp(), end.timestamp()
+    group_start, parts = None, []
+    for chunk_start, data in chunks.iterator(chunk_size=16):
+        if chunk_start != group_start and parts:
+            yield from _group_points(group_start, parts, start_time,
+                                     end_time)
+            parts = []
+        group_start = chunk_start
+        parts.append(decode(data))
+    if parts:
+        yield from _group_points(group_start, parts, start_time, end_time)
+
+
+def _group_points(group_start: datetime, parts: list, start_time: float,
+                  end_time: float):
+    # A partition may have a downsampled chunk and a raw one with fixes
+    # which came late.
+    records = merge(*parts) if len(parts) > 1 else parts[0]
+    times = group_start.timestamp() + records['offset'] / 1000
+    mask = (times >= start_time) & (times <= end_time)
+    yield from zip(times[mask].tolist(),
+                   records['latitude'][mask].tolist(),
+                   records['longitude'][mask].tolist(),
+                   records['distance'][mask].tolist())
+
+
+def compact(raw_before: datetime, delete_before: datetime,
+            resolution: int = DEFAULT_RESOLUTION) -> tuple:
+    """Downsample old raw chunks and delete expired ones.
+
+    Args:
+        raw_before (datetime): Raw partitions which end before it are
+    downsampled.
+        delete_before (datetime): Partitions which start before it are
+    deleted.
+        resolution (int): Seconds between records kept by downsampling.
+
+    Returns:
+        (downsampled, deleted) numbers of chunks.
+    """
+    deleted, _ = LocationChunk.objects.filter(
+        start__lt=delete_before).delete()
+    raw_chunks = LocationChunk.objects.filter(
+        resolution=0,
+        start__lt=raw_before - timedelta(seconds=partition_seconds()),
+    ).values_list('pk', flat=True)
+    downsampled = 0
+    for pk in list(raw_chunks.iterator()):
+        with transaction.atomic():
+            raw = LocationChunk.objects.select_for_update().filter(
+                pk=pk).first()
+            if raw is None:
+                continue
+            chunk, _ = LocationChunk.objects.select_for_update(
+            ).get_or_create(vehicle_id=raw.vehicle_id, start=raw.start,
+                            resolution=resolution, defaults={'data': b''})
+            records = downsample(
+                merge(decode(chunk.data), decode(raw.data)), resolution)
+            chunk.data = records.tobytes()
+            chunk.count = len(records)
+            chunk.save(update_fields=['data', 'count'])
+            raw.delete()
+        downsampled += 1
+    return downsampled, deleted
+
+
+def compact_by_settings() -> tuple:
+    """Compact history as the HISTORY_* settings say, see compact."""
+    now = timezone.now()
+    return compact(
+        now - timedelta(days=getattr(settings, 'HISTORY_RAW_DAYS',
+                                     DEFAULT_RAW_DAYS)),
+        now - timedelta(days=getattr(settings, 'HISTORY_RETENTION_DAYS',
+                                     DEFAULT_RETENTION_DAYS)),
+        getattr(settings, 'HISTORY_RESOLUTION', DEFAULT_RESOLUTION))
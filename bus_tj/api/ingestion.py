@@ -0,0 +1,151 @@
+"""Matching and storing of vehicle location fixes."""
+import math
+from datetime import datetime, timezone as dt_timezone
+from typing import NamedTuple
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from tracker.models import Vehicle
+from .alerts import Move, alert_registry
+from .arrivals import arrival_table
+from .fleet import fleet
+from .history import history_buffer
+from .live import LiveVehicle, live_state
+from .matching import get_route_index
+from .metrics import hot_section
+
+MAX_BULK_FIXES = 1000
+
+
+class Fix(NamedTuple):
+    """GPS fix of a vehicle.
+
+    Attributes:
+    vehicle_id (int): PrimaryKey of the vehicle.
+    latitude (float): The latitude of the fix.
+    longitude (float): The longitude of the fix.
+    timestamp (datetime): The time the fix was taken.
+    """
+
+    vehicle_id: int
+    latitude: float
+    longitude: float
+    timestamp: datetime
+
+
+def parse_timestamp(value) -> datetime:
+    """Parse ISO 8601 string or unix time, default to now."""
+    if value is None:
+        return timezone.now()
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=dt_timezone.utc)
+    timestamp = parse_datetime(str(value))
+    if timestamp is None:
+        raise ValueError('timestamp must be ISO 8601 or unix time')
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp, dt_timezone.utc)
+    return timestamp
+
+
+def parse_fix(item) -> Fix:
+    """Build Fix from request data.
+
+    Both ``lat``/``lon`` and ``latitude``/``longitude`` keys are accepted.
+
+    Raises:
+        ValueError with a message for the client if the item is invalid.
+    """
+    if not isinstance(item, dict):
+        raise ValueError('fix must be an object')
+    latitude = item.get('lat', item.get('latitude'))
+    longitude = item.get('lon', item.get('longitude'))
+    if item.get('vehicle_id') is None or latitude is None or (
+            longitude is None):
+        raise ValueError('params are required')
+    try:
+        fix = Fix(int(item['vehicle_id']), float(latitude),
+                  float(longitude), parse_timestamp(item.get('timestamp')))
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise ValueError('params must be numbers')
+    # float() also takes 'nan', 'inf' and '1e400'.
+    if not (math.isfinite(fix.latitude) and math.isfinite(fix.longitude)
+            and -90 <= fix.latitude <= 90
+            and -180 <= fix.longitude <= 180):
+        raise ValueError('params must be numbers')
+    return fix
+
+
+@hot_section('apply_fixes')
+def apply_fixes(fixes: list) -> list:
+    """Match fixes onto vehicle routes and store the new locations.
+
+    Routes of vehicles are read with one query. The matched point and
+    distance along the route are stored in the live state, which writes
+    them to the database in batches. If a vehicle has several fixes, the
+    latest one wins, and it's dropped if the live state already has a
+    newer fix. Arrivals of moved vehicles are updated in the arrival
+    table, their proximity alerts are checked, and every matched fix is
+    added to the location history.
+
+    Args:
+        fixes (list): Fix objects.
+
+    Returns:
+        List of result dicts aligned with fixes. Every result has a status:
+    'ok', or 'not_found' with a message.
+    """
+    # Records of the live state may predate a route change made by bulk
+    # writes, which send no signals, so routes come from the database.
+    routes = dict(Vehicle.objects.filter(
+        pk__in={fix.vehicle_id for fix in fixes}).values_list(
+        'id', 'path_id'))
+    results = []
+    latest = {}
+    history = []
+    for number, fix in enumerate(fixes):
+        path_id = routes.get(fix.vehicle_id)
+        if path_id is None:
+            results.append({'vehicle_id': fix.vehicle_id,
+                            'status': 'not_found',
+                            'message': 'Vehicle object does not exist.'})
+            continue
+        route = get_route_index(path_id)
+        if route is None:
+            results.append({'vehicle_id': fix.vehicle_id,
+                            'status': 'not_found',
+                            'message': 'Path object does not exist.'})
+            continue
+        match = route.snap(fix.latitude, fix.longitude)
+        results.append({'vehicle_id': fix.vehicle_id, 'status': 'ok',
+                        'distance': round(match.distance),
+                        'location': match.location_id})
+        history.append((fix.vehicle_id, fix.timestamp, fix.latitude,
+                        fix.longitude, match.distance))
+        previous = latest.get(fix.vehicle_id)
+        if previous is None or fixes[previous[0]].timestamp <= fix.timestamp:
+            latest[fix.vehicle_id] = (number, match)
+    stored = {vehicle.id for vehicle in live_state.put_many([
+        LiveVehicle(vehicle_id, routes[vehicle_id], match.location_id,
+                    match.distance, fixes[number].latitude,
+                    fixes[number].longitude,
+                    fixes[number].timestamp.timestamp())
+        for vehicle_id, (number, match) in latest.items()
+    ])}
+    latest = {vehicle_id: fix for vehicle_id, fix in latest.items()
+              if vehicle_id in stored}
+    for vehicle_id, (number, match) in latest.items():
+        fix = fixes[number]
+        arrival_table.update(vehicle_id, routes[vehicle_id], match.distance,
+                             fix.timestamp)
+        fleet.update(vehicle_id, latitude=fix.latitude,
+                     longitude=fix.longitude, location=match.location_id,
+                     distance=round(match.distance), timestamp=fix.timestamp)
+    alert_registry.check([
+        Move(vehicle_id, routes[vehicle_id], match.distance,
+             arrival_table.speed(vehicle_id))
+        for vehicle_id, (_, match) in latest.items()
+    ])
+    if history:
+        history_buffer.append(history)
+    return results
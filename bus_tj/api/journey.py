@@ -0,0 +1,384 @@
+"""Journey planner over routes of buses with transfers.
+
+The network is flattened into arrays once: stops of every route sorted by
+their distance from the route start, routes which serve every stop and
+walking transfers between stops close to each other. The arrays are
+stored in JourneyGraph, so workers load them with one query instead of
+building them, and are dropped by signals when the network changes.
+
+Journeys are found by RAPTOR rounds: round k holds the earliest arrival
+at every stop with k rides. Buses have no timetable, so a ride costs
+JOURNEY_BOARD_WAIT minutes of waiting plus its distance at the average bus
+speed. Every route is scanned with NumPy: the best stop to board before
+every stop is a running minimum over the route. Stops of a circular route
+are listed for two laps, so rides past the route start are found too.
+"""
+import io
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from tracker.models import BusStop, JourneyGraph, StopOffset
+from .arrivals import bus_speed
+from .geometry import get_route_geometry
+from .metrics import hot_section
+from .offsets import build_stop_offsets
+from .spatial import StopIndex
+
+DEFAULT_MAX_RIDES = 4
+DEFAULT_BOARD_WAIT = 5
+DEFAULT_WALK_DISTANCE = 300
+DEFAULT_WALK_SPEED = 80
+ARRAYS = ('stop_ids', 'route_path_ids', 'route_start', 'route_stops',
+          'route_distances', 'stop_route_start', 'stop_positions',
+          'transfer_start', 'transfer_stops', 'transfer_distances')
+
+
+def _csr(groups: list, dtype) -> tuple:
+    """Return (start pointers, flat values) of lists of values."""
+    start = np.zeros(len(groups) + 1, dtype=np.int64)
+    start[1:] = np.cumsum([len(group) for group in groups])
+    values = np.fromiter((value for group in groups for value in group),
+                         dtype=dtype, count=int(start[-1]))
+    return start, values
+
+
+def _gather(start: np.ndarray, rows: np.ndarray) -> tuple:
+    """Return (row, entry) of every entry of the rows of a CSR array."""
+    counts = start[rows + 1] - start[rows]
+    offsets = np.cumsum(counts) - counts
+    entries = (np.arange(int(counts.sum()))
+               - np.repeat(offsets - start[rows], counts))
+    return np.repeat(rows, counts), entries
+
+
+def _smallest(keys: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Return indices of the smallest value of every key."""
+    order = np.lexsort((values, keys))
+    keys = keys[order]
+    return order[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else order
+
+
+class StopGraph:
+    """Arrays of routes, stops and transfers.
+
+    Attributes:
+    stop_ids: BusStop ids, stops are numbered by their position here.
+    route_path_ids: Path.path_id of every route.
+    route_start: Start of the stops of every route in route_stops.
+    route_stops: Stop numbers of every route sorted along the route, two
+    laps of a circular route.
+    route_distances: Distances of route_stops from the route start.
+    stop_route_start: Start of the routes of every stop in stop_positions.
+    stop_positions: Positions in route_stops where the stop is served.
+    transfer_start: Start of the transfers of every stop.
+    transfer_stops: Stop numbers reachable on foot.
+    transfer_distances: Walking distances in meters.
+    """
+
+    def __init__(self, **arrays):
+        """Create graph of the ARRAYS."""
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.numbers = {int(stop_id): number
+                        for number, stop_id in enumerate(self.stop_ids)}
+        self.route_of = np.repeat(np.arange(len(self.route_path_ids)),
+                                  np.diff(self.route_start))
+
+    @classmethod
+    def build(cls, walk_distance: float = None) -> 'StopGraph':
+        """Build graph from stops, their offsets and buses of routes."""
+        if walk_distance is None:
+            walk_distance = getattr(settings, 'JOURNEY_WALK_DISTANCE',
+                                    DEFAULT_WALK_DISTANCE)
+        served = {}
+        for stop_id, path_id in BusStop.buses.through.objects.values_list(
+                'busstop_id', 'vehicle__path_id').distinct():
+            served.setdefault(path_id, set()).add(stop_id)
+        offsets = dict(((stop_id, path_id), distance) for
+                       stop_id, path_id, distance in
+                       StopOffset.objects.filter(
+                           path_id__in=served.keys()).values_list(
+                           'stop_id', 'path_id', 'distance'))
+        missing = [path_id for path_id, stop_ids in served.items()
+                   if any((stop_id, path_id) not in offsets
+                          for stop_id in stop_ids)]
+        if missing:
+            build_stop_offsets(missing)
+            offsets.update(((stop_id, path_id), distance) for
+                           stop_id, path_id, distance in
+                           StopOffset.objects.filter(
+                               path_id__in=missing).values_list(
+                               'stop_id', 'path_id', 'distance'))
+
+        stops = list(BusStop.objects.values_list(
+            'id', 'name', 'location__latitude', 'location__longitude'))
+        numbers = {stop[0]: number for number, stop in enumerate(stops)}
+        path_ids, route_stops, route_distances = [], [], []
+        for path_id in sorted(served):
+            placed = sorted(
+                (offsets[stop_id, path_id], numbers[stop_id])
+                for stop_id in served[path_id]
+                if (stop_id, path_id) in offsets)
+            if len(placed) < 2:
+                continue
+            route = get_route_geometry(path_id)
+            if route.circular:
+                # Rides may go past the route start, so the stops of the
+                # next lap follow.
+                placed += [(distance + route.period, number)
+                           for distance, number in placed]
+            path_ids.append(path_id)
+            route_stops.append([number for _, number in placed])
+            route_distances.append([distance for distance, _ in placed])
+        route_start, flat_stops = _csr(route_stops, np.int64)
+        _, flat_distances = _csr(route_distances, float)
+
+        positions = [[] for _ in stops]
+        for position, number in enumerate(flat_stops.tolist()):
+            positions[number].append(position)
+        stop_route_start, stop_positions = _csr(positions, np.int64)
+
+        index = StopIndex(stop for stop in stops if stop[2] is not None)
+        transfers, walks = [], []
+        for stop_id, _, latitude, longitude in stops:
+            near = [] if latitude is None else [
+                (numbers[stop[0]], distance) for distance, stop in
+                index.within(latitude, longitude, walk_distance)
+                if stop[0] != stop_id]
+            transfers.append([number for number, _ in near])
+            walks.append([distance for _, distance in near])
+        transfer_start, transfer_stops = _csr(transfers, np.int64)
+        _, transfer_distances = _csr(walks, float)
+        return cls(
+            stop_ids=np.array([stop[0] for stop in stops], dtype=np.int64),
+            route_path_ids=np.array(path_ids, dtype=np.int64),
+            route_start=route_start, route_stops=flat_stops,
+            route_distances=flat_distances,
+            stop_route_start=stop_route_start,
+            stop_positions=stop_positions, transfer_start=transfer_start,
+            transfer_stops=transfer_stops,
+            transfer_distances=transfer_distances)
+
+    def to_bytes(self) -> bytes:
+        """Return arrays in the .npz format."""
+        buffer = io.BytesIO()
+        np.savez(buffer, **{name: getattr(self, name) for name in ARRAYS})
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data) -> 'StopGraph':
+        """Load graph saved by to_bytes."""
+        with np.load(io.BytesIO(bytes(data))) as arrays:
+            return cls(**{name: arrays[name] for name in ARRAYS})
+
+    @hot_section('journey_plan')
+    def plan(self, from_stop: int, to_stop: int, max_rides: int = None,
+             board_wait: float = None, speed: float = None,
+             walk_speed: float = None) -> list:
+        """Find the fastest journey for every number of rides.
+
+        Args:
+            from_stop (int): PrimaryKey of the first stop.
+            to_stop (int): PrimaryKey of the last stop.
+            max_rides (int): The maximum number of buses to take.
+            board_wait (float): Minutes of waiting for every bus.
+            speed (float): Bus speed in meters per minute.
+            walk_speed (float): Walking speed in meters per minute.
+
+        Returns:
+            Journeys faster than every journey with fewer rides, with the
+        number of rides, total minutes and bus and walk legs.
+
+        Raises:
+            KeyError if a stop is not in the graph.
+        """
+        if max_rides is None:
+            max_rides = getattr(settings, 'JOURNEY_MAX_RIDES',
+                                DEFAULT_MAX_RIDES)
+        if board_wait is None:
+            board_wait = getattr(settings, 'JOURNEY_BOARD_WAIT',
+                                 DEFAULT_BOARD_WAIT)
+        speed = speed or bus_speed()
+        if walk_speed is None:
+            walk_speed = getattr(settings, 'JOURNEY_WALK_SPEED',
+                                 DEFAULT_WALK_SPEED)
+        source, target = self.numbers[from_stop], self.numbers[to_stop]
+        size = len(self.stop_ids)
+        # Arrivals by any means and by bus: a stop reached on foot may
+        # still be worth reaching by bus to walk on from it.
+        best = np.full(size, np.inf)
+        best[source] = 0
+        best_ride = best.copy()
+        ridden = np.full(size, np.inf)
+        ridden[source] = 0
+        rounds = [self._walk(ridden, [source], best, target, walk_speed,
+                             None)]
+        journeys = []
+        if rounds[0][0][target] < np.inf:
+            journeys.append(self._journey(rounds, 0, target, speed,
+                                          walk_speed, board_wait))
+        for _ in range(max_rides):
+            labels, _, _, _, marked = rounds[-1]
+            if not len(marked):
+                break
+            ridden, ride_from, ride_route, improved = self._ride(
+                labels, marked, best, best_ride, target, speed,
+                board_wait)
+            label = self._walk(ridden, improved, best, target, walk_speed,
+                               (ride_from, ride_route))
+            rounds.append(label)
+            if label[0][target] < np.inf:
+                journeys.append(self._journey(
+                    rounds, len(rounds) - 1, target, speed, walk_speed,
+                    board_wait))
+        return journeys
+
+    def _ride(self, labels: np.ndarray, marked: np.ndarray,
+              best: np.ndarray, best_ride: np.ndarray, target: int,
+              speed: float, board_wait: float) -> tuple:
+        """Scan routes which serve marked stops, one round of rides."""
+        size = len(self.stop_ids)
+        ridden = np.full(size, np.inf)
+        ride_from = np.full(size, -1, dtype=np.int64)
+        ride_route = np.full(size, -1, dtype=np.int64)
+        _, entries = _gather(self.stop_route_start, marked)
+        positions = self.stop_positions[entries]
+        routes = self.route_of[positions]
+        earliest = _smallest(routes, positions)
+        for route, first in zip(routes[earliest].tolist(),
+                                positions[earliest].tolist()):
+            end = self.route_start[route + 1]
+            stops = self.route_stops[first:end]
+            times = self.route_distances[first:end] / speed
+            board = labels[stops] + board_wait - times
+            running = np.minimum.accumulate(board)
+            boarded = np.maximum.accumulate(np.where(
+                board <= running, np.arange(len(stops)), 0))
+            # Buses are boarded before the stop they are ridden to.
+            arrival = np.concatenate(([np.inf], running[:-1])) + times
+            boarded = np.concatenate(([0], boarded[:-1]))
+            better = np.flatnonzero(arrival < np.minimum(
+                np.minimum(best_ride[stops], ridden[stops]), best[target]))
+            if not len(better):
+                continue
+            # A stop served twice by a route keeps its earlier arrival.
+            better = better[_smallest(stops[better], arrival[better])]
+            ridden[stops[better]] = arrival[better]
+            ride_from[stops[better]] = stops[boarded[better]]
+            ride_route[stops[better]] = route
+        improved = np.flatnonzero(ridden < np.inf)
+        best_ride[improved] = ridden[improved]
+        best[improved] = np.minimum(best[improved], ridden[improved])
+        return ridden, ride_from, ride_route, improved
+
+    def _walk(self, ridden: np.ndarray, improved, best: np.ndarray,
+              target: int, walk_speed: float, ride: tuple) -> tuple:
+        """Walk from stops reached by the rides of the round.
+
+        Returns:
+            (labels, ride, walked, walk_from, marked) of the round.
+        """
+        walked = np.full(len(self.stop_ids), np.inf)
+        walk_from = np.full(len(self.stop_ids), -1, dtype=np.int64)
+        improved = np.asarray(improved, dtype=np.int64)
+        origins, entries = _gather(self.transfer_start, improved)
+        near = self.transfer_stops[entries]
+        times = ridden[origins] + self.transfer_distances[entries] / (
+            walk_speed)
+        fastest = _smallest(near, times)
+        near, times, origins = near[fastest], times[fastest], origins[fastest]
+        better = times < np.minimum(best[near], best[target])
+        walked[near[better]] = times[better]
+        walk_from[near[better]] = origins[better]
+        labels = np.minimum(ridden, walked)
+        marked = np.flatnonzero(walked < np.inf)
+        best[marked] = np.minimum(best[marked], walked[marked])
+        marked = np.union1d(marked, improved)
+        return labels, ride, walked, walk_from, marked
+
+    def _journey(self, rounds: list, rides: int, target: int, speed: float,
+                 walk_speed: float, board_wait: float) -> dict:
+        legs = []
+        stop = target
+        for number in range(rides, -1, -1):
+            labels, ride, walked, walk_from, _ = rounds[number]
+            if walk_from[stop] >= 0 and walked[stop] == labels[stop]:
+                start = int(walk_from[stop])
+                distance = self._walk_distance(start, stop)
+                legs.append({'mode': 'walk',
+                             'from': int(self.stop_ids[start]),
+                             'to': int(self.stop_ids[stop]),
+                             'distance': round(distance),
+                             'minutes': round(distance / walk_speed)})
+                stop = start
+            if ride is None:
+                break
+            ride_from, ride_route = ride
+            start, route = int(ride_from[stop]), int(ride_route[stop])
+            distance = self._route_distance(route, start, stop)
+            legs.append({'mode': 'bus',
+                         'path_id': int(self.route_path_ids[route]),
+                         'from': int(self.stop_ids[start]),
+                         'to': int(self.stop_ids[stop]),
+                         'distance': round(distance),
+                         'wait': round(board_wait),
+                         'minutes': round(distance / speed)})
+            stop = start
+        legs.reverse()
+        return {'rides': rides,
+                'minutes': round(float(rounds[rides][0][target])),
+                'legs': legs}
+
+    def _walk_distance(self, start: int, stop: int) -> float:
+        begin, end = (self.transfer_start[start],
+                      self.transfer_start[start + 1])
+        near = self.transfer_stops[begin:end]
+        return float(self.transfer_distances[begin:end][near == stop][0])
+
+    def _route_distance(self, route: int, start: int, stop: int) -> float:
+        begin, end = self.route_start[route], self.route_start[route + 1]
+        stops = self.route_stops[begin:end]
+        distances = self.route_distances[begin:end]
+        board = int(np.flatnonzero(stops == start)[0])
+        alight = board + int(np.flatnonzero(stops[board:] == stop)[0])
+        return float(distances[alight] - distances[board])
+
+
+_graph = None
+_graph_id = None
+_lock = threading.Lock()
+
+
+def get_graph() -> StopGraph:
+    """Return the stored graph, building and storing it if there is none.
+
+    One query checks that the graph held by this process is the latest.
+    """
+    global _graph, _graph_id
+    latest = JourneyGraph.objects.order_by('-id').values_list(
+        'id', flat=True).first()
+    if latest is not None and latest == _graph_id:
+        return _graph
+    with _lock:
+        data = None
+        if latest is not None:
+            data = JourneyGraph.objects.filter(pk=latest).values_list(
+                'data', flat=True).first()
+        if data is not None:
+            graph = StopGraph.from_bytes(data)
+        else:
+            graph = StopGraph.build()
+            latest = JourneyGraph.objects.create(data=graph.to_bytes()).pk
+            JourneyGraph.objects.filter(id__lt=latest).delete()
+        _graph, _graph_id = graph, latest
+        return graph
+
+
+def invalidate_graph() -> None:
+    """Drop the stored graph, it will be rebuilt on the next query."""
+    global _graph, _graph_id
+    with _lock:
+        _graph, _graph_id = None, None
+    JourneyGraph.objects.all().delete()
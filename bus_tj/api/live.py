@@ -0,0 +1,323 @@
+"""Live state of vehicles shared by the workers of a node.
+
+Every vehicle is a fixed-size record in a memory-mapped file: route,
+matched route point, distance along the route, position and time of the
+last fix. Records are placed by open addressing on the vehicle id, so any
+worker which maps the file finds a vehicle without asking the database.
+
+Readers take no locks: every record carries a sequence number which is
+odd while the record is written, and a reader retries until it copies the
+record between two equal even numbers. Writers of all workers serialize on
+an flock of the file. Locations and distances are written to the database
+behind the fixes, in batches of LIVE_STATE_BATCH_SIZE vehicles, every
+LIVE_STATE_FLUSH_INTERVAL seconds by a thread of the process, and when the
+process exits.
+"""
+import atexit
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import numpy as np
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+
+from tracker.models import Vehicle
+
+logger = logging.getLogger(__name__)
+
+RECORD = np.dtype([('seq', '<u8'), ('id', '<i8'), ('path_id', '<i8'),
+                   ('location_id', '<i8'), ('distance', '<f8'),
+                   ('latitude', '<f8'), ('longitude', '<f8'),
+                   ('timestamp', '<f8')])
+EMPTY = 0
+REMOVED = -1
+NO_LOCATION = -1
+DEFAULT_CAPACITY = 1 << 16
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 5
+READ_ATTEMPTS = 100
+
+
+class LiveVehicle(NamedTuple):
+    """Live state of a vehicle.
+
+    Attributes:
+    id (int): PrimaryKey of the vehicle.
+    path_id (int): The id of the route of the vehicle.
+    location_id (int): The route point the vehicle is at, or None.
+    distance (float): The distance from the route start, or None.
+    latitude (float): The latitude of the last fix, or None.
+    longitude (float): The longitude of the last fix, or None.
+    timestamp (float): Unix time of the last fix, or None.
+    """
+
+    id: int
+    path_id: int
+    location_id: int
+    distance: float
+    latitude: float
+    longitude: float
+    timestamp: float
+
+
+def _none_if_nan(value: float):
+    return None if value != value else value
+
+
+class LiveState:
+    """Vehicle records in a memory-mapped file.
+
+    Settings:
+        LIVE_STATE_PATH: The file, workers which share it share the state.
+        LIVE_STATE_CAPACITY: The number of records, it must stay above the
+    number of vehicles. Every worker must use the same value.
+        LIVE_STATE_BATCH_SIZE: Vehicles written to the database at once.
+        LIVE_STATE_FLUSH_INTERVAL: Seconds between database writes.
+    """
+
+    def __init__(self):
+        """Create state, the file is mapped on first use."""
+        self._records = None
+        self._fd = None
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._flushed = time.monotonic()
+        self._flusher_pid = None
+
+    def _open(self) -> np.ndarray:
+        if self._records is not None:
+            return self._records
+        with self._lock:
+            if self._records is not None:
+                return self._records
+            path = os.fspath(getattr(
+                settings, 'LIVE_STATE_PATH',
+                os.path.join(tempfile.gettempdir(), 'bus_tj_live.bin')))
+            capacity = getattr(settings, 'LIVE_STATE_CAPACITY',
+                               DEFAULT_CAPACITY)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != capacity * RECORD.itemsize:
+                    # New file or another capacity, start empty.
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, capacity * RECORD.itemsize)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._fd = fd
+            self._records = np.memmap(path, dtype=RECORD, mode='r+',
+                                      shape=(capacity,))
+            return self._records
+
+    @contextmanager
+    def _writing(self):
+        records = self._open()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield records
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _find(records: np.ndarray, vehicle_id: int) -> int:
+        """Return slot of the vehicle or -1, REMOVED slots are skipped."""
+        ids = records['id']
+        capacity = len(records)
+        slot = vehicle_id % capacity
+        for _ in range(capacity):
+            found = ids[slot]
+            if found == vehicle_id:
+                return slot
+            if found == EMPTY:
+                return -1
+            slot = (slot + 1) % capacity
+        return -1
+
+    def get(self, vehicle_id: int) -> LiveVehicle:
+        """Return live state of the vehicle or None if it isn't known."""
+        records = self._open()
+        sequences = records['seq']
+        for _ in range(READ_ATTEMPTS):
+            slot = self._find(records, vehicle_id)
+            if slot < 0:
+                return None
+            before = int(sequences[slot])
+            if before % 2:
+                continue
+            record = records[slot].item()
+            if int(sequences[slot]) != before:
+                continue
+            if record[1] != vehicle_id:
+                # The slot was reused between the lookup and the copy.
+                continue
+            _, _, path_id, location_id, *values = record
+            return LiveVehicle(
+                vehicle_id, path_id,
+                None if location_id == NO_LOCATION else location_id,
+                *(_none_if_nan(value) for value in values))
+        return None
+
+    def get_many(self, vehicle_ids) -> dict:
+        """Return live states of the known vehicles keyed by id."""
+        found = {}
+        for vehicle_id in vehicle_ids:
+            vehicle = self.get(vehicle_id)
+            if vehicle is not None:
+                found[vehicle_id] = vehicle
+        return found
+
+    def timestamps(self) -> tuple:
+        """Return ids and fix times of the known vehicles, NaN if no fix.
+
+        The arrays are read without locks, a record being written may be
+        missed and is seen by a later call.
+        """
+        records = self._open()
+        ids = records['id'].copy()
+        stamps = records['timestamp'].copy()
+        known = ids > 0
+        return ids[known], stamps[known]
+
+    def put_many(self, vehicles: list) -> list:
+        """Store LiveVehicle records, every vehicle must be in the database.
+
+        A record whose fix is older than the stored one is skipped, fixes
+        may come late and out of order. Locations and distances of the
+        vehicles are written to the database later.
+
+        Returns:
+            The stored records.
+        """
+        stored = []
+        with self._writing() as records:
+            sequences = records['seq']
+            for vehicle in vehicles:
+                slot = self._find(records, vehicle.id)
+                if slot < 0:
+                    slot = self._free_slot(records, vehicle.id)
+                elif vehicle.timestamp is not None and (
+                        records['timestamp'][slot] > vehicle.timestamp):
+                    continue
+                sequences[slot] += 1
+                records[slot] = (
+                    sequences[slot], vehicle.id, vehicle.path_id,
+                    NO_LOCATION if vehicle.location_id is None
+                    else vehicle.location_id,
+                    *(np.nan if value is None else value
+                      for value in vehicle[3:]))
+                sequences[slot] += 1
+                stored.append(vehicle)
+            self._dirty.update(vehicle.id for vehicle in stored)
+            self._start_flusher()
+            due = len(self._dirty) >= getattr(
+                settings, 'LIVE_STATE_BATCH_SIZE', DEFAULT_BATCH_SIZE
+            ) or time.monotonic() - self._flushed >= getattr(
+                settings, 'LIVE_STATE_FLUSH_INTERVAL',
+                DEFAULT_FLUSH_INTERVAL)
+        if due:
+            self.flush()
+        return stored
+
+    def _start_flusher(self) -> None:
+        """Start the flush thread of this process, once after a fork too."""
+        if self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_periodically,
+                         name='live-state-flush', daemon=True).start()
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(getattr(settings, 'LIVE_STATE_FLUSH_INTERVAL',
+                               DEFAULT_FLUSH_INTERVAL))
+            if not self._dirty:
+                continue
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush the live state.')
+
+    @staticmethod
+    def _free_slot(records: np.ndarray, vehicle_id: int) -> int:
+        ids = records['id']
+        capacity = len(records)
+        slot = vehicle_id % capacity
+        for _ in range(capacity):
+            if ids[slot] in (EMPTY, REMOVED):
+                return slot
+            slot = (slot + 1) % capacity
+        raise OverflowError('LIVE_STATE_CAPACITY is too small.')
+
+    def remove(self, vehicle_id: int) -> None:
+        """Forget the vehicle, e.g. when it's deleted or edited."""
+        with self._writing() as records:
+            slot = self._find(records, vehicle_id)
+            if slot < 0:
+                return
+            records['seq'][slot] += 1
+            records['id'][slot] = REMOVED
+            records['seq'][slot] += 1
+            self._dirty.discard(vehicle_id)
+
+    def remove_routes(self, path_ids) -> None:
+        """Forget vehicles of the routes, e.g. when their points change."""
+        with self._writing() as records:
+            changed = np.flatnonzero(
+                (records['id'] > 0)
+                & np.isin(records['path_id'], list(path_ids)))
+            if not len(changed):
+                return
+            records['seq'][changed] += 1
+            records['id'][changed] = REMOVED
+            records['seq'][changed] += 1
+
+    def clear(self) -> None:
+        """Forget every vehicle, e.g. after bulk writes."""
+        with self._writing() as records:
+            records['seq'] += 1
+            records['id'] = EMPTY
+            records['seq'] += 1
+            self._dirty.clear()
+
+    def close(self) -> None:
+        """Unmap the file, next use maps LIVE_STATE_PATH again.
+
+        Changes which weren't flushed are forgotten.
+        """
+        with self._lock:
+            if self._fd is not None:
+                # The mapping goes when its last reader drops it.
+                os.close(self._fd)
+            self._records = None
+            self._fd = None
+            self._dirty.clear()
+
+    def flush(self) -> None:
+        """Write locations and distances this process changed."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            self._flushed = time.monotonic()
+        vehicles = [
+            Vehicle(id=vehicle.id, location_id=vehicle.location_id,
+                    distance=vehicle.distance)
+            for vehicle in self.get_many(dirty).values()
+        ]
+        if not vehicles:
+            return
+        try:
+            Vehicle.objects.bulk_update(vehicles, ['location', 'distance'],
+                                        batch_size=1000)
+        except DatabaseError:
+            logger.exception(f'Failed to write {len(vehicles)} vehicles.')
+
+
+live_state = LiveState()
+atexit.register(live_state.flush)
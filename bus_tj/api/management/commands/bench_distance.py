@@ -0,0 +1,68 @@
+"""Compare vectorized distance kernel with the per-row geopy loop."""
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from geopy.distance import geodesic
+
+from api import distance
+
+
+def best_time(function, repeat: int) -> float:
+    """Return the best wall time of function in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class Command(BaseCommand):
+    """Benchmark distance computation against N random points."""
+
+    help = 'Compare api.distance with a geopy.geodesic loop.'
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+            help='Numbers of candidate points.')
+        parser.add_argument(
+            '--repeat', type=int, default=3,
+            help='Runs per measurement, the best one is reported.')
+        parser.add_argument(
+            '--seed', type=int, default=0, help='Random seed.')
+
+    def handle(self, *args, **options):
+        """Run benchmark and print a table."""
+        rng = np.random.default_rng(options['seed'])
+        origin = (38.56, 68.78)
+        self.stdout.write(
+            f'{"points":>8} {"geopy loop":>12} {"haversine":>12} '
+            f'{"nearest":>12} {"refined":>12} {"speedup":>9}')
+        for size in options['sizes']:
+            lats = origin[0] + rng.uniform(-0.1, 0.1, size)
+            lons = origin[1] + rng.uniform(-0.1, 0.1, size)
+
+            def geopy_loop():
+                distances = {}
+                for lat, lon in zip(lats, lons):
+                    distances[geodesic(origin, (lat, lon)).meters] = lat
+                return sorted(distances)[:4]
+
+            loop = best_time(geopy_loop, options['repeat'])
+            kernel = best_time(
+                lambda: distance.haversine(*origin, lats, lons),
+                options['repeat'])
+            nearest = best_time(
+                lambda: distance.nearest(*origin, lats, lons, 4),
+                options['repeat'])
+            refined = best_time(
+                lambda: distance.nearest(*origin, lats, lons, 4,
+                                         refine=True),
+                options['repeat'])
+            self.stdout.write(
+                f'{size:>8} {loop * 1000:>10.2f}ms {kernel * 1000:>10.3f}ms '
+                f'{nearest * 1000:>10.3f}ms {refined * 1000:>10.3f}ms '
+                f'{loop / refined:>8.0f}x')
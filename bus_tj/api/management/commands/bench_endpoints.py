@@ -0,0 +1,260 @@
+"""Measure latency and query counts of the API at several city sizes."""
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import django
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import (CaptureQueriesContext, override_settings,
+                               setup_test_environment,
+                               teardown_test_environment)
+from django.utils import timezone
+
+from api.city import CENTER, generate_city
+from api.history import history_buffer
+from api.live import live_state
+from api.views import calculate_distance
+from tracker.models import BusStop, Path
+
+DUMMY_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+}
+METRICS = ('p50', 'p95', 'p99')
+
+
+def git_commit() -> str:
+    """Return the current commit or None outside of a git checkout."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(times: list, queries: list) -> dict:
+    """Return latency percentiles in ms and mean queries per call."""
+    times = np.array(times) * 1000
+    return {
+        'calls': len(times),
+        'mean': round(float(times.mean()), 3),
+        'p50': round(float(np.percentile(times, 50)), 3),
+        'p95': round(float(np.percentile(times, 95)), 3),
+        'p99': round(float(np.percentile(times, 99)), 3),
+        'queries': round(float(np.mean(queries)), 2),
+    }
+
+
+class Command(BaseCommand):
+    """Benchmark endpoints against synthetic cities in a test database."""
+
+    help = ('Generate synthetic cities of --sizes stops in a test database '
+            'and report p50/p95/p99 latency and queries of every endpoint.')
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[100, 1000, 10000],
+            help='Numbers of stops; routes and buses scale with them.')
+        parser.add_argument(
+            '--points', type=int, default=200,
+            help='Path points of every route.')
+        parser.add_argument(
+            '--calls', type=int, default=200,
+            help='Measured calls per endpoint.')
+        parser.add_argument(
+            '--warmup', type=int, default=10,
+            help='Calls per endpoint made before measuring.')
+        parser.add_argument(
+            '--cache', action='store_true',
+            help='Use the configured response cache, by default it is '
+            'replaced with a dummy one to measure the database path.')
+        parser.add_argument(
+            '--seed', type=int, default=0, help='Random seed.')
+        parser.add_argument(
+            '--output', help='Write the JSON report to this file.')
+        parser.add_argument(
+            '--compare',
+            help='JSON report of an earlier run to compare with.')
+        parser.add_argument(
+            '--threshold', type=float, default=20,
+            help='Percent of p95 or queries growth reported as a '
+            'regression.')
+
+    def handle(self, *args, **options):
+        """Run benchmark, print a table and write the report."""
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False)
+        # The live state of the test buses must not reach the file which
+        # the workers of the real database map.
+        directory = tempfile.TemporaryDirectory()
+        live_state.close()
+        try:
+            with override_settings(LIVE_STATE_PATH=os.path.join(
+                    directory.name, 'live_state.bin')):
+                if options['cache']:
+                    results = self.run_sizes(options)
+                else:
+                    with override_settings(CACHES=DUMMY_CACHES):
+                        results = self.run_sizes(options)
+        finally:
+            history_buffer.flush()
+            live_state.flush()
+            live_state.close()
+            directory.cleanup()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+        report = {
+            'commit': git_commit(),
+            'created': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'cache': options['cache'],
+            'results': results,
+        }
+        self.print_table(results)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump(report, file, indent=2)
+        if options['compare']:
+            self.compare(options['compare'], results, options['threshold'])
+
+    def run_sizes(self, options) -> list:
+        """Generate every size on top of the previous one and measure."""
+        rng = np.random.default_rng(options['seed'])
+        results = []
+        created = 0
+        for size in sorted(options['sizes']):
+            stops = size - created
+            routes = max(1, stops // 25)
+            generate_city(stops, routes, options['points'], routes * 3,
+                          seed=options['seed'] + size)
+            created = size
+            for endpoint, call in self.endpoints(rng):
+                for _ in range(options['warmup']):
+                    call()
+                times, queries = [], []
+                for _ in range(options['calls']):
+                    with CaptureQueriesContext(connection) as context:
+                        started = time.perf_counter()
+                        call()
+                        times.append(time.perf_counter() - started)
+                    queries.append(len(context.captured_queries))
+                results.append(dict(summarize(times, queries),
+                                    size=size, endpoint=endpoint))
+        return results
+
+    def endpoints(self, rng: np.random.Generator) -> list:
+        """Return (name, call) of every benchmarked endpoint."""
+        client = Client()
+        stops = list(BusStop.objects.values_list(
+            'id', 'buses__id').exclude(buses=None))
+        stop_ids = sorted({stop_id for stop_id, _ in stops})
+        points = list(Path.objects.values_list(
+            'location__latitude', 'location__longitude'))
+
+        def pick(items):
+            return items[rng.integers(len(items))]
+
+        def check(response):
+            if response.status_code != 200:
+                raise CommandError(
+                    f'{response.request["PATH_INFO"]} returned '
+                    f'{response.status_code}.')
+            return response
+
+        def stop_list():
+            latitude, longitude = np.array(CENTER) + rng.uniform(
+                -0.05, 0.05, 2)
+            check(client.get('/api/stop/', {'latitude': latitude,
+                                            'longitude': longitude}))
+
+        def bus_update():
+            stop_id, bus_id = pick(stops)
+            latitude, longitude = pick(points)
+            check(client.put(f'/api/bus/{bus_id}/', {
+                'latitude': latitude, 'longitude': longitude,
+            }, content_type='application/json'))
+
+        def bus_bulk():
+            fixes = []
+            for _ in range(100):
+                _, bus_id = pick(stops)
+                latitude, longitude = pick(points)
+                fixes.append({'vehicle_id': bus_id, 'lat': latitude,
+                              'lon': longitude})
+            check(client.post('/api/bus/bulk/', fixes,
+                              content_type='application/json'))
+
+        def location_list():
+            stop_id, bus_id = pick(stops)
+            check(client.get('/api/location/', {'bus': bus_id,
+                                                'stop': stop_id}))
+
+        def distance():
+            stop_id, bus_id = pick(stops)
+            calculate_distance(bus_id, stop_id)
+
+        return [
+            ('stop-list', stop_list),
+            ('stop-retrieve', lambda: check(client.get(
+                f'/api/stop/{pick(stop_ids)}/'))),
+            ('stop-arrivals', lambda: check(client.get(
+                f'/api/stop/{pick(stop_ids)}/arrivals/'))),
+            ('bus-list', lambda: check(client.get(
+                '/api/bus/', {'stop': pick(stop_ids)}))),
+            ('bus-retrieve', lambda: check(client.get(
+                f'/api/bus/{pick(stops)[1]}/'))),
+            ('bus-update', bus_update),
+            ('bus-bulk', bus_bulk),
+            ('location-list', location_list),
+            ('calculate-distance', distance),
+        ]
+
+    def print_table(self, results: list) -> None:
+        """Print results, latencies are in ms."""
+        self.stdout.write(
+            f'{"size":>7} {"endpoint":<20} {"p50":>9} {"p95":>9} '
+            f'{"p99":>9} {"queries":>8}')
+        for result in results:
+            self.stdout.write(
+                f'{result["size"]:>7} {result["endpoint"]:<20} '
+                f'{result["p50"]:>9.3f} {result["p95"]:>9.3f} '
+                f'{result["p99"]:>9.3f} {result["queries"]:>8.2f}')
+
+    def compare(self, path: str, results: list, threshold: float) -> None:
+        """Print ratios to an earlier report and fail on regressions."""
+        with open(path, encoding='utf-8') as file:
+            baseline = json.load(file)
+        previous = {(result['size'], result['endpoint']): result
+                    for result in baseline['results']}
+        self.stdout.write(f'\nCompared with {baseline.get("commit")}:')
+        regressions = []
+        for result in results:
+            old = previous.get((result['size'], result['endpoint']))
+            if old is None:
+                continue
+            ratios = ' '.join(
+                f'{metric} x{result[metric] / old[metric]:.2f}'
+                if old[metric] else f'{metric} -' for metric in METRICS)
+            queries = result['queries'] - old['queries']
+            # Mean queries vary a little with the random calls.
+            regressed = any(
+                result[metric] > old[metric] * (1 + threshold / 100) + slack
+                for metric, slack in (('p95', 0), ('queries', 0.5)))
+            if regressed:
+                regressions.append(f'{result["size"]} {result["endpoint"]}')
+            self.stdout.write(
+                f'{result["size"]:>7} {result["endpoint"]:<20} {ratios} '
+                f'queries {queries:+.2f}{" REGRESSION" if regressed else ""}')
+        if regressions:
+            raise CommandError(f'{len(regressions)} regressions: '
+                               f'{", ".join(regressions)}.')
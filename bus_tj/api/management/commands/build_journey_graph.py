@@ -0,0 +1,24 @@
+"""Build the journey planner graph ahead of the first journey request."""
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.journey import get_graph, invalidate_graph
+
+
+class Command(BaseCommand):
+    """Rebuild and store the route and stop arrays of the planner."""
+
+    help = ('Build route, stop and transfer arrays of the journey planner '
+            'from the network and store them for every worker.')
+
+    def handle(self, *args, **options):
+        """Build graph and print its size."""
+        started = time.perf_counter()
+        invalidate_graph()
+        graph = get_graph()
+        self.stdout.write(
+            f'Built graph of {len(graph.stop_ids)} stops, '
+            f'{len(graph.route_path_ids)} routes and '
+            f'{len(graph.transfer_stops)} transfers in '
+            f'{time.perf_counter() - started:.1f} s.')
@@ -0,0 +1,21 @@
+"""Place stops on routes ahead of the first distance requests."""
+from django.core.management.base import BaseCommand
+
+from api.offsets import build_stop_offsets
+
+
+class Command(BaseCommand):
+    """Store distances of stops from the start of their routes."""
+
+    help = ('Store offsets of the stops served by the buses of every route '
+            'or of the given routes.')
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument('path_ids', nargs='*', type=int,
+                            help='Routes to place stops on.')
+
+    def handle(self, *args, **options):
+        """Build offsets and print their number."""
+        count = build_stop_offsets(options['path_ids'] or None)
+        self.stdout.write(f'Stored {count} stop offsets.')
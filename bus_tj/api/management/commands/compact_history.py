@@ -0,0 +1,44 @@
+"""Downsample and expire the location history."""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api import history
+
+
+class Command(BaseCommand):
+    """Downsample old raw history and delete expired history."""
+
+    help = ('Keep one fix per --resolution seconds in partitions older '
+            'than --raw-days and delete partitions older than '
+            '--retention-days.')
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            '--raw-days', type=float,
+            default=getattr(settings, 'HISTORY_RAW_DAYS',
+                            history.DEFAULT_RAW_DAYS),
+            help='Days every fix is kept.')
+        parser.add_argument(
+            '--resolution', type=int,
+            default=getattr(settings, 'HISTORY_RESOLUTION',
+                            history.DEFAULT_RESOLUTION),
+            help='Seconds between fixes kept after --raw-days.')
+        parser.add_argument(
+            '--retention-days', type=float,
+            default=getattr(settings, 'HISTORY_RETENTION_DAYS',
+                            history.DEFAULT_RETENTION_DAYS),
+            help='Days history is kept.')
+
+    def handle(self, *args, **options):
+        """Compact history and print what was done."""
+        now = timezone.now()
+        downsampled, deleted = history.compact(
+            now - timedelta(days=options['raw_days']),
+            now - timedelta(days=options['retention_days']),
+            options['resolution'])
+        self.stdout.write(f'Downsampled {downsampled} chunks, deleted '
+                          f'{deleted} chunks.')
@@ -0,0 +1,41 @@
+"""Fill the database with a synthetic network."""
+from django.core.management.base import BaseCommand, CommandError
+
+from api.city import DEFAULT_SPACING, generate_city
+
+
+class Command(BaseCommand):
+    """Create stops, routes and buses of a synthetic city."""
+
+    help = ('Create a synthetic network next to the existing data: routes '
+            'of Path points, stops on them and buses which serve them.')
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument(
+            '--stops', type=int, default=1000, help='Number of stops.')
+        parser.add_argument(
+            '--routes', type=int, default=40, help='Number of routes.')
+        parser.add_argument(
+            '--points', type=int, default=200,
+            help='Path points of every route.')
+        parser.add_argument(
+            '--vehicles', type=int, default=120, help='Number of buses.')
+        parser.add_argument(
+            '--spacing', type=float, default=DEFAULT_SPACING,
+            help='Meters between route points.')
+        parser.add_argument(
+            '--seed', type=int, default=0, help='Random seed.')
+
+    def handle(self, *args, **options):
+        """Generate the city and print what was created."""
+        try:
+            city = generate_city(
+                options['stops'], options['routes'], options['points'],
+                options['vehicles'], options['seed'], options['spacing'])
+        except ValueError as error:
+            raise CommandError(str(error))
+        self.stdout.write(
+            f'Created {len(city["path_ids"])} routes, '
+            f'{len(city["stop_ids"])} stops and '
+            f'{len(city["vehicle_ids"])} buses.')
@@ -0,0 +1,40 @@
+"""Import a GTFS static feed."""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.gtfs import GtfsError, GtfsImporter
+
+
+class Command(BaseCommand):
+    """Import stops, routes and their buses from a GTFS zip archive."""
+
+    help = ('Import a GTFS zip archive. Importing the feed again applies '
+            'only the changes.')
+
+    def add_arguments(self, parser):
+        """Add command arguments."""
+        parser.add_argument('path', help='The GTFS zip archive.')
+        parser.add_argument(
+            '--feed', default='default',
+            help='The name of the feed, objects of other feeds are kept.')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Import even if the archive hasn\'t changed.')
+
+    def handle(self, *args, **options):
+        """Import the feed and print what was changed."""
+        started = time.perf_counter()
+        try:
+            stats = GtfsImporter(options['path'], options['feed']).run(
+                options['force'])
+        except (GtfsError, OSError, ValueError) as error:
+            raise CommandError(str(error))
+        if not stats:
+            self.stdout.write('The feed hasn\'t changed.')
+            return
+        for kind, counts in stats.items():
+            self.stdout.write(
+                f'{kind}: {counts["created"]} created, '
+                f'{counts["updated"]} updated, {counts["deleted"]} deleted')
+        self.stdout.write(f'Imported in {time.perf_counter() - started:.1f}s.')
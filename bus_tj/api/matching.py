@@ -0,0 +1,140 @@
+"""Map matching of GPS fixes onto vehicle routes."""
+import math
+from typing import NamedTuple
+
+import numpy as np
+
+from .distance import METERS_PER_DEGREE
+from .geometry import get_route_geometry
+from .metrics import hot_section
+from .spatial import Grid
+
+DEFAULT_SEGMENT_CELL_SIZE = 200
+
+
+class Match(NamedTuple):
+    """Result of snapping a point onto a route.
+
+    Attributes:
+    distance (float): Interpolated distance from the start of the route.
+    location_id (int): The location of the route point nearest to the match.
+    offset (float): Distance between the point and the route in meters.
+    """
+
+    distance: float
+    location_id: int
+    offset: float
+
+
+class RouteIndex:
+    """Segment index of one route.
+
+    Points are projected onto a local plane around the route, so segment
+    projection is plain vector math over NumPy arrays. Segments are put
+    into every grid cell their bounding box covers, which makes a lookup
+    touch only the few cells around the fix instead of the whole route.
+
+    Attributes:
+    route (RouteGeometry): The geometry of the route.
+    cell_size (float): The side of a grid cell in meters.
+    """
+
+    def __init__(self, route, cell_size: float = DEFAULT_SEGMENT_CELL_SIZE):
+        """Build index.
+
+        Args:
+            route (RouteGeometry): The geometry of the route.
+            cell_size (float): The side of a grid cell in meters.
+        """
+        self.route = route
+        self.cell_size = cell_size
+        ref_lat = float(route.latitudes.mean()) if len(route) else 0.0
+        self._kx = METERS_PER_DEGREE * math.cos(math.radians(ref_lat))
+        self._ky = METERS_PER_DEGREE
+        x, y = self._to_plane(route.latitudes, route.longitudes)
+        if len(route) == 1:
+            start, end = np.zeros(1, dtype=int), np.zeros(1, dtype=int)
+        else:
+            start = np.arange(len(route) - 1)
+            end = start + 1
+        self._start, self._end = start, end
+        self._x1, self._y1 = x[start], y[start]
+        self._dx, self._dy = x[end] - x[start], y[end] - y[start]
+        self._length_sq = self._dx ** 2 + self._dy ** 2
+        self._grid = Grid()
+        min_cx, min_cy = self._cell(np.minimum(x[start], x[end]),
+                                    np.minimum(y[start], y[end]))
+        max_cx, max_cy = self._cell(np.maximum(x[start], x[end]),
+                                    np.maximum(y[start], y[end]))
+        for number in range(len(start)):
+            for cx in range(min_cx[number], max_cx[number] + 1):
+                for cy in range(min_cy[number], max_cy[number] + 1):
+                    self._grid.add((cx, cy), number)
+
+    def __len__(self) -> int:
+        """Return number of route points."""
+        return len(self.route)
+
+    def _to_plane(self, latitude, longitude) -> tuple:
+        return longitude * self._kx, latitude * self._ky
+
+    def _cell(self, x, y) -> tuple:
+        return (np.floor(x / self.cell_size).astype(int),
+                np.floor(y / self.cell_size).astype(int))
+
+    def _project(self, numbers: np.ndarray, px: float, py: float) -> tuple:
+        """Return squared distances to the segments and positions on them."""
+        dx, dy = self._dx[numbers], self._dy[numbers]
+        x1, y1 = self._x1[numbers], self._y1[numbers]
+        length_sq = self._length_sq[numbers]
+        dot = (px - x1) * dx + (py - y1) * dy
+        t = np.divide(dot, length_sq, out=np.zeros_like(dot),
+                      where=length_sq > 0)
+        t = np.clip(t, 0.0, 1.0)
+        ex, ey = x1 + t * dx - px, y1 + t * dy - py
+        return ex * ex + ey * ey, t
+
+    @hot_section('snap')
+    def snap(self, latitude: float, longitude: float) -> Match:
+        """Snap point onto the nearest segment of the route.
+
+        Returns:
+            Match or None if the route has no points.
+        """
+        px, py = self._to_plane(latitude, longitude)
+        best = None
+        cx, cy = self._cell(px, py)
+        for r, numbers in self._grid.rings(int(cx), int(cy)):
+            if numbers:
+                numbers = np.asarray(numbers)
+                dist_sq, t = self._project(numbers, px, py)
+                i = int(np.argmin(dist_sq))
+                if best is None or dist_sq[i] < best[0]:
+                    best = (float(dist_sq[i]), int(numbers[i]), float(t[i]))
+            # Every segment in unseen cells is at least r cells away.
+            if best is not None and best[0] <= (r * self.cell_size) ** 2:
+                break
+        if best is None:
+            return None
+        dist_sq, number, t = best
+        start, end = self._start[number], self._end[number]
+        distances = self.route.distances
+        return Match(
+            distance=float(distances[start]
+                           + t * (distances[end] - distances[start])),
+            location_id=int(self.route.location_ids[
+                start if t < 0.5 else end]),
+            offset=math.sqrt(dist_sq),
+        )
+
+
+def get_route_index(path_id: int) -> RouteIndex:
+    """Return segment index of the route from the route cache.
+
+    Returns:
+        RouteIndex or None if the route has no points.
+    """
+    route = get_route_geometry(path_id)
+    if not len(route):
+        return None
+    return route.index
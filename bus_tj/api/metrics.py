@@ -0,0 +1,235 @@
+"""Request, database and hot section metrics in Prometheus format.
+
+Metrics live in the memory of the process, so with several workers every
+worker is scraped on its own, e.g. through a port per worker.
+"""
+import bisect
+import cProfile
+import heapq
+import os
+import random
+import re
+import threading
+import time
+from contextlib import ContextDecorator, ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _format_labels(labels: tuple) -> str:
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+
+
+class Histogram:
+    """Prometheus histogram with labels."""
+
+    def __init__(self, name: str, description: str, buckets: tuple):
+        """Create histogram.
+
+        Args:
+            name (str): The metric name.
+            description (str): The HELP text.
+            buckets (tuple): Sorted upper bounds of buckets.
+        """
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        """Record one value."""
+        key = tuple(sorted(labels.items()))
+        number = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            series[0][number] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        """Return lines of the text exposition format."""
+        with self._lock:
+            series = {key: (list(counts), total)
+                      for key, (counts, total) in self._series.items()}
+        lines = [f'# HELP {self.name} {self.description}',
+                 f'# TYPE {self.name} histogram']
+        for key, (counts, total) in sorted(series.items()):
+            labels = _format_labels(key)
+            prefix = f'{labels},' if labels else ''
+            seen = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                seen += count
+                lines.append(
+                    f'{self.name}_bucket{{{prefix}le="{bound}"}} {seen}')
+            labels = f'{{{labels}}}' if labels else ''
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {seen}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    'bus_tj_request_seconds', 'Time to handle a request.', LATENCY_BUCKETS)
+DB_QUERIES = Histogram(
+    'bus_tj_db_queries', 'Database queries of a request.', QUERY_BUCKETS)
+DB_SECONDS = Histogram(
+    'bus_tj_db_seconds', 'Time of database queries of a request.',
+    LATENCY_BUCKETS)
+SECTION_SECONDS = Histogram(
+    'bus_tj_section_seconds', 'Time spent in a hot section.',
+    LATENCY_BUCKETS)
+HISTOGRAMS = [REQUEST_SECONDS, DB_QUERIES, DB_SECONDS, SECTION_SECONDS]
+
+
+class hot_section(ContextDecorator):
+    """Record time of a named section, as a decorator or a with block."""
+
+    def __init__(self, name: str):
+        """Create section timer."""
+        self.name = name
+        self._started = threading.local()
+
+    def __enter__(self):
+        """Start timing."""
+        self._started.value = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        """Record elapsed time."""
+        SECTION_SECONDS.observe(
+            time.perf_counter() - self._started.value, section=self.name)
+        return False
+
+
+class QueryCounter:
+    """Database execute wrapper which counts queries and their time."""
+
+    def __init__(self):
+        """Create counter."""
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        """Run the query and measure it."""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+class SlowestProfiles:
+    """Keep cProfile dumps of the slowest sampled requests.
+
+    Settings:
+        PROFILE_SAMPLE_RATE: Share of requests profiled, 0 turns it off.
+        PROFILE_KEEP: The number of dumps kept.
+        PROFILE_DIR: The directory of .prof files.
+    """
+
+    def __init__(self):
+        """Create empty set of dumps."""
+        self._heap = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def sample() -> bool:
+        """Return True if the next request should be profiled."""
+        rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+        return rate > 0 and random.random() < rate
+
+    def add(self, profile: cProfile.Profile, seconds: float,
+            name: str) -> None:
+        """Dump profile if it is one of the slowest ones."""
+        keep = getattr(settings, 'PROFILE_KEEP', 20)
+        directory = getattr(settings, 'PROFILE_DIR', 'profiles')
+        path = os.path.join(directory, '{:010.3f}-{}.prof'.format(
+            seconds * 1000, re.sub(r'[^\w.-]+', '_', name)))
+        with self._lock:
+            if len(self._heap) >= keep and seconds <= self._heap[0][0]:
+                return
+            os.makedirs(directory, exist_ok=True)
+            profile.dump_stats(path)
+            heapq.heappush(self._heap, (seconds, path))
+            if len(self._heap) > keep:
+                _, dropped = heapq.heappop(self._heap)
+                try:
+                    os.remove(dropped)
+                except OSError:
+                    pass
+
+
+profiles = SlowestProfiles()
+
+
+class MetricsMiddleware:
+    """Record latency and database usage of every request by view."""
+
+    def __init__(self, get_response):
+        """Create middleware."""
+        self.get_response = get_response
+
+    def __call__(self, request):
+        """Handle request and record its metrics."""
+        counter = QueryCounter()
+        profile = cProfile.Profile() if profiles.sample() else None
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            if profile is not None:
+                profile.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profile is not None:
+                    profile.disable()
+        seconds = time.perf_counter() - started
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        REQUEST_SECONDS.observe(seconds, view=view, method=request.method,
+                                status=response.status_code)
+        DB_QUERIES.observe(counter.count, view=view)
+        DB_SECONDS.observe(counter.seconds, view=view)
+        if profile is not None:
+            profiles.add(profile, seconds, f'{request.method} {view}')
+        return response
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """JSON renderer which records serialization time."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        """Render data as the 'render_json' hot section."""
+        with hot_section('render_json'):
+            return super().render(data, accepted_media_type,
+                                  renderer_context)
+
+
+def render_metrics() -> str:
+    """Return every metric in the Prometheus text format."""
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Expose metrics to Prometheus."""
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
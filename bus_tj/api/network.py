@@ -0,0 +1,72 @@
+"""Version of the network shared by processes through the database.
+
+Signals drop in-memory indexes of stops and routes only in the process
+which changed them. That process also stores a NetworkChange row, and the
+others drop their indexes when they see a new one, which they check at
+most every NETWORK_CHECK_INTERVAL seconds.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Max
+
+from tracker.models import NetworkChange
+
+DEFAULT_CHECK_INTERVAL = 1
+
+
+class NetworkVersion:
+    """The last network change the process has seen."""
+
+    def __init__(self):
+        """Create version, it is read on first check."""
+        self._seen = None
+        self._checked = None
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def connect(self, listener) -> None:
+        """Call listener when another process changes the network."""
+        self._listeners.append(listener)
+
+    def _notify(self) -> None:
+        for listener in self._listeners:
+            listener()
+
+    def check(self) -> None:
+        """Drop indexes if another process has changed the network."""
+        interval = getattr(settings, 'NETWORK_CHECK_INTERVAL',
+                           DEFAULT_CHECK_INTERVAL)
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < interval:
+            return
+        with self._lock:
+            if self._checked is not None and now - self._checked < interval:
+                return
+            latest = NetworkChange.objects.aggregate(
+                last=Max('id'))['last']
+            # Nothing is indexed before the first check.
+            changed = self._checked is not None and latest != self._seen
+            self._seen, self._checked = latest, now
+        if changed:
+            self._notify()
+
+    def changed(self) -> None:
+        """Tell other processes that this one has changed the network.
+
+        Signals have dropped indexes of this process already, they are
+        dropped again only if another process has changed the network
+        since the last check too.
+        """
+        with self._lock:
+            change = NetworkChange.objects.create()
+            missed = self._seen is not None and NetworkChange.objects.filter(
+                id__gt=self._seen, id__lt=change.pk).exists()
+            NetworkChange.objects.filter(id__lt=change.pk).delete()
+            self._seen, self._checked = change.pk, time.monotonic()
+        if missed:
+            self._notify()
+
+
+network_version = NetworkVersion()
@@ -0,0 +1,122 @@
+"""Positions of stops and buses along their routes kept in the database.
+
+A stop is placed on a route once and its distance from the route start is
+stored in StopOffset, a bus stores its distance in Vehicle.distance when
+its fix is matched. The distance between a bus and a stop is then the
+difference of two indexed values. Offsets are computed on first use and
+dropped by signals when routes, stops or locations change.
+"""
+from django.db.models import Q
+
+from tracker.models import BusStop, Path, StopOffset, Vehicle
+from .arrivals import route_distance
+from .geometry import get_route_geometry
+from .live import live_state
+
+
+def stop_offset(stop_id: int, path_id: int) -> float:
+    """Return distance of the stop from the start of the route.
+
+    Raises:
+        BusStop.DoesNotExist if there is no stop.
+        Path.DoesNotExist if the route has no points.
+    """
+    distance = StopOffset.objects.filter(
+        stop_id=stop_id, path_id=path_id
+    ).values_list('distance', flat=True).first()
+    if distance is not None:
+        return distance
+    location_id, latitude, longitude = BusStop.objects.values_list(
+        'location_id', 'location__latitude', 'location__longitude'
+    ).get(pk=stop_id)
+    distance = route_distance(path_id, location_id, latitude, longitude)
+    if distance is None:
+        raise Path.DoesNotExist
+    # Another request may have stored it since.
+    StopOffset.objects.bulk_create(
+        [StopOffset(stop_id=stop_id, path_id=path_id, distance=distance)],
+        ignore_conflicts=True)
+    return distance
+
+
+def vehicle_offset(vehicle_id: int, path_id: int) -> float:
+    """Place the bus on its route by its location and store the distance.
+
+    Buses which got no fix since their location was set have no distance.
+
+    Raises:
+        Path.DoesNotExist if the route has no points or the bus has no
+    location.
+    """
+    location_id, latitude, longitude = Vehicle.objects.values_list(
+        'location_id', 'location__latitude', 'location__longitude'
+    ).get(pk=vehicle_id)
+    distance = None
+    if location_id is not None:
+        distance = route_distance(path_id, location_id, latitude, longitude)
+    if distance is None:
+        raise Path.DoesNotExist
+    Vehicle.objects.filter(pk=vehicle_id, distance=None).update(
+        distance=distance)
+    return distance
+
+
+def build_stop_offsets(path_ids=None) -> int:
+    """Store offsets of every stop served by the buses of the routes.
+
+    Args:
+        path_ids: Routes to place stops on, every route by default.
+
+    Returns:
+        The number of offsets stored.
+    """
+    if path_ids is None:
+        path_ids = Vehicle.objects.values_list(
+            'path_id', flat=True).distinct()
+    path_ids = list(path_ids)
+    offsets = []
+    for path_id in path_ids:
+        stops = (BusStop.objects
+                 .filter(buses__path_id=path_id)
+                 .distinct()
+                 .values_list('id', 'location_id', 'location__latitude',
+                              'location__longitude'))
+        if not len(get_route_geometry(path_id)):
+            continue
+        for stop_id, location_id, latitude, longitude in stops:
+            distance = route_distance(path_id, location_id, latitude,
+                                      longitude)
+            offsets.append(StopOffset(stop_id=stop_id, path_id=path_id,
+                                      distance=distance))
+    StopOffset.objects.filter(path_id__in=path_ids).delete()
+    StopOffset.objects.bulk_create(offsets, batch_size=1000)
+    return len(offsets)
+
+
+def invalidate_offsets(path_ids=None, stop_ids=None,
+                       location_ids=None) -> None:
+    """Drop offsets on the routes, of the stops and at the locations.
+
+    Without arguments every offset is dropped. Bus distances are cleared
+    the same way and recomputed from bus locations on next use, buses of
+    the routes are dropped from the live state.
+    """
+    if path_ids is None and stop_ids is None and location_ids is None:
+        StopOffset.objects.all().delete()
+        Vehicle.objects.exclude(distance=None).update(distance=None)
+        live_state.clear()
+        return
+    stops = Q(pk__in=[])
+    vehicles = Q(pk__in=[])
+    if path_ids:
+        stops |= Q(path_id__in=path_ids)
+        vehicles |= Q(path_id__in=path_ids)
+        live_state.remove_routes(path_ids)
+    if stop_ids:
+        stops |= Q(stop_id__in=stop_ids)
+    if location_ids:
+        stops |= Q(stop__location_id__in=location_ids)
+        vehicles |= Q(location_id__in=location_ids)
+    StopOffset.objects.filter(stops).delete()
+    Vehicle.objects.filter(vehicles).exclude(distance=None).update(
+        distance=None)
@@ -0,0 +1,191 @@
+"""Publish/subscribe fan-out of live updates.
+
+The broker is chosen by the PUBSUB setting, in the same shape as CACHES:
+
+    PUBSUB = {
+        'BACKEND': 'api.pubsub.RedisBroker',
+        'OPTIONS': {'url': 'redis://localhost:6379/0'},
+    }
+
+LocalBroker only reaches subscribers in the same process. RedisBroker
+relays messages between processes through any Redis-compatible server.
+"""
+import asyncio
+import json
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+DEFAULT_QUEUE_SIZE = 100
+
+
+class Subscription:
+    """Queue of (topic, message) pairs for one asyncio consumer.
+
+    It must be created inside a running event loop. When the consumer is
+    too slow, the oldest messages are dropped.
+    """
+
+    def __init__(self, broker, topics, maxsize: int = DEFAULT_QUEUE_SIZE):
+        """Create subscription bound to the running event loop."""
+        self.broker = broker
+        self.topics = frozenset(topics)
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize)
+
+    def put(self, topic: str, message) -> bool:
+        """Deliver message, it is safe to call from any thread.
+
+        A subscription whose event loop is closed, e.g. of a client which
+        went away, is removed and False is returned.
+        """
+        try:
+            self._loop.call_soon_threadsafe(self._put, (topic, message))
+        except RuntimeError:
+            self.close()
+            return False
+        return True
+
+    def _put(self, item) -> None:
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(item)
+
+    async def get(self) -> tuple:
+        """Wait for the next (topic, message) pair."""
+        return await self._queue.get()
+
+    def close(self) -> None:
+        """Stop receiving messages."""
+        self.broker.unsubscribe(self)
+
+    def __aiter__(self):
+        """Iterate over messages."""
+        return self
+
+    async def __anext__(self) -> tuple:
+        """Wait for the next (topic, message) pair."""
+        return await self.get()
+
+
+class LocalBroker:
+    """In-process broker."""
+
+    def __init__(self, **options):
+        """Create broker without subscribers."""
+        self._topics = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def has_subscribers(self, topic: str) -> bool:
+        """Check whether anybody in this process listens to the topic."""
+        return bool(self._topics.get(topic))
+
+    def publish(self, topic: str, message) -> int:
+        """Send JSON-serializable message to subscribers of the topic.
+
+        Returns:
+            The number of subscribers which got the message.
+        """
+        return self._fan_out(topic, message)
+
+    def _fan_out(self, topic: str, message) -> int:
+        with self._lock:
+            subscriptions = list(self._topics.get(topic, ()))
+        return sum(subscription.put(topic, message)
+                   for subscription in subscriptions)
+
+    def subscribe(self, topics, maxsize: int = DEFAULT_QUEUE_SIZE):
+        """Subscribe the running event loop to the topics."""
+        subscription = Subscription(self, topics, maxsize)
+        with self._lock:
+            for topic in subscription.topics:
+                self._topics[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """Remove subscription from all its topics."""
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._topics.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._topics[topic]
+
+
+class RedisBroker(LocalBroker):
+    """Broker which relays messages through Redis channels.
+
+    Every process publishes to Redis and runs one listener thread which
+    fans messages out to its local subscribers. Any object with the
+    redis-py ``publish`` and ``pubsub`` methods can be passed as client,
+    e.g. a fake in tests.
+    """
+
+    def __init__(self, url: str = 'redis://localhost:6379/0',
+                 prefix: str = 'bus_tj:', client=None, **options):
+        """Create broker, redis is imported only if no client is given."""
+        super().__init__(**options)
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self._client = client
+        self._prefix = prefix
+        self._listener = None
+
+    def publish(self, topic: str, message) -> int:
+        """Send message to subscribers of the topic in every process.
+
+        Returns:
+            The number of processes listening to Redis, any of them may
+        have subscribers of the topic.
+        """
+        return self._client.publish(self._prefix + topic, json.dumps(message))
+
+    def subscribe(self, topics, maxsize: int = DEFAULT_QUEUE_SIZE):
+        """Subscribe the running event loop to the topics."""
+        if self._listener is None:
+            with self._lock:
+                if self._listener is None:
+                    self._listener = threading.Thread(
+                        target=self._listen, name='pubsub-listener',
+                        daemon=True)
+                    self._listener.start()
+        return super().subscribe(topics, maxsize)
+
+    def _listen(self) -> None:
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(self._prefix + '*')
+        for item in pubsub.listen():
+            if item.get('type') != 'pmessage':
+                continue
+            channel = item['channel']
+            data = item['data']
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            self._fan_out(channel[len(self._prefix):], json.loads(data))
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker() -> LocalBroker:
+    """Return broker configured by the PUBSUB setting."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                config = getattr(settings, 'PUBSUB', {})
+                backend = import_string(
+                    config.get('BACKEND', 'api.pubsub.LocalBroker'))
+                _broker = backend(**config.get('OPTIONS', {}))
+    return _broker
+
+
+def set_broker(broker) -> None:
+    """Replace the broker, e.g. with a stand-in in tests."""
+    global _broker
+    _broker = broker
@@ -0,0 +1,246 @@
+"""Signal receivers which keep in-process indexes in sync with models."""
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_save)
+from django.dispatch import receiver
+
+from tracker.models import BusStop, Location, Path, ProximityAlert, Vehicle
+from .alerts import alert_registry
+from .arrivals import arrival_table
+from .caching import bump_version
+from .fleet import fleet
+from .geometry import route_cache
+from .journey import invalidate_graph
+from .live import live_state
+from .network import network_version
+from .offsets import invalidate_offsets
+from .spatial import invalidate_stop_index
+
+
+_bulk = threading.local()
+
+
+@contextmanager
+def bulk_changes():
+    """Skip network receivers of the thread while bulk writes run.
+
+    Deleting rows sends a signal per row, a bulk writer calls
+    invalidate_network once when it's done instead.
+    """
+    _bulk.active = True
+    try:
+        yield
+    finally:
+        _bulk.active = False
+
+
+def network_receiver(function):
+    """Make the receiver do nothing inside bulk_changes()."""
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not getattr(_bulk, 'active', False):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def invalidate_network(path_ids=None, stop_ids=None) -> None:
+    """Drop every index and cached response after bulk writes.
+
+    bulk_create and bulk_update send no signals, so code which changes
+    the network with them calls this when the transaction commits.
+
+    Args:
+        path_ids: Changed routes, offsets on them are dropped.
+        stop_ids: Changed stops, their offsets are dropped. Without both
+    every offset is dropped.
+    """
+    invalidate_stop_index()
+    route_cache.invalidate()
+    arrival_table.invalidate_stops()
+    fleet.reset()
+    invalidate_offsets(path_ids=path_ids, stop_ids=stop_ids)
+    invalidate_graph()
+    alert_registry.reset()
+    bump_version('stops')
+    bump_version('buses')
+    network_version.changed()
+
+
+@receiver([post_save, post_delete], sender=BusStop)
+@receiver([post_save, post_delete], sender=Location)
+@receiver([post_save, post_delete], sender=Path)
+@receiver([post_save, post_delete], sender=Vehicle)
+@receiver(m2m_changed, sender=BusStop.buses.through)
+@network_receiver
+def share_network_change(sender, **kwargs):
+    """Make other processes drop their indexes of stops and routes."""
+    network_version.changed()
+
+
+@receiver([post_save, post_delete], sender=BusStop)
+@receiver([post_save, post_delete], sender=Location)
+@network_receiver
+def refresh_stop_index(sender, **kwargs):
+    """Drop stop index when stops or their locations change."""
+    invalidate_stop_index()
+
+
+@receiver([post_save, post_delete], sender=Path)
+@network_receiver
+def refresh_route_geometry(sender, instance, **kwargs):
+    """Drop cached geometry of the changed route.
+
+    A saved row may have been moved from another route, so routes which
+    held the row are dropped too.
+    """
+    route_cache.invalidate(instance.path_id, row_id=instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Location)
+@network_receiver
+def refresh_location_routes(sender, instance, created=False, **kwargs):
+    """Drop cached geometry of the routes which use the location."""
+    if not created:
+        route_cache.invalidate(location_id=instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Path)
+@network_receiver
+def refresh_route_offsets(sender, instance, **kwargs):
+    """Drop offsets on the changed route and at the point of the row."""
+    invalidate_offsets(path_ids=[instance.path_id],
+                       location_ids=[instance.location_id])
+
+
+@receiver([post_save, post_delete], sender=Location)
+@network_receiver
+def refresh_location_offsets(sender, instance, created=False, **kwargs):
+    """Drop offsets at the location and on the routes which use it."""
+    if not created:
+        invalidate_offsets(
+            path_ids=list(Path.objects.filter(location_id=instance.pk)
+                          .values_list('path_id', flat=True).distinct()),
+            location_ids=[instance.pk])
+
+
+@receiver(post_save, sender=BusStop)
+@network_receiver
+def refresh_stop_offsets(sender, instance, created=False, **kwargs):
+    """Drop offsets of the stop, its location may have changed."""
+    if not created:
+        invalidate_offsets(stop_ids=[instance.pk])
+
+
+@receiver([post_save, post_delete], sender=BusStop)
+@receiver([post_save, post_delete], sender=Path)
+@receiver(post_delete, sender=Vehicle)
+@receiver(m2m_changed, sender=BusStop.buses.through)
+@network_receiver
+def refresh_journey_graph(sender, **kwargs):
+    """Drop the journey graph when stops, routes or their buses change."""
+    invalidate_graph()
+
+
+@receiver(pre_save, sender=Vehicle)
+def check_vehicle_route(sender, instance, update_fields=None, **kwargs):
+    """Note whether the saved bus moves to another route.
+
+    Only the route of a bus is in the journey graph, other fields change
+    with every edit.
+    """
+    instance._route_changed = instance.pk is not None and (
+        update_fields is None or 'path_id' in update_fields
+    ) and not Vehicle.objects.filter(
+        pk=instance.pk, path_id=instance.path_id).exists()
+
+
+@receiver(post_save, sender=Vehicle)
+def refresh_vehicle_journeys(sender, instance, **kwargs):
+    """Drop the journey graph when a bus has moved to another route."""
+    if getattr(instance, '_route_changed', False):
+        invalidate_graph()
+
+
+@receiver([post_save, post_delete], sender=Location)
+@network_receiver
+def refresh_location_journeys(sender, created=False, **kwargs):
+    """Drop the journey graph when a stop or a route point moves."""
+    if not created:
+        invalidate_graph()
+
+
+@receiver(pre_save, sender=Vehicle)
+def clear_vehicle_distance(sender, instance, update_fields=None, **kwargs):
+    """Forget distance of the bus when its location or route is saved.
+
+    The distance is recomputed from the location on next use.
+    """
+    if update_fields is None or (
+            'distance' not in update_fields
+            and {'location', 'path_id'} & set(update_fields)):
+        instance.distance = None
+
+
+@receiver([post_save, post_delete], sender=BusStop)
+@receiver([post_save, post_delete], sender=Vehicle)
+@receiver(m2m_changed, sender=BusStop.buses.through)
+@network_receiver
+def refresh_route_stops(sender, **kwargs):
+    """Forget stops of routes when stops or their buses change."""
+    arrival_table.invalidate_stops()
+
+
+@receiver(post_delete, sender=Vehicle)
+def forget_arrivals(sender, instance, **kwargs):
+    """Drop arrivals of the deleted bus."""
+    arrival_table.forget(instance.pk)
+    fleet.remove(instance.pk)
+    live_state.remove(instance.pk)
+
+
+@receiver(post_save, sender=Vehicle)
+def refresh_fleet(sender, instance, **kwargs):
+    """Reload the fleet snapshot when a bus is created or edited.
+
+    The live state of the bus is dropped too, its route may have changed.
+    """
+    live_state.remove(instance.pk)
+    fleet.reset()
+
+
+@receiver([post_save, post_delete], sender=BusStop)
+@receiver([post_save, post_delete], sender=Location)
+@network_receiver
+def refresh_stop_responses(sender, **kwargs):
+    """Make cached responses about stops stale."""
+    bump_version('stops')
+
+
+@receiver([post_save, post_delete], sender=Vehicle)
+@receiver(m2m_changed, sender=BusStop.buses.through)
+@network_receiver
+def refresh_bus_responses(sender, **kwargs):
+    """Make cached responses about buses stale."""
+    bump_version('buses')
+
+
+@receiver([post_save, post_delete], sender=ProximityAlert)
+def refresh_alerts(sender, **kwargs):
+    """Reload alerts when one is added or fired.
+
+    Other workers notice the change in the database by themselves.
+    """
+    alert_registry.reset()
+
+
+@receiver([post_save, post_delete], sender=BusStop)
+@receiver([post_save, post_delete], sender=Location)
+@receiver([post_save, post_delete], sender=Path)
+@receiver([post_save, post_delete], sender=Vehicle)
+@network_receiver
+def refresh_alert_offsets(sender, **kwargs):
+    """Reload alerts, their stops or the routes of their buses may move."""
+    alert_registry.reset()
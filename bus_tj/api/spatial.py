@@ -0,0 +1,328 @@
+"""Spatial search of bus stops.
+
+StopIndex is an in-process grid over every stop. search_stops pages
+through stops around a point in the database, narrowing candidates by
+the indexed latitude and longitude of their locations.
+"""
+import base64
+import binascii
+import json
+import math
+import threading
+from collections import defaultdict
+from typing import NamedTuple
+
+import numpy as np
+from django.db.models import Max, Min
+
+from tracker.models import BusStop
+from . import distance
+from .distance import METERS_PER_DEGREE
+from .metrics import hot_section
+from .network import network_version
+
+DEFAULT_CELL_SIZE = 500
+INITIAL_BOX = 500
+
+
+class Grid:
+    """Sparse grid of buckets keyed by integer (x, y) cells."""
+
+    def __init__(self):
+        """Create empty grid."""
+        self._buckets = defaultdict(list)
+        self._bounds = None
+
+    def __bool__(self) -> bool:
+        """Return True if any item was added."""
+        return self._bounds is not None
+
+    def add(self, cell: tuple, item) -> None:
+        """Put item into the bucket of the cell."""
+        self._buckets[cell].append(item)
+        x, y = cell
+        if self._bounds is None:
+            self._bounds = (x, x, y, y)
+        else:
+            min_x, max_x, min_y, max_y = self._bounds
+            self._bounds = (min(min_x, x), max(max_x, x),
+                            min(min_y, y), max(max_y, y))
+
+    def _ring(self, cx: int, cy: int, r: int):
+        """Yield cells of ring r around (cx, cy) clipped to the grid."""
+        min_x, max_x, min_y, max_y = self._bounds
+        if r == 0:
+            yield cx, cy
+            return
+        x_from, x_to = max(cx - r, min_x), min(cx + r, max_x)
+        for y in (cy - r, cy + r):
+            if min_y <= y <= max_y:
+                for x in range(x_from, x_to + 1):
+                    yield x, y
+        y_from, y_to = max(cy - r + 1, min_y), min(cy + r - 1, max_y)
+        for x in (cx - r, cx + r):
+            if min_x <= x <= max_x:
+                for y in range(y_from, y_to + 1):
+                    yield x, y
+
+    def rings(self, cx: int, cy: int, last: int = None):
+        """Yield (r, items) for rings around (cx, cy) from the inside out.
+
+        Rings which do not intersect the grid are skipped. Items of every
+        cell at Chebyshev distance r from (cx, cy) are yielded together.
+        """
+        if self._bounds is None:
+            return
+        min_x, max_x, min_y, max_y = self._bounds
+        first = max(min_x - cx, cx - max_x, min_y - cy, cy - max_y, 0)
+        farthest = max(abs(cx - min_x), abs(cx - max_x),
+                       abs(cy - min_y), abs(cy - max_y))
+        if last is None or last > farthest:
+            last = farthest
+        for r in range(first, last + 1):
+            yield r, [item for cell in self._ring(cx, cy, r)
+                      for item in self._buckets.get(cell, ())]
+
+
+class StopIndex:
+    """Grid bucket map over stop coordinates.
+
+    Stops are put into square cells of ``cell_size`` meters. Queries scan
+    rings of cells around the query point and stop as soon as no unseen
+    cell can contain a closer stop.
+
+    Attributes:
+    cell_size (float): The side of a cell in meters.
+    """
+
+    def __init__(self, stops, cell_size: float = DEFAULT_CELL_SIZE):
+        """Build index.
+
+        Args:
+            stops: Iterable of (id, name, latitude, longitude) tuples.
+            cell_size (float): The side of a cell in meters.
+        """
+        self.cell_size = cell_size
+        self.stops = list(stops)
+        self._lats = np.fromiter((s[2] for s in self.stops), dtype=float,
+                                 count=len(self.stops))
+        self._lons = np.fromiter((s[3] for s in self.stops), dtype=float,
+                                 count=len(self.stops))
+        max_lat = float(np.abs(self._lats).max()) if self.stops else 0.0
+        self._lat_step = cell_size / METERS_PER_DEGREE
+        # Cells are narrower in meters towards the poles, so the longitude
+        # step is taken at the latitude closest to the pole.
+        self._lon_step = self._lat_step / max(
+            math.cos(math.radians(max_lat)), 1e-6)
+        self._grid = Grid()
+        for number, stop in enumerate(self.stops):
+            self._grid.add(self._cell(stop[2], stop[3]), number)
+
+    def __len__(self) -> int:
+        """Return number of indexed stops."""
+        return len(self.stops)
+
+    def _cell(self, latitude: float, longitude: float) -> tuple:
+        return (math.floor(latitude / self._lat_step),
+                math.floor(longitude / self._lon_step))
+
+    @hot_section('nearest_stops')
+    def nearest(self, latitude: float, longitude: float, k: int = 4,
+                radius: float = None, refine: bool = False) -> list:
+        """Get k nearest stops.
+
+        Args:
+            latitude (float): The latitude of the query point.
+            longitude (float): The longitude of the query point.
+            k (int): The maximum number of stops to return.
+            radius (float): Optional search radius in meters.
+            refine (bool): Rank the result by exact geodesic distance.
+
+        Returns:
+            List of (distance, (id, name, latitude, longitude)) sorted by
+        distance.
+        """
+        if k <= 0:
+            return []
+        last_ring = None
+        if radius is not None:
+            last_ring = math.floor(radius / self.cell_size) + 1
+        numbers = np.empty(0, dtype=int)
+        distances = np.empty(0)
+        cx, cy = self._cell(latitude, longitude)
+        for r, found in self._grid.rings(cx, cy, last_ring):
+            if found:
+                found = np.asarray(found)
+                found_distances = distance.haversine(
+                    latitude, longitude,
+                    self._lats[found], self._lons[found])
+                if radius is not None:
+                    inside = found_distances <= radius
+                    found, found_distances = (found[inside],
+                                              found_distances[inside])
+                numbers = np.concatenate((numbers, found))
+                distances = np.concatenate((distances, found_distances))
+            # Every stop in unseen cells is at least r cells away.
+            if (len(distances) >= k and np.partition(distances, k - 1)[k - 1]
+                    <= r * self.cell_size):
+                break
+        picked, distances = distance.nearest(
+            latitude, longitude, self._lats[numbers], self._lons[numbers],
+            k, distances=distances, refine=refine)
+        return [(float(d), self.stops[n])
+                for d, n in zip(distances, numbers[picked])]
+
+    def within(self, latitude: float, longitude: float,
+               radius: float) -> list:
+        """Get all stops within radius meters sorted by distance."""
+        return self.nearest(latitude, longitude, len(self.stops), radius)
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_stop_index() -> StopIndex:
+    """Return stop index, building it from the database if needed."""
+    global _index
+    network_version.check()
+    index = _index
+    if index is not None:
+        return index
+    with _lock:
+        if _index is None:
+            queryset = BusStop.objects.values_list(
+                'id', 'name', 'location__latitude', 'location__longitude')
+            _index = StopIndex(queryset)
+        return _index
+
+
+def invalidate_stop_index() -> None:
+    """Drop stop index, it will be rebuilt on the next query."""
+    global _index
+    with _lock:
+        _index = None
+
+
+network_version.connect(invalidate_stop_index)
+
+
+class StopPage(NamedTuple):
+    """Page of stops sorted by distance.
+
+    Attributes:
+    stops (list): (distance, (id, name, latitude, longitude)) tuples.
+    cursor (str): The cursor of the next page, None on the last page.
+    """
+
+    stops: list
+    cursor: str
+
+
+def encode_cursor(stop_distance: float, stop_id: int) -> str:
+    """Return opaque cursor which points after the stop."""
+    return base64.urlsafe_b64encode(
+        json.dumps([stop_distance, stop_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Return (distance, id) of the cursor.
+
+    Raises:
+        ValueError if the cursor is malformed.
+    """
+    try:
+        stop_distance, stop_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()))
+        return float(stop_distance), int(stop_id)
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValueError('cursor is invalid')
+
+
+def _box(latitude: float, longitude: float, half: float) -> dict:
+    """Return lookups of a box which contains the circle of radius half."""
+    lat_step = half / METERS_PER_DEGREE
+    # The box is widest in meters at its edge closest to the pole.
+    cos = math.cos(math.radians(min(abs(latitude) + lat_step, 90)))
+    lon_step = lat_step / cos if cos > 1e-6 else 360
+    return {
+        'location__latitude__range': (latitude - lat_step,
+                                      latitude + lat_step),
+        'location__longitude__range': (longitude - lon_step,
+                                       longitude + lon_step),
+    }
+
+
+def _covers(box: dict, extent: dict) -> bool:
+    lat_from, lat_to = box['location__latitude__range']
+    lon_from, lon_to = box['location__longitude__range']
+    return (lat_from <= extent['min_lat'] and extent['max_lat'] <= lat_to
+            and lon_from <= extent['min_lon']
+            and extent['max_lon'] <= lon_to)
+
+
+@hot_section('search_stops')
+def search_stops(latitude: float, longitude: float, limit: int,
+                 radius: float = None, cursor: str = None) -> StopPage:
+    """Get a page of stops around the point, nearest first.
+
+    The database is asked for stops in a box around the point which grows
+    twice until it holds a page of stops closer than half of its side, so
+    exact distances are computed only for stops next to the point.
+
+    Args:
+        latitude (float): The latitude of the query point.
+        longitude (float): The longitude of the query point.
+        limit (int): The maximum number of stops on the page.
+        radius (float): Optional search radius in meters.
+        cursor (str): The cursor of an earlier page to continue after.
+
+    Raises:
+        ValueError if the cursor is malformed.
+    """
+    after = decode_cursor(cursor) if cursor is not None else (-1.0, 0)
+    half = max(INITIAL_BOX, after[0] * 2)
+    extent = None
+    while True:
+        if radius is not None:
+            half = min(half, radius)
+        stops = (BusStop.objects
+                 .select_related('location')
+                 .only('id', 'name', 'location__latitude',
+                       'location__longitude')
+                 .filter(**_box(latitude, longitude, half)))
+        stops = [(stop.id, stop.name, stop.location.latitude,
+                  stop.location.longitude) for stop in stops]
+        distances = distance.haversine(
+            latitude, longitude, [stop[2] for stop in stops],
+            [stop[3] for stop in stops]).tolist()
+        found = sorted(
+            (stop_distance, stop) for stop_distance, stop in
+            zip(distances, stops)
+            if (stop_distance, stop[0]) > after and (
+                radius is None or stop_distance <= radius))
+        # Stops outside the box are farther than half from the point.
+        complete = [item for item in found if item[0] <= half]
+        if len(complete) > limit:
+            found = complete
+            break
+        if radius is not None:
+            if half >= radius:
+                break
+        else:
+            if extent is None:
+                extent = BusStop.objects.aggregate(
+                    min_lat=Min('location__latitude'),
+                    max_lat=Max('location__latitude'),
+                    min_lon=Min('location__longitude'),
+                    max_lon=Max('location__longitude'))
+            if extent['min_lat'] is None or _covers(
+                    _box(latitude, longitude, half), extent):
+                break
+        half *= 2
+    page = found[:limit]
+    next_cursor = None
+    if len(found) > limit:
+        last_distance, last_stop = page[-1]
+        next_cursor = encode_cursor(last_distance, last_stop[0])
+    return StopPage(page, next_cursor)
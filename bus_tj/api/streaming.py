@@ -0,0 +1,127 @@
+"""Server-Sent Events stream of arrival updates.
+
+Clients subscribe with ``/api/stream/?stop=<id>&bus=<id>`` to one bus at
+one stop, or with ``/api/stream/?route=<path_id>`` to every bus of a route,
+and receive updates as buses report their locations. The bot subscribes
+with ``/api/stream/?alerts=1`` to proximity alerts as they fire; alerts of
+every chat go there, so the request must carry ``Authorization: Bearer
+<ALERT_STREAM_TOKEN>``.
+"""
+import asyncio
+import hmac
+import json
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from .alerts import ALERTS_TOPIC
+from .arrivals import arrival_table, route_topic, vehicle_topic
+from .pubsub import get_broker
+
+STREAM_PATH = '/api/stream/'
+HEARTBEAT_INTERVAL = 15
+
+
+def format_event(event: str, data) -> bytes:
+    """Encode one SSE event."""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+
+
+def arrival_event(stop_id: int, bus_id: int, message: dict) -> bytes:
+    """Turn vehicle update into an event for one stop or None."""
+    if stop_id in message['passed']:
+        return format_event('passed', {'stop': stop_id, 'bus': bus_id})
+    for arrival_stop, distance, eta in message['arrivals']:
+        if arrival_stop == stop_id:
+            return format_event('arrival', {'stop': stop_id, 'bus': bus_id,
+                                            'distance': distance,
+                                            'eta': eta})
+    return None
+
+
+async def send_response(send, status: int, body: dict) -> None:
+    """Send plain JSON response."""
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body',
+                'body': json.dumps(body).encode()})
+
+
+def has_alert_token(scope) -> bool:
+    """Check the request for the ALERT_STREAM_TOKEN, none is set by default."""
+    token = getattr(settings, 'ALERT_STREAM_TOKEN', None)
+    if not token:
+        return False
+    headers = dict(scope.get('headers', ()))
+    return hmac.compare_digest(headers.get(b'authorization', b''),
+                               f'Bearer {token}'.encode())
+
+
+async def wait_disconnect(receive) -> None:
+    """Return when the client goes away."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def sse_application(scope, receive, send) -> None:
+    """ASGI application of the stream endpoint."""
+    params = parse_qs(scope.get('query_string', b'').decode())
+    try:
+        if 'alerts' in params:
+            if not has_alert_token(scope):
+                await send_response(send, 403,
+                                    {'message': 'token is invalid'})
+                return
+            topic = ALERTS_TOPIC
+            initial = []
+
+            def to_event(message):
+                return format_event('alert', message)
+        elif 'route' in params:
+            path_id = int(params['route'][0])
+            topic = route_topic(path_id)
+            initial = []
+
+            def to_event(message):
+                return format_event('vehicle', message)
+        else:
+            stop_id = int(params['stop'][0])
+            bus_id = int(params['bus'][0])
+            topic = vehicle_topic(bus_id)
+            arrival = arrival_table.get(stop_id, bus_id)
+            initial = [format_event('arrival', {
+                'stop': stop_id, 'bus': bus_id,
+                'distance': round(arrival.distance), 'eta': arrival.eta,
+            })] if arrival is not None else []
+
+            def to_event(message):
+                return arrival_event(stop_id, bus_id, message)
+    except (KeyError, ValueError):
+        await send_response(send, 400, {'message': 'params are required'})
+        return
+
+    subscription = get_broker().subscribe([topic])
+    disconnect = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache')]})
+        for event in initial:
+            await send({'type': 'http.response.body', 'body': event,
+                        'more_body': True})
+        while not disconnect.done():
+            message = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait(
+                {message, disconnect}, timeout=HEARTBEAT_INTERVAL,
+                return_when=asyncio.FIRST_COMPLETED)
+            if message in done:
+                event = to_event(message.result()[1])
+            else:
+                message.cancel()
+                event = None if disconnect.done() else b': ping\n\n'
+            if event is not None:
+                await send({'type': 'http.response.body', 'body': event,
+                            'more_body': True})
+    finally:
+        subscription.close()
+        disconnect.cancel()
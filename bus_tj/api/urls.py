@@ -9,6 +9,9 @@ router = DefaultRouter()
 router.register('bus', views.BusViewSet, basename='bus')
 router.register('stop', views.StopViewSet, basename='stop')
 router.register('location', views.LocationViewSet, basename='location')
+router.register('fleet', views.FleetViewSet, basename='fleet')
+router.register('journey', views.JourneyViewSet, basename='journey')
+router.register('alert', views.AlertViewSet, basename='alert')
 
 urlpatterns = [
     path('', include(router.urls)),
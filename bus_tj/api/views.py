@@ -1,57 +1,149 @@
 """All APIs are here."""
-from geopy.distance import geodesic
+import json
+import math
+from datetime import timedelta
+
+import numpy as np
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet
 from rest_framework import status
 
-from tracker.models import BusStop, Path, Location, Vehicle
+from tracker.models import BusStop, Path, ProximityAlert, Vehicle
+from .arrivals import arrival_table, departure_board, estimate_eta
+from .caching import cached_response
 from .exceptions import ObjectDoesNotExistError
+from .fleet import fleet
+from .geometry import get_route_geometry
+from .history import history_buffer, iter_trace
+from .journey import get_graph
+from .ingestion import (MAX_BULK_FIXES, apply_fixes, parse_fix,
+                        parse_timestamp)
+from .live import live_state
+from .metrics import hot_section
+from .offsets import stop_offset, vehicle_offset
+from .spatial import get_stop_index, search_stops
 
+DEFAULT_NEAREST_STOPS = 4
+MAX_NEAREST_STOPS = 50
+DEFAULT_TRACE_PERIOD = timedelta(hours=1)
+TRACE_BATCH = 500
 
+
+@hot_section('calculate_distance')
 def calculate_distance(bus_id: int, stop_id: int) -> int:
-    """Calculate distance between bus and stop.
+    """Calculate distance the bus has to drive to the stop.
+
+    Both positions are measured along the route of the bus: the bus
+    distance from the route start is read from the live state, or from
+    the database if the bus got no fix on this node, and the stop offset
+    on that route is stored in StopOffset. On a circular route the bus
+    reaches a stop it has passed on its next lap.
 
     Args:
         bus_id (int): PrimaryKey of the bus.
         stop_id (int): PrimaryKey of the stop.
 
+    Returns:
+        Distance in meters or None if the bus has passed the stop of a
+    linear route.
+
     Raises:
         ObjectDoesNotExistError if can't find any object in models BusStop,
     Path and Vehicle.
-        TypeError if Path.distance is not integer (sometimes it will work if
-    it is not integer, but it is recommended to be integer).
     """
+    bus_id, stop_id = int(bus_id), int(stop_id)
     try:
-        bus = Vehicle.objects.get(pk=bus_id)
-        stop = BusStop.objects.get(pk=stop_id)
-        bus_path = Path.objects.get(location=bus.location)
-        stop_path = Path.objects.get(location=stop.location)
-        return stop_path.distance - bus_path.distance
+        bus = live_state.get(bus_id)
+        if bus is not None and bus.distance is not None:
+            path_id, bus_distance = bus.path_id, bus.distance
+        else:
+            path_id, bus_distance = Vehicle.objects.values_list(
+                'path_id', 'distance').get(pk=bus_id)
+        if bus_distance is None:
+            bus_distance = vehicle_offset(bus_id, path_id)
+        distance = get_route_geometry(path_id).forward(
+            bus_distance, stop_offset(stop_id, path_id))
+        return None if np.isnan(distance) else round(float(distance))
     except Vehicle.DoesNotExist:
         raise ObjectDoesNotExistError('Vehicle object does not exist.')
     except BusStop.DoesNotExist:
         raise ObjectDoesNotExistError('BusStop object does not exist.')
     except Path.DoesNotExist:
         raise ObjectDoesNotExistError('Path object does not exist.')
-    except TypeError:
-        raise TypeError('Path.distance is not int (sometimes it will work if '
-                        'it is not integer, but it is recommended to be '
-                        'integer).')
+
+
+def query_timestamp(value):
+    """Parse ISO 8601 or unix time query param, None stays None."""
+    if value is None:
+        return None
+    try:
+        value = float(value)
+    except ValueError:
+        pass
+    return parse_timestamp(value)
+
+
+def stream_trace(bus_id: int, points):
+    """Yield JSON of the trace in pieces of TRACE_BATCH points."""
+    yield f'{{"bus": {bus_id}, "points": ['
+    batch = []
+    separator = ''
+    for time, latitude, longitude, distance in points:
+        batch.append(json.dumps([round(time, 3), round(latitude, 6),
+                                 round(longitude, 6), round(distance, 1)]))
+        if len(batch) == TRACE_BATCH:
+            yield separator + ','.join(batch)
+            batch, separator = [], ','
+    if batch:
+        yield separator + ','.join(batch)
+    yield ']}'
+
+
+def alert_data(alert: dict) -> dict:
+    """Return alert in the shape of the API."""
+    return {'id': alert['id'], 'chat_id': alert['chat_id'],
+            'bus': alert['vehicle_id'], 'stop': alert['stop_id'],
+            'distance': alert['distance'], 'minutes': alert['minutes']}
 
 
 class LocationViewSet(ViewSet):
     """Get location of the bus."""
 
     def list(self, request):
-        """Get location of the bus."""
-        bus_id = request.GET.get('bus')
-        stop_id = request.GET.get('stop')
-        return Response({'distance': calculate_distance(bus_id, stop_id)})
+        """Get distance and ETA of the bus to the stop.
+
+        The distance is computed from the live state shared by the workers.
+        The arrival table of this worker answers only if it has seen the
+        latest fix of the bus.
+        """
+        try:
+            bus_id = int(request.GET.get('bus'))
+            stop_id = int(request.GET.get('stop'))
+        except (TypeError, ValueError):
+            return Response({'message': 'params are required'})
+        arrival = arrival_table.get(stop_id, bus_id)
+        if arrival is not None:
+            live = live_state.get(bus_id)
+            if live is None or live.timestamp is None or (
+                    arrival.updated.timestamp() >= live.timestamp):
+                return Response({'distance': round(arrival.distance),
+                                 'eta': arrival.eta})
+        distance = calculate_distance(bus_id, stop_id)
+        return Response({
+            'distance': distance,
+            'eta': (None if distance is None else
+                    estimate_eta(distance, arrival_table.speed(bus_id))),
+        })
 
 
 class BusViewSet(ViewSet):
     """Get buses which pass the stop."""
 
+    @cached_response('stops', 'buses')
     def list(self, request):
         """Get buses which pass the stop."""
         stop_id = request.GET.get('stop')
@@ -60,6 +152,7 @@ class BusViewSet(ViewSet):
         response = {'buses': [[i.name, i.id] for i in buses]}
         return Response(response, status=status.HTTP_200_OK)
 
+    @cached_response('buses')
     def retrieve(self, request, pk=None):
         """Get bus info."""
         bus = Vehicle.objects.get(pk=pk)
@@ -67,49 +160,332 @@ class BusViewSet(ViewSet):
                         status=status.HTTP_200_OK)
 
     def update(self, request, pk=None):
-        """Update bus location."""
-        data = request.data.json()
-        latitude = data['latitude']
-        longitude = data['longitude']
-        if latitude is None or longitude is None:
+        """Update bus location.
+
+        The fix is snapped onto the nearest segment of the bus route and the
+        bus is moved to the route point closest to the match.
+        """
+        if (request.data.get('latitude') is None
+                or request.data.get('longitude') is None):
             return Response({'message': 'params are required'})
-        our_location = (latitude, longitude)
-        queryset = Location.objects.all()
-        distances = {}
-        for location in queryset:
-            point = (location.latitude, location.longitude)
-            distance = geodesic(our_location, point).meters
-            distances[distance] = location
-        nearest_point = distances[sorted(distances.keys())[0]]
-        bus = Vehicle.objects.get(pk=pk)
-        bus.objects.update(location=nearest_point)
-        return Response({}, status=status.HTTP_200_OK)
+        try:
+            fix = parse_fix({
+                'vehicle_id': pk,
+                'latitude': request.data.get('latitude'),
+                'longitude': request.data.get('longitude'),
+                'timestamp': request.data.get('timestamp'),
+            })
+        except ValueError as error:
+            return Response({'message': str(error)},
+                            status=status.HTTP_400_BAD_REQUEST)
+        result = apply_fixes([fix])[0]
+        if result['status'] != 'ok':
+            return Response({'message': result['message']},
+                            status=status.HTTP_404_NOT_FOUND)
+        return Response({'distance': result['distance'],
+                         'location': result['location']},
+                        status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Update locations of many buses at once.
+
+        Body is a list of {vehicle_id, lat, lon, timestamp} objects, or an
+        object with such a list under "fixes". Every item gets its own
+        result, so one bad fix doesn't fail the whole batch.
+        """
+        items = request.data
+        if isinstance(items, dict):
+            items = items.get('fixes')
+        if not isinstance(items, list):
+            return Response({'message': 'list of fixes is required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > MAX_BULK_FIXES:
+            return Response(
+                {'message': f'at most {MAX_BULK_FIXES} fixes are allowed'},
+                status=status.HTTP_400_BAD_REQUEST)
+        results = [None] * len(items)
+        fixes, numbers = [], []
+        for number, item in enumerate(items):
+            try:
+                fixes.append(parse_fix(item))
+                numbers.append(number)
+            except ValueError as error:
+                results[number] = {
+                    'vehicle_id': (item.get('vehicle_id')
+                                   if isinstance(item, dict) else None),
+                    'status': 'invalid', 'message': str(error)}
+        for number, result in zip(numbers, apply_fixes(fixes)):
+            results[number] = result
+        updated = sum(result['status'] == 'ok' for result in results)
+        return Response({'updated': updated, 'results': results},
+                        status=status.HTTP_200_OK)
+
+    @action(detail=True)
+    def trace(self, request, pk=None):
+        """Stream locations of the bus in a period.
+
+        Query params:
+            start, end: ISO 8601 or unix time, the last hour by default.
+
+        Points are [unix time, latitude, longitude, distance along the
+        route] in time order.
+        """
+        try:
+            bus_id = int(pk)
+            end = query_timestamp(request.GET.get('end')) or timezone.now()
+            start = (query_timestamp(request.GET.get('start'))
+                     or end - DEFAULT_TRACE_PERIOD)
+        except (ValueError, OverflowError, OSError):
+            return Response({'message': 'params must be timestamps'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not Vehicle.objects.filter(pk=bus_id).exists():
+            return Response({'message': 'Vehicle object does not exist.'},
+                            status=status.HTTP_404_NOT_FOUND)
+        history_buffer.flush()
+        return StreamingHttpResponse(
+            stream_trace(bus_id, iter_trace(bus_id, start, end)),
+            content_type='application/json')
 
 
 class StopViewSet(ViewSet):
-    """Get 4 bus_stops near you."""
+    """Get bus_stops near you."""
 
+    @cached_response('stops')
     def list(self, request):
-        """Get 4 bus_stops near you."""
+        """Get k (4 by default) bus_stops near you.
+
+        Query params:
+            latitude, longitude: The point to search around.
+            k: The number of stops to return, up to MAX_NEAREST_STOPS.
+            radius: Optional search radius in meters.
+            limit: The page size, up to MAX_NEAREST_STOPS. With it stops
+        are paged outward from the point and the response has the cursor
+        of the next page under "next", null on the last page.
+            cursor: The "next" of the previous page.
+        """
         latitude = request.GET.get('latitude')
         longitude = request.GET.get('longitude')
         if latitude is None or longitude is None:
             return Response({'message': 'params are required'})
-        our_location = (latitude, longitude)
-        queryset = BusStop.objects.all()
-        distances = {}
-        for stop in queryset:
-            point = (stop.location.latitude, stop.location.longitude)
-            distance = geodesic(our_location, point).meters
-            distances[distance] = stop
-        keys = sorted(distances.keys())[:4]
+        cursor = request.GET.get('cursor')
+        try:
+            latitude = float(latitude)
+            longitude = float(longitude)
+            k = int(request.GET.get('k', DEFAULT_NEAREST_STOPS))
+            limit = request.GET.get('limit')
+            if limit is None and cursor is not None:
+                limit = DEFAULT_NEAREST_STOPS
+            limit = int(limit) if limit is not None else None
+            radius = request.GET.get('radius')
+            radius = float(radius) if radius is not None else None
+        except ValueError:
+            return Response({'message': 'params must be numbers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # float() also takes 'nan' and 'inf'.
+        if not 0 < k <= MAX_NEAREST_STOPS or not (
+                math.isfinite(latitude) and math.isfinite(longitude)) or (
+                radius is not None and not 0 <= radius < math.inf) or (
+                limit is not None and not 0 < limit <= MAX_NEAREST_STOPS):
+            return Response({'message': 'params are out of range'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if limit is not None:
+            try:
+                page = search_stops(latitude, longitude, limit, radius,
+                                    cursor)
+            except ValueError as error:
+                return Response({'message': str(error)},
+                                status=status.HTTP_400_BAD_REQUEST)
+            return Response({
+                'stops': [[stop[1], stop[0], round(distance)]
+                          for distance, stop in page.stops],
+                'next': page.cursor,
+            }, status=status.HTTP_200_OK)
+        nearest = get_stop_index().nearest(latitude, longitude, k, radius)
         response = {
-            'stops': [[distances[key].name, distances[key].id] for key in keys]
+            'stops': [[stop[1], stop[0], round(distance)]
+                      for distance, stop in nearest]
         }
         return Response(response, status=status.HTTP_200_OK)
 
+    @cached_response('stops')
     def retrieve(self, request, pk=None):
         """Get stop info."""
         stop = BusStop.objects.get(pk=pk)
         return Response({'id': stop.id, 'name': stop.name},
                         status=status.HTTP_200_OK)
+
+    @action(detail=True)
+    def arrivals(self, request, pk=None):
+        """Get distance and ETA of every bus which passes the stop."""
+        try:
+            board = departure_board(int(pk))
+        except ValueError:
+            return Response({'message': 'params must be numbers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        except ObjectDoesNotExistError as error:
+            return Response({'message': str(error)},
+                            status=status.HTTP_404_NOT_FOUND)
+        return Response(board, status=status.HTTP_200_OK)
+
+
+class JourneyViewSet(ViewSet):
+    """Plan journeys between stops."""
+
+    def list(self, request):
+        """Get the fastest journey for every number of rides.
+
+        Query params:
+            from, to: PrimaryKeys of the first and the last stops.
+
+        Every journey has the number of rides, total minutes and legs: bus
+        rides on a route with the buses of the route, and walks between
+        stops close to each other.
+        """
+        try:
+            from_stop = int(request.GET['from'])
+            to_stop = int(request.GET['to'])
+        except KeyError:
+            return Response({'message': 'params are required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        except ValueError:
+            return Response({'message': 'params must be numbers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            journeys = get_graph().plan(from_stop, to_stop)
+        except KeyError:
+            return Response({'message': 'BusStop object does not exist.'},
+                            status=status.HTTP_404_NOT_FOUND)
+        path_ids = {leg['path_id'] for journey in journeys
+                    for leg in journey['legs'] if leg['mode'] == 'bus'}
+        buses = {}
+        for bus_id, name, path_id in Vehicle.objects.filter(
+                path_id__in=path_ids).values_list('id', 'name', 'path_id'):
+            buses.setdefault(path_id, []).append([name, bus_id])
+        for journey in journeys:
+            for leg in journey['legs']:
+                if leg['mode'] == 'bus':
+                    leg['buses'] = buses.get(leg['path_id'], [])
+        return Response({'from': from_stop, 'to': to_stop,
+                         'journeys': journeys}, status=status.HTTP_200_OK)
+
+
+class AlertViewSet(ViewSet):
+    """Proximity alerts of chats, see api/alerts.py."""
+
+    def list(self, request):
+        """Get alerts of the chat.
+
+        Query params:
+            chat_id: The chat.
+        """
+        try:
+            chat_id = int(request.GET['chat_id'])
+        except KeyError:
+            return Response({'message': 'params are required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        except ValueError:
+            return Response({'message': 'params must be numbers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        alerts = ProximityAlert.objects.filter(chat_id=chat_id).values(
+            'id', 'chat_id', 'vehicle_id', 'stop_id', 'distance', 'minutes')
+        return Response({'alerts': [alert_data(alert) for alert in alerts]},
+                        status=status.HTTP_200_OK)
+
+    def create(self, request):
+        """Ask to be told when the bus is close to the stop.
+
+        Body:
+            chat_id, bus, stop: The chat, the bus and the stop.
+            distance, minutes: Thresholds in meters and minutes, at least
+        one is required.
+
+        The alert fires once, when the bus is within either threshold or
+        has driven past the stop. A new alert of the chat for the same bus
+        and stop replaces the old one.
+        """
+        data = request.data
+        try:
+            chat_id = int(data['chat_id'])
+            bus_id = int(data['bus'])
+            stop_id = int(data['stop'])
+            distance = data.get('distance')
+            minutes = data.get('minutes')
+            if distance is None and minutes is None:
+                raise KeyError('distance')
+            distance = None if distance is None else float(distance)
+            minutes = None if minutes is None else int(minutes)
+        except KeyError:
+            return Response({'message': 'params are required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        except (TypeError, ValueError):
+            return Response({'message': 'params must be numbers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            path_id = Vehicle.objects.values_list(
+                'path_id', flat=True).get(pk=bus_id)
+            stop_offset(stop_id, path_id)
+        except Vehicle.DoesNotExist:
+            message = 'Vehicle object does not exist.'
+        except BusStop.DoesNotExist:
+            message = 'BusStop object does not exist.'
+        except Path.DoesNotExist:
+            message = 'Path object does not exist.'
+        else:
+            message = None
+        if message is not None:
+            return Response({'message': message},
+                            status=status.HTTP_404_NOT_FOUND)
+        alert, _ = ProximityAlert.objects.update_or_create(
+            chat_id=chat_id, vehicle_id=bus_id, stop_id=stop_id,
+            defaults={'distance': distance, 'minutes': minutes,
+                      'created': timezone.now()})
+        return Response(alert_data({
+            'id': alert.id, 'chat_id': chat_id, 'vehicle_id': bus_id,
+            'stop_id': stop_id, 'distance': distance, 'minutes': minutes,
+        }), status=status.HTTP_201_CREATED)
+
+    def destroy(self, request, pk=None):
+        """Cancel the alert."""
+        deleted, _ = ProximityAlert.objects.filter(pk=pk).delete()
+        if not deleted:
+            return Response(
+                {'message': 'ProximityAlert object does not exist.'},
+                status=status.HTTP_404_NOT_FOUND)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class FleetViewSet(ViewSet):
+    """Get positions of every bus."""
+
+    def list(self, request):
+        """Get positions of every bus or of the buses changed since.
+
+        Query params:
+            since: Optional version of an earlier response. Only buses
+        changed after it and ids of removed buses are returned, unless
+        "full" in the response is true.
+
+        The body is pre-serialized, a full snapshot is built once per
+        version.
+        """
+        since = request.GET.get('since')
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            return Response({'message': 'params must be numbers'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        version, body = fleet.snapshot(since)
+        if since is None and request.headers.get(
+                'If-None-Match') == f'"{version}"':
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        response = HttpResponse(body, content_type='application/json')
+        if since is None:
+            response['ETag'] = f'"{version}"'
+        return response
+
+    @action(detail=False)
+    def positions(self, request):
+        """Get positions as a GTFS-realtime VehiclePositions feed in JSON."""
+        _, body = fleet.vehicle_positions()
+        return HttpResponse(body, content_type='application/json')
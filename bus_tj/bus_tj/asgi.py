@@ -2,6 +2,8 @@
 ASGI config for bus_tj project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Requests to the arrival stream are served by ``api.streaming``, everything
+else goes to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -13,4 +15,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bus_tj.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from api.streaming import STREAM_PATH, sse_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """Route the stream endpoint to the SSE application."""
+    if scope['type'] == 'http' and scope['path'] == STREAM_PATH:
+        return await sse_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -128,3 +129,119 @@ STATIC_URL = '/static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MEDIA_ROOT = BASE_DIR / 'media'
+
+# Fan-out of live arrival updates, see api/pubsub.py. Use
+# api.pubsub.RedisBroker when WSGI and ASGI workers run in separate
+# processes.
+
+PUBSUB = {
+    'BACKEND': 'api.pubsub.LocalBroker',
+    'OPTIONS': {},
+}
+
+# Cache of API responses, see api/caching.py. Versions of cached data live
+# in the cache too, so use a shared backend (e.g. Redis or Memcached) when
+# several processes serve the API. With locmem a process doesn't see changes
+# made by another one until its versions expire, up to API_CACHE_TIMEOUT
+# seconds later.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'bus_tj',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+API_CACHE = 'default'
+
+API_CACHE_TIMEOUT = 300
+
+# Location history, see api/history.py. Fixes are written in batches of
+# HISTORY_BATCH_SIZE or every HISTORY_FLUSH_INTERVAL seconds. Every
+# HISTORY_COMPACT_INTERVAL seconds, and when the compact_history command
+# runs, every fix is kept for HISTORY_RAW_DAYS, one per HISTORY_RESOLUTION
+# seconds after that and nothing after HISTORY_RETENTION_DAYS.
+
+HISTORY_PARTITION = 60 * 60
+
+HISTORY_BATCH_SIZE = 500
+
+HISTORY_FLUSH_INTERVAL = 5
+
+HISTORY_RAW_DAYS = 7
+
+HISTORY_RESOLUTION = 60
+
+HISTORY_RETENTION_DAYS = 90
+
+HISTORY_COMPACT_INTERVAL = 60 * 60
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.metrics.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+# Sampling profiler, see api/metrics.py. PROFILE_SAMPLE_RATE of requests
+# are run under cProfile and dumps of the PROFILE_KEEP slowest ones are
+# kept in PROFILE_DIR.
+
+PROFILE_SAMPLE_RATE = 0
+
+PROFILE_KEEP = 20
+
+PROFILE_DIR = BASE_DIR / 'profiles'
+
+# Indexes of stops and routes held by a process are dropped when another
+# process changes the network, see api/network.py. Processes look for
+# changes every NETWORK_CHECK_INTERVAL seconds.
+
+NETWORK_CHECK_INTERVAL = 1
+
+# Live vehicle state, see api/live.py. Workers which map the same
+# LIVE_STATE_PATH share it; locations are written to the database in
+# batches of LIVE_STATE_BATCH_SIZE or every LIVE_STATE_FLUSH_INTERVAL
+# seconds.
+
+LIVE_STATE_PATH = BASE_DIR / 'live_state.bin'
+
+LIVE_STATE_CAPACITY = 1 << 16
+
+LIVE_STATE_BATCH_SIZE = 500
+
+LIVE_STATE_FLUSH_INTERVAL = 5
+
+# Journey planner, see api/journey.py. Every ride costs JOURNEY_BOARD_WAIT
+# minutes of waiting, stops closer than JOURNEY_WALK_DISTANCE meters are
+# connected by walks at JOURNEY_WALK_SPEED meters a minute.
+
+JOURNEY_MAX_RIDES = 4
+
+JOURNEY_BOARD_WAIT = 5
+
+JOURNEY_WALK_DISTANCE = 300
+
+JOURNEY_WALK_SPEED = 80
+
+# Routes which end within ROUTE_LOOP_TOLERANCE meters of their start are
+# circular, buses reach the stops behind them on the next lap.
+
+ROUTE_LOOP_TOLERANCE = 50
+
+# Proximity alerts, see api/alerts.py. Alerts which haven't fired in
+# ALERT_TTL seconds are dropped, workers look for new alerts in the
+# database every ALERT_CHECK_INTERVAL seconds, and an alert nobody
+# received is published again after ALERT_RETRY_INTERVAL seconds.
+
+ALERT_TTL = 2 * 60 * 60
+
+ALERT_CHECK_INTERVAL = 1
+
+ALERT_RETRY_INTERVAL = 30
+
+# Secret the bot sends to read fired alerts from the stream endpoint, the
+# alert stream is closed while it isn't set.
+
+ALERT_STREAM_TOKEN = None
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.16 on 2026-10-18 14:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0008_busstop_buses'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField()),
+                ('resolution', models.IntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+                ('data', models.BinaryField()),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='location_chunks', to='tracker.vehicle')),
+            ],
+            options={
+                'unique_together': {('vehicle', 'start', 'resolution')},
+            },
+        ),
+    ]
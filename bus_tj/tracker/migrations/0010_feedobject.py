@@ -0,0 +1,27 @@
+# Generated by Django 3.2.16 on 2026-10-18 15:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0009_locationchunk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedObject',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('feed', models.CharField(max_length=64)),
+                ('kind', models.CharField(max_length=16)),
+                ('source_id', models.CharField(max_length=255)),
+                ('object_id', models.BigIntegerField()),
+                ('checksum', models.CharField(max_length=40)),
+            ],
+            options={
+                'unique_together': {('feed', 'kind', 'source_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 3.2.16 on 2026-10-18 15:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_vehicle_distance(apps, schema_editor):
+    """Take distance of buses from the Path row of their location."""
+    Path = apps.get_model('tracker', 'Path')
+    Vehicle = apps.get_model('tracker', 'Vehicle')
+    Vehicle.objects.update(distance=models.Subquery(
+        Path.objects.filter(
+            path_id=models.OuterRef('path_id'),
+            location_id=models.OuterRef('location_id'),
+        ).values('distance')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0010_feedobject'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StopOffset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path_id', models.IntegerField()),
+                ('distance', models.FloatField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='vehicle',
+            name='distance',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='path',
+            index=models.Index(fields=['path_id', 'order'], name='tracker_pat_path_id_217386_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='path',
+            index=models.Index(fields=['path_id', 'distance'], name='tracker_pat_path_id_163938_idx'),
+        ),
+        migrations.AddField(
+            model_name='stopoffset',
+            name='stop',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='offsets', to='tracker.busstop'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stopoffset',
+            unique_together={('stop', 'path_id')},
+        ),
+        migrations.RunPython(fill_vehicle_distance,
+                             migrations.RunPython.noop),
+    ]
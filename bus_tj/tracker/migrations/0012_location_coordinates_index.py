@@ -0,0 +1,17 @@
+# Generated by Django 3.2.16 on 2026-10-18 15:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0011_route_offsets'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['latitude', 'longitude'], name='tracker_loc_latitud_523a89_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.16 on 2026-10-18 15:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0012_location_coordinates_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JourneyGraph',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('data', models.BinaryField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.16 on 2026-10-18 15:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0013_journeygraph'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProximityAlert',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField()),
+                ('distance', models.FloatField(null=True)),
+                ('minutes', models.IntegerField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('stop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alerts', to='tracker.busstop')),
+                ('vehicle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alerts', to='tracker.vehicle')),
+            ],
+            options={
+                'unique_together': {('chat_id', 'vehicle', 'stop')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.16 on 2026-10-18 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0014_proximityalert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proximityalert',
+            name='fired',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.2.16 on 2026-10-18 15:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0015_proximityalert_fired'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NetworkChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
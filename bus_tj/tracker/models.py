@@ -13,6 +13,11 @@ class Location(models.Model):
     latitude = models.FloatField()
     longitude = models.FloatField()
 
+    class Meta:
+        """Index points by coordinates for nearest lookups."""
+
+        indexes = [models.Index(fields=['latitude', 'longitude'])]
+
 
 class Path(models.Model):
     """Path model.
@@ -32,12 +37,23 @@ class Path(models.Model):
     order = models.IntegerField()
     distance = models.IntegerField()
 
+    class Meta:
+        """Index rows by route for ordered and distance lookups."""
+
+        indexes = [
+            models.Index(fields=['path_id', 'order']),
+            models.Index(fields=['path_id', 'distance']),
+        ]
+
 
 class Vehicle(models.Model):
     """Vehicle model.
 
     Attributes:
     name (CharField): The name of a vehicle.
+    path_id (IntegerField): The id of the route of the vehicle.
+    location (Location): The route point the vehicle is at.
+    distance (FloatField): The distance of the vehicle from the route start.
     """
 
     name = models.CharField(max_length=10)
@@ -46,6 +62,7 @@ class Vehicle(models.Model):
         Location, on_delete=models.SET_NULL, null=True,
         related_name='vehicle_location'
     )
+    distance = models.FloatField(null=True, blank=True)
 
 
 class BusStop(models.Model):
@@ -60,3 +77,132 @@ class BusStop(models.Model):
     location = models.ForeignKey(
         Location, on_delete=models.CASCADE, related_name='location')
     buses = models.ManyToManyField(Vehicle)
+
+
+class StopOffset(models.Model):
+    """Distance of a stop from the start of a route which serves it.
+
+    Attributes:
+    stop (BusStop): The stop.
+    path_id (IntegerField): The id of the route.
+    distance (FloatField): The distance from the route start.
+    """
+
+    stop = models.ForeignKey(
+        BusStop, on_delete=models.CASCADE, related_name='offsets')
+    path_id = models.IntegerField()
+    distance = models.FloatField()
+
+    class Meta:
+        """Keep one offset of a stop per route."""
+
+        unique_together = ('stop', 'path_id')
+
+
+class LocationChunk(models.Model):
+    """Packed location history of a vehicle in one time partition.
+
+    Attributes:
+    vehicle (Vehicle): The vehicle.
+    start (DateTimeField): The start of the partition.
+    resolution (IntegerField): Seconds between kept records, 0 if every
+    fix is kept.
+    count (IntegerField): The number of records.
+    data (BinaryField): Fixed-width records sorted by time, see
+    api/history.py.
+    """
+
+    vehicle = models.ForeignKey(
+        Vehicle, on_delete=models.CASCADE, related_name='location_chunks')
+    start = models.DateTimeField()
+    resolution = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)
+    data = models.BinaryField()
+
+    class Meta:
+        """Keep one chunk per partition and resolution."""
+
+        unique_together = ('vehicle', 'start', 'resolution')
+
+
+class FeedObject(models.Model):
+    """Object imported from an external feed, e.g. a GTFS stop.
+
+    Attributes:
+    feed (CharField): The name of the feed.
+    kind (CharField): The kind of the source object, e.g. 'stop'.
+    source_id (CharField): The id of the object in the feed.
+    object_id (BigIntegerField): PrimaryKey of the created object, or
+    Path.path_id for routes.
+    checksum (CharField): The checksum of the source data, an object is
+    updated on re-import only if it changes.
+    """
+
+    feed = models.CharField(max_length=64)
+    kind = models.CharField(max_length=16)
+    source_id = models.CharField(max_length=255)
+    object_id = models.BigIntegerField()
+    checksum = models.CharField(max_length=40)
+
+    class Meta:
+        """Remember each source object of a feed once."""
+
+        unique_together = ('feed', 'kind', 'source_id')
+
+
+class JourneyGraph(models.Model):
+    """Route and stop arrays of the journey planner built from the network.
+
+    Attributes:
+    created (DateTimeField): The time the graph was built.
+    data (BinaryField): NumPy arrays in the .npz format, see
+    api/journey.py.
+    """
+
+    created = models.DateTimeField(auto_now_add=True)
+    data = models.BinaryField()
+
+
+class NetworkChange(models.Model):
+    """Change of stops, routes or their buses made by one process.
+
+    Other processes drop their indexes when the last id moves, see
+    api/network.py.
+
+    Attributes:
+    created (DateTimeField): The time of the change.
+    """
+
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class ProximityAlert(models.Model):
+    """Request of a chat to be told when a bus comes close to a stop.
+
+    Attributes:
+    chat_id (BigIntegerField): The Telegram chat to notify.
+    vehicle (Vehicle): The bus.
+    stop (BusStop): The stop.
+    distance (FloatField): Notify when the bus is this many meters away,
+    or None.
+    minutes (IntegerField): Notify when the bus is this many minutes away,
+    or None.
+    created (DateTimeField): The time of the request.
+    fired (BooleanField): A worker is publishing the alert, it's deleted
+    when it reaches the bot.
+    """
+
+    chat_id = models.BigIntegerField()
+    vehicle = models.ForeignKey(
+        Vehicle, on_delete=models.CASCADE, related_name='alerts')
+    stop = models.ForeignKey(
+        BusStop, on_delete=models.CASCADE, related_name='alerts')
+    distance = models.FloatField(null=True)
+    minutes = models.IntegerField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    fired = models.BooleanField(default=False)
+
+    class Meta:
+        """Keep one alert of a chat per bus and stop."""
+
+        unique_together = ('chat_id', 'vehicle', 'stop')